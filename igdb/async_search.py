@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import random
+import time
+import numpy as np
+from psycopg import errors  # type: ignore
+from psycopg_pool import AsyncConnectionPool  # type: ignore
+from pgvector.psycopg import register_vector_async  # type: ignore
+from .embedding_client import DEFAULT_BATCH_SIZE, DEFAULT_MAX_CONCURRENCY, ThrottledError
+from .search import (DEFAULT_HYBRID_CANDIDATES, DEFAULT_RERANK_FACTOR, DEFAULT_RRF_K, DEFAULT_SECRET_TTL, DEFAULT_TOP_K,
+                     SearchClient, SearchQueries, SecretCache)
+from .tracing import current_span, span
+
+logger = logging.getLogger(__name__)
+
+# Texts submitted within this many seconds are packed into the same endpoint request
+DEFAULT_BATCH_WINDOW = 0.005
+# Seconds to wait for a pooled connection before giving up, so a saturated database fails fast instead of queueing
+DEFAULT_POOL_TIMEOUT = 5.0
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution and its result (or exception).
+    # Awaiters are shielded, a cancelled caller doesn't cancel the call the others are waiting for.
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._futures = {}
+
+    def _done(self, key, future):
+        self._futures.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # Retrieved, even if every caller was cancelled
+
+    async def run(self, key, function, *args, **kwargs):
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function(*args, **kwargs))
+            self._futures[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+            self.calls += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(future)
+
+
+class AsyncEmbeddingClient:
+    # Async front of a blocking transport ("SageMakerTransport", "HttpTransport", "FakeTransport"):
+    #   - concurrent requests for the same text share one embedding,
+    #   - at most "max_concurrency" requests are in flight (the endpoint's MaxConcurrency),
+    #   - a request takes up to "batch_size" of the queued texts once it gets a slot, so texts queue up while the
+    #     endpoint is busy and go out together, and a lone text waits at most "batch_window" seconds for company,
+    #   - throttled requests are retried with exponential backoff and full jitter.
+    # [NOTE] The optional "cache" is called on the event loop, use an in-memory one ("MemoryEmbeddingCache").
+    def __init__(self, transport, batch_size=DEFAULT_BATCH_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 batch_window=DEFAULT_BATCH_WINDOW, max_retries=8, base_delay=0.2, max_delay=20.0, cache=None):
+        self.transport = transport
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+        self.texts = 0
+        self.coalesced = 0
+        self._futures = {}  # Text -> future of its vector, while it is queued or being embedded
+        self._queue = []
+        self._flush_handle = None
+        self._tasks = set()
+        self._slots = None
+
+    def _submit(self, text):
+        self.texts += 1
+        future = self._futures.get(text)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        loop = asyncio.get_running_loop()
+        future = self._futures[text] = loop.create_future()
+        self._queue.append(text)
+        if len(self._queue) % self.batch_size == 0:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        # Start a request for the queued texts, it takes them from the queue when it gets a slot
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        task = asyncio.ensure_future(self._send())
+        self._tasks.add(task)  # Keep a reference until it completes
+        task.add_done_callback(self._tasks.discard)
+
+    async def _invoke(self, texts):
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                vectors = (await asyncio.to_thread(self.transport, {"inputs": texts}))["vectors"]
+            except ThrottledError:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                continue
+            if len(vectors) != len(texts):
+                raise ValueError(f"Expected {len(texts)} vectors, got {len(vectors)}")
+            return vectors
+
+    async def _send(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._slots:
+            texts, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            if not texts:
+                return  # Taken by an earlier request
+            if self._queue and self._flush_handle is None:
+                self._flush()
+            try:
+                vectors = await self._invoke(texts)
+            except Exception as error:
+                vectors = error
+        if isinstance(vectors, Exception):
+            for text in texts:
+                future = self._futures.pop(text)
+                if not future.done():
+                    future.set_exception(vectors)
+            return
+        if self.cache is not None:
+            self.cache.put_many(texts, vectors)
+        for text, vector in zip(texts, vectors):
+            future = self._futures.pop(text)
+            if not future.done():
+                future.set_result(vector)
+
+    async def embed(self, texts):
+        vectors = self.cache.get_many(texts) if self.cache is not None else [None] * len(texts)
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        futures = [self._submit(texts[i]) for i in misses]
+        for i, vector in zip(misses, await asyncio.gather(*(asyncio.shield(future) for future in futures))):
+            vectors[i] = vector
+        return vectors
+
+
+class AsyncSearchClient(SearchQueries):
+    # Same searches as "SearchClient" on an asyncio connection pool, for services serving many users at once.
+    # The pool size bounds the concurrent queries, a query waiting longer than "pool_timeout" for a connection
+    # fails with "psycopg_pool.PoolTimeout". Call "await open()" (or use "async with") before searching.
+    def __init__(self, secret_arn=None, conninfo="", embedder=None, min_size=1, max_size=4,
+                 secret_ttl=DEFAULT_SECRET_TTL, pool_timeout=DEFAULT_POOL_TIMEOUT, probes=None, ef_search=None,
+                 table="igdb", storage="full", rerank_factor=DEFAULT_RERANK_FACTOR, dim=384, neighbors_table=None,
+                 result_cache=None):
+        SearchQueries.__init__(self, table, storage, rerank_factor, dim, neighbors_table, result_cache)
+        self.secrets = SecretCache(secret_arn, ttl=secret_ttl) if secret_arn else None
+        self.embedder = embedder  # Optional "AsyncEmbeddingClient" used by "search_text()" and "hybrid_search()"
+        self.probes = probes
+        self.ef_search = ef_search
+        self.pool = AsyncConnectionPool(
+            conninfo,
+            kwargs=self._connect_kwargs if self.secrets else None,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=pool_timeout,
+            configure=register_vector_async,
+            open=False,
+        )
+
+    async def _connect_kwargs(self):
+        # Secrets Manager is called from a thread, the event loop keeps serving while the secret is refreshed
+        return await asyncio.to_thread(self.secrets.connect_kwargs)
+
+    _ef_search = SearchClient._ef_search
+
+    async def _fetch(self, query, params, candidates, probes=None, ef_search=None):
+        ef_search = self._ef_search(ef_search, candidates)
+        probes = self.probes if probes is None else probes
+        with span("query"):
+            async with self.pool.connection() as conn:
+                if probes is not None:
+                    await conn.execute("SELECT set_config('ivfflat.probes', %s, true);", (str(int(probes)),))
+                if ef_search is not None:
+                    await conn.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(int(ef_search)),))
+                async with conn.cursor() as cur:
+                    await cur.execute(query, params, prepare=True)
+                    return await cur.fetchall()
+
+    async def search(self, vector, k=DEFAULT_TOP_K, probes=None, ef_search=None):
+        vector = np.asarray(vector, dtype=np.float32)
+        candidates = k * self.rerank_factor if self.storage == "halfvec" else k
+        return await self._fetch(self.query, self._params(vector, k), candidates, probes, ef_search)
+
+    async def generation(self):
+        try:
+            async with self.pool.connection() as conn:
+                row = await (await conn.execute(self.generation_query)).fetchone()
+        except errors.UndefinedTable:
+            row = None
+        return row[0] if row else 0
+
+    async def _cached(self, key, vector, start, search):
+        # Same as "SearchClient._cached()", "search" is a coroutine function
+        if self.result_cache is None:
+            return await search()
+        if self.result_cache.generation_due():
+            self.result_cache.set_generation(await self.generation())
+        rows = self.result_cache.get(key, vector, time.perf_counter() - start)
+        current_span().add(cache_hits=rows is not None)
+        if rows is None:
+            rows = await search()
+            self.result_cache.put(key, vector, rows, time.perf_counter() - start)
+        return rows
+
+    @span("search_text")
+    async def search_text(self, text, k=DEFAULT_TOP_K, **kwargs):
+        start = time.perf_counter()
+        with span("embed"):
+            vector, = await self.embedder.embed([text])
+        return await self._cached(self._cache_key("vector", k, **kwargs), vector, start, lambda: self.search(vector, k=k, **kwargs))
+
+    async def lexical_search(self, text, k=DEFAULT_TOP_K):
+        with span("lexical"):
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(self.lexical_query, dict(text=text, k=k), prepare=True)
+                    rows = await cur.fetchall()
+        return [row[:-1] for row in rows], bool(rows) and rows[0][-1]
+
+    @span("hybrid_search")
+    async def hybrid_search(self, text, k=DEFAULT_TOP_K, vector=None, candidates=DEFAULT_HYBRID_CANDIDATES,
+                            rrf_k=DEFAULT_RRF_K, lexical_fast_path=True, probes=None, ef_search=None):
+        # Same as "SearchClient.hybrid_search()"
+        start = time.perf_counter()
+        if lexical_fast_path and vector is None:
+            rows, strong_match = await self.lexical_search(text, k)
+            if strong_match:
+                return rows
+        if vector is None:
+            with span("embed"):
+                vector, = await self.embedder.embed([text])
+        candidates = max(candidates, k)
+        params = dict(text=text, vector=np.asarray(vector, dtype=np.float32), candidates=candidates, rrf_k=rrf_k, k=k)
+        key = self._cache_key("hybrid", k, candidates=candidates, rrf_k=rrf_k, probes=probes, ef_search=ef_search)
+        return await self._cached(key, vector, start, lambda: self._fetch(self.hybrid_query, params, candidates, probes, ef_search))
+
+    async def related(self, igdb_id, k=DEFAULT_TOP_K):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(self.related_query, (igdb_id, k), prepare=True)
+                return await cur.fetchall()
+
+    async def open(self):
+        await self.pool.open(wait=True)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
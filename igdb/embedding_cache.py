@@ -0,0 +1,188 @@
+# Embedding caches of the notebooks and the inference script, it only depends on the standard library.
+# "igdb/embedding_cache.py" is the canonical file, "model/code/embedding_cache.py" is a copy of it: edit it and
+# copy it over, "tests/test_embedding_cache.py" checks they match.
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+# The model and pooling mode served by the model endpoint, see "model/code/inference.py"
+DEFAULT_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_POOLING = "mean"
+DEFAULT_MAX_ENTRIES = 1_000_000
+# Query embeddings kept in memory by "MemoryEmbeddingCache" (about 1.5 KiB each)
+DEFAULT_MEMORY_ENTRIES = 10_000
+
+# SQLite limits the number of host parameters of a statement
+_CHUNK_SIZE = 500
+
+
+def normalize_text(text):
+    # Texts that only differ in unicode composition or whitespace share the same embedding
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    # Persistent embedding cache in a local SQLite file, content-addressed by
+    # sha256(model id, pooling mode, normalized text). The least recently used entries
+    # are evicted once the cache holds more than "max_entries" embeddings.
+    # [NOTE] The number of entries is counted once when the file is opened, then kept up to date by "put_many()",
+    # so writers don't scan the table. Other processes writing to the same file make it drift until it's reopened.
+    def __init__(self, path, model_id=DEFAULT_MODEL_ID, pooling=DEFAULT_POOLING, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.model_id = model_id
+        self.pooling = pooling
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings(
+                              key BLOB PRIMARY KEY,
+                              vector BLOB NOT NULL,
+                              last_access REAL NOT NULL);""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access_idx ON embeddings (last_access);")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT count(*) FROM embeddings;").fetchone()[0]
+
+    def key(self, text):
+        digest = hashlib.sha256()
+        for part in (self.model_id, self.pooling, normalize_text(text)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.digest()
+
+    def get_many(self, texts):
+        # Return the cached vector of each text, or None when it is missing
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _CHUNK_SIZE):
+                chunk = keys[start:start + _CHUNK_SIZE]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))});", chunk)
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?;",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+            vectors = [array("f", found[key]).tolist() if key in found else None for key in keys]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, texts, vectors):
+        now = time.time()
+        rows = {self.key(text): (array("f", vector).tobytes(), now) for text, vector in zip(texts, vectors)}
+        keys = list(rows)
+        with self._lock:
+            # Primary key lookups of the keys being written, to count the new entries only
+            existing = 0
+            for start in range(0, len(keys), _CHUNK_SIZE):
+                chunk = keys[start:start + _CHUNK_SIZE]
+                existing += self._conn.execute(
+                    f"SELECT count(*) FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))});", chunk).fetchone()[0]
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?);",
+                                   [(key, vector, last_access) for key, (vector, last_access) in rows.items()])
+            self._count += len(keys) - existing
+            self._evict()
+            self._conn.commit()
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def put(self, text, vector):
+        self.put_many([text], [vector])
+
+    def _evict(self):
+        excess = self._count - self.max_entries
+        if excess > 0:
+            # The least recently used entries, read from the "last_access" index
+            deleted = self._conn.execute("""DELETE FROM embeddings WHERE key IN (
+                                            SELECT key FROM embeddings ORDER BY last_access LIMIT ?);""", (excess,)).rowcount
+            self._count -= deleted
+            self.evictions += deleted
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+class MemoryEmbeddingCache:
+    # In-memory LRU of query embeddings, keyed by the normalized text, for the repeated questions of a search
+    # frontend. Same interface as "EmbeddingCache", pass it as the "cache" of an embedding client.
+    # [NOTE] Texts are lower-cased as well by default: the tokenizer of all-MiniLM-L6-v2 is uncased, they embed the same.
+    def __init__(self, max_entries=DEFAULT_MEMORY_ENTRIES, lowercase=True):
+        self.max_entries = max_entries
+        self.lowercase = lowercase
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text):
+        text = normalize_text(text)
+        return text.lower() if self.lowercase else text
+
+    def get_many(self, texts):
+        vectors = []
+        with self._lock:
+            for text in texts:
+                key = self.key(text)
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                vectors.append(vector)
+        return vectors
+
+    def put_many(self, texts, vectors):
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                self._entries[key] = vector
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def put(self, text, vector):
+        self.put_many([text], [vector])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+# Defaults follow the Serverless endpoint config in "SageMakerModelStack" and "MAX_BATCH_SIZE" of the inference script
+DEFAULT_MAX_CONCURRENCY = 5
+DEFAULT_BATCH_SIZE = 32
+
+# Error codes returned by SageMaker Runtime when the endpoint is out of capacity
+THROTTLING_ERROR_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailable", "ModelNotReadyException")
+THROTTLING_STATUS_CODES = (429, 503)
+
+
+class ThrottledError(Exception):
+    pass
+
+
+class SageMakerTransport:
+    # Invoke a SageMaker endpoint with a JSON payload, same as "HuggingFacePredictor.predict()" does
+    def __init__(self, endpoint_name, client=None):
+        if client is None:
+            import boto3  # type: ignore
+            client = boto3.client("sagemaker-runtime")
+        self.endpoint_name = endpoint_name
+        self.client = client
+
+    def __call__(self, payload):
+        try:
+            response = self.client.invoke_endpoint(
+                EndpointName=self.endpoint_name,
+                ContentType="application/json",
+                Accept="application/json",
+                Body=json.dumps(payload),
+            )
+        except self.client.exceptions.ClientError as error:
+            if error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                raise ThrottledError(str(error)) from error
+            raise
+        return json.loads(response["Body"].read())
+
+
+class HttpTransport:
+    # POST a JSON payload to an HTTP endpoint, e.g. a local stand-in serving "predict_fn()"
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, payload):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            if error.code in THROTTLING_STATUS_CODES:
+                raise ThrottledError(f"HTTP {error.code}") from error
+            raise
+
+
+class FakeTransport:
+    # Deterministic unit vectors derived from a hash of each text, after a simulated endpoint latency.
+    # Stands in for the model endpoint in local runs and load tests, identical texts get identical vectors.
+    def __init__(self, dim=384, latency=0.05, per_text_latency=0.002):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+
+    def vector(self, text):
+        import numpy as np
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).normal(size=self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def __call__(self, payload):
+        texts = payload["inputs"]
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return {"vectors": [self.vector(text) for text in texts]}
+
+
+class EmbeddingClient:
+    # Pack texts into batched requests, keep at most "max_concurrency" requests in flight,
+    # and retry throttled requests with exponential backoff and full jitter
+    def __init__(self, transport, batch_size=DEFAULT_BATCH_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=8, base_delay=0.2, max_delay=20.0, cache=None):
+        self.transport = transport
+        self.cache = cache  # Optional "EmbeddingCache", checked before calling the model
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _invoke(self, texts):
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                self.requests += 1
+            try:
+                vectors = self.transport({"inputs": texts})["vectors"]
+            except ThrottledError:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.debug(f"Throttled, retrying in {delay:.2f}s (attempt {attempt + 1})")
+                time.sleep(delay)
+                continue
+            if len(vectors) != len(texts):
+                raise ValueError(f"Expected {len(texts)} vectors, got {len(vectors)}")
+            return vectors
+
+    def embed_batches(self, texts):
+        # Yield "(indices, vectors)" for every batch as soon as it completes, in completion order.
+        # Cached texts are yielded first without calling the model, the rest are submitted lazily
+        # so only "max_concurrency" batches are pending at once.
+        texts = list(texts)
+        misses = list(range(len(texts)))
+        if self.cache is not None:
+            cached = self.cache.get_many(texts)
+            hits = [i for i, vector in enumerate(cached) if vector is not None]
+            if hits:
+                yield hits, [cached[i] for i in hits]
+            misses = [i for i, vector in enumerate(cached) if vector is None]
+
+        batches = (misses[start:start + self.batch_size] for start in range(0, len(misses), self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = {}
+            for indices in batches:
+                pending[executor.submit(self._invoke, [texts[i] for i in indices])] = indices
+                if len(pending) >= self.max_concurrency:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._completed(texts, pending.pop(future), future.result())
+            for future in list(pending):
+                yield self._completed(texts, pending.pop(future), future.result())
+
+    def _completed(self, texts, indices, vectors):
+        if self.cache is not None:
+            self.cache.put_many([texts[i] for i in indices], vectors)
+        return indices, vectors
+
+    def embed(self, texts):
+        vectors = [None] * len(texts)
+        for indices, batch_vectors in self.embed_batches(texts):
+            for i, vector in zip(indices, batch_vectors):
+                vectors[i] = vector
+        return vectors
+
+    def embed_to_file(self, texts, path, keys=None):
+        # Append one JSON line per text ("{"key": ..., "vector": [...]}") as soon as its batch completes,
+        # so a long run keeps its progress on disk. "keys" defaults to the position of the text.
+        keys = list(range(len(texts))) if keys is None else list(keys)
+        written = 0
+        with open(path, "a") as file:
+            for indices, batch_vectors in self.embed_batches(texts):
+                for i, vector in zip(indices, batch_vectors):
+                    file.write(json.dumps({"key": keys[i], "vector": vector}) + "\n")
+                file.flush()
+                written += len(batch_vectors)
+        return written
+
+
+def read_embeddings_file(path):
+    # Vectors written by "EmbeddingClient.embed_to_file()", by key. A last line cut off by an interrupted run is
+    # truncated away, so a resumed run appends after the last complete line.
+    vectors = {}
+    if not os.path.exists(path):
+        return vectors
+    with open(path, "rb+") as file:
+        end = 0
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            record = json.loads(line)
+            vectors[record["key"]] = record["vector"]
+            end += len(line)
+        file.truncate(end)
+    return vectors
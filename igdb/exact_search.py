@@ -0,0 +1,160 @@
+import json
+import os
+import numpy as np
+from .search import RESULT_COLUMNS, DEFAULT_TOP_K
+
+EMBEDDINGS_FILE = "embeddings.npy"
+IDS_FILE = "ids.npy"
+METADATA_FILE = "metadata.json"
+
+# Number of rows fetched from the database, queries scored and compact rows decoded, at once
+EXPORT_CHUNK_SIZE = 2000
+QUERY_CHUNK_SIZE = 64
+ROW_CHUNK_SIZE = 65536
+# With a quantized copy, the first pass fetches this many candidates per result for re-ranking
+DEFAULT_RERANK_FACTOR = 4
+
+
+def export_index(conn, path, table="igdb", chunk_size=EXPORT_CHUNK_SIZE):
+    # Export the embeddings of the table into a float32 matrix file, plus the ids and the other
+    # result columns. Rows are streamed with a server-side cursor and written straight into the
+    # memory-mapped matrix, so the export doesn't hold the whole table in memory.
+    # [NOTE] "register_vector()" must have been called on the connection
+    os.makedirs(path, exist_ok=True)
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*), max(vector_dims(description_embeddings)) FROM {table};")
+        count, dim = cur.fetchone()
+    embeddings = np.lib.format.open_memmap(os.path.join(path, EMBEDDINGS_FILE), mode="w+", dtype=np.float32, shape=(count, dim or 0))
+    ids = np.empty(count, dtype=np.int64)
+    metadata = []
+    with conn.transaction():
+        with conn.cursor(name="igdb_export") as cur:
+            cur.itersize = chunk_size
+            cur.execute(f"SELECT {', '.join(RESULT_COLUMNS)}, description_embeddings FROM {table} ORDER BY igdb_id;")
+            for i, (*columns, vector) in enumerate(cur):
+                if i >= count:  # Rows inserted after counting
+                    break
+                ids[i] = columns[0]
+                embeddings[i] = vector
+                metadata.append(columns)
+    embeddings.flush()
+    del embeddings
+    np.save(os.path.join(path, IDS_FILE), ids[:len(metadata)])
+    with open(os.path.join(path, METADATA_FILE), "w") as file:
+        json.dump(metadata, file)
+    return ExactSearchIndex(path)
+
+
+class ExactSearchIndex:
+    # Brute-force cosine top-k search over a memory-mapped embedding matrix.
+    # Returns the same rows (columns and order) as "SearchClient.search()" does without an ANN index.
+    # With "quantization" set to "float16" or "int8" (scalar-quantized with per-dimension scale/offset),
+    # the first pass scans a compact in-memory copy, then only the top candidates are re-ranked with
+    # the full precision rows read from the memory-mapped matrix.
+    def __init__(self, path, embedder=None, quantization=None, rerank_factor=DEFAULT_RERANK_FACTOR):
+        self.embedder = embedder  # Optional "EmbeddingClient" used by "search_text()"
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.ids = np.load(os.path.join(path, IDS_FILE))
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")[:len(self.ids)]
+        with open(os.path.join(path, METADATA_FILE)) as file:
+            self.metadata = [tuple(row) for row in json.load(file)]
+        # Cosine similarity = dot product of unit vectors, keep the inverse norms instead of a normalized copy
+        norms = np.linalg.norm(self.embeddings, axis=1)
+        self.inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0).astype(np.float32)
+        self.codes = self.scale = self.offset = None
+        if quantization is not None:
+            self._quantize(quantization)
+
+    def _quantize(self, quantization):
+        n, dim = self.embeddings.shape
+        if quantization == "float16":
+            self.codes = np.empty((n, dim), dtype=np.float16)
+            for start in range(0, n, ROW_CHUNK_SIZE):
+                self.codes[start:start + ROW_CHUNK_SIZE] = self.embeddings[start:start + ROW_CHUNK_SIZE]
+        elif quantization == "int8":
+            # Map [min, max] of every dimension onto [-128, 127]
+            low = np.full(dim, np.inf, dtype=np.float32)
+            high = np.full(dim, -np.inf, dtype=np.float32)
+            for start in range(0, n, ROW_CHUNK_SIZE):
+                chunk = self.embeddings[start:start + ROW_CHUNK_SIZE]
+                low = np.minimum(low, chunk.min(axis=0))
+                high = np.maximum(high, chunk.max(axis=0))
+            self.offset = low
+            self.scale = np.where(high > low, (high - low) / 255, np.float32(1)).astype(np.float32)
+            self.codes = np.empty((n, dim), dtype=np.int8)
+            for start in range(0, n, ROW_CHUNK_SIZE):
+                chunk = self.embeddings[start:start + ROW_CHUNK_SIZE]
+                self.codes[start:start + ROW_CHUNK_SIZE] = np.clip(np.rint((chunk - self.offset) / self.scale) - 128, -128, 127)
+        else:
+            raise ValueError(f"Unknown quantization: {quantization}")
+
+    @property
+    def nbytes(self):
+        # Bytes scanned by the first pass
+        return self.codes.nbytes if self.codes is not None else self.embeddings.nbytes
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _top_k(self, similarities, k):
+        k = min(k, similarities.shape[0])
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+        return candidates[np.argsort(-similarities[candidates], kind="stable")]
+
+    def _compact_similarities(self, queries):
+        # Approximate similarities from the compact copy, decoded chunk by chunk
+        similarities = np.empty((len(self.codes), len(queries)), dtype=np.float32)
+        if self.quantization == "int8":
+            # x ~ offset + scale * (code + 128), so q.x ~ q.offset + (q * scale).(code + 128)
+            scaled_queries = (queries * self.scale).T
+            base = queries @ self.offset
+        for start in range(0, len(self.codes), ROW_CHUNK_SIZE):
+            chunk = self.codes[start:start + ROW_CHUNK_SIZE].astype(np.float32)
+            if self.quantization == "int8":
+                similarities[start:start + ROW_CHUNK_SIZE] = (chunk + 128) @ scaled_queries + base
+            else:
+                similarities[start:start + ROW_CHUNK_SIZE] = chunk @ queries.T
+        return similarities * self.inverse_norms[:, None]
+
+    def _similarities(self, queries):
+        if self.codes is not None:
+            return self._compact_similarities(queries)
+        return (self.embeddings @ queries.T) * self.inverse_norms[:, None]
+
+    def _search_positions(self, vectors, k):
+        # Yield "(row positions, cosine distances)" of the top-k rows for every query vector
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.float32(1e-12))
+        for start in range(0, len(vectors), QUERY_CHUNK_SIZE):
+            queries = vectors[start:start + QUERY_CHUNK_SIZE]
+            similarities = self._similarities(queries)
+            for column, query in enumerate(queries):
+                if self.codes is None:
+                    top = self._top_k(similarities[:, column], k)
+                    yield top, 1.0 - similarities[top, column]
+                    continue
+                # Re-rank the candidates of the compact copy with the full precision rows
+                candidates = np.sort(self._top_k(similarities[:, column], k * self.rerank_factor))
+                exact = (self.embeddings[candidates] @ query) * self.inverse_norms[candidates]
+                top = self._top_k(exact, k)
+                yield candidates[top], 1.0 - exact[top]
+
+    def search_ids(self, vector, k=DEFAULT_TOP_K):
+        # Return "(ids, cosine distances)" of the top-k rows
+        return self.search_batch_ids([vector], k=k)[0]
+
+    def search_batch_ids(self, vectors, k=DEFAULT_TOP_K):
+        return [(self.ids[top], distances) for top, distances in self._search_positions(vectors, k)]
+
+    def search(self, vector, k=DEFAULT_TOP_K):
+        return self.search_batch([vector], k=k)[0]
+
+    def search_batch(self, vectors, k=DEFAULT_TOP_K):
+        return [[self.metadata[i] for i in top.tolist()] for top, _ in self._search_positions(vectors, k)]
+
+    def search_text(self, text, k=DEFAULT_TOP_K):
+        vector = self.embedder.embed([text])[0]
+        return self.search(vector, k=k)
@@ -0,0 +1,124 @@
+import threading
+import time
+import numpy as np
+
+# Cosine distance under which a query embedding is served the results cached for another one
+DEFAULT_MAX_DISTANCE = 0.05
+DEFAULT_MAX_RESULTS = 4096
+# Seconds between two reads of the import generation, i.e. how long results may outlive an import
+DEFAULT_GENERATION_TTL = 10.0
+
+
+class ResultCache:
+    # Top-k results of recent searches, keyed on their query embedding: a search whose embedding is within
+    # "max_distance" cosine distance of a cached one, with the same mode and parameters ("key"), gets the
+    # cached rows without querying the database. The least recently used entry is evicted once the cache
+    # holds "max_entries" results.
+    # Entries belong to the import generation written by the importer (lambda/sync.py), all of them are
+    # dropped when the search client reads a new generation, so an import is never served stale results.
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, max_entries=DEFAULT_MAX_RESULTS, generation_ttl=DEFAULT_GENERATION_TTL):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.generation_ttl = generation_ttl
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0  # Search time of the cached results, minus the time taken by the hits
+        self._generation_checked_at = None
+        self._vectors = None  # Unit-normalized query embeddings, one row per slot
+        self._keys = np.full(max_entries, -1, dtype=np.int64)  # Id of the key of every slot, -1 when it is free
+        self._key_ids = {}
+        self._used = np.zeros(max_entries, dtype=np.int64)  # Logical time of the last use of every slot
+        self._clock = 0
+        self._rows = [None] * max_entries
+        self._seconds = np.zeros(max_entries)
+        self._lock = threading.Lock()
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _nearest(self, key_id, vector):
+        # Slot of the nearest cached query embedding with the key within "max_distance", or None
+        slots = np.nonzero(self._keys == key_id)[0] if key_id is not None else ()
+        if not len(slots):
+            return None
+        scores = self._vectors[slots] @ vector
+        best = int(np.argmax(scores))
+        return int(slots[best]) if 1.0 - float(scores[best]) <= self.max_distance else None
+
+    def generation_due(self):
+        # Whether the import generation should be read again
+        return self._generation_checked_at is None or time.monotonic() - self._generation_checked_at >= self.generation_ttl
+
+    def set_generation(self, generation):
+        with self._lock:
+            self._generation_checked_at = time.monotonic()
+            if generation != self.generation:
+                if self.generation is not None:
+                    self.invalidations += 1
+                self._clear()
+                self.generation = generation
+
+    def _clear(self):
+        self._keys[:] = -1
+        self._key_ids.clear()
+        self._rows = [None] * self.max_entries
+
+    def get(self, key, vector, elapsed=0.0):
+        # Cached rows of the nearest query embedding with the same key, or None. "elapsed" is the time
+        # already spent on the search (e.g. its embedding), deducted from the time saved by a hit.
+        vector = self._normalize(vector)
+        with self._lock:
+            slot = self._nearest(self._key_ids.get(key), vector)
+            if slot is None:
+                self.misses += 1
+                return None
+            self._clock += 1
+            self._used[slot] = self._clock
+            self.hits += 1
+            self.saved_seconds += max(0.0, float(self._seconds[slot]) - elapsed)
+            return list(self._rows[slot])
+
+    def put(self, key, vector, rows, seconds):
+        # Cache the rows of a search which took "seconds" (embedding included). Concurrent searches of near
+        # questions all miss, the first cached entry is replaced instead of caching each of them.
+        vector = self._normalize(vector)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._clear()
+            key_id = self._key_ids.setdefault(key, len(self._key_ids))
+            slot = self._nearest(key_id, vector)
+            if slot is None:
+                free = np.nonzero(self._keys < 0)[0]
+                if len(free):
+                    slot = free[0]
+                else:
+                    slot = int(np.argmin(self._used))
+                    self.evictions += 1
+            self._clock += 1
+            self._keys[slot] = key_id
+            self._vectors[slot] = vector
+            self._used[slot] = self._clock
+            self._rows[slot] = list(rows)
+            self._seconds[slot] = seconds
+
+    def __len__(self):
+        return int((self._keys >= 0).sum())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "saved_ms_per_hit": self.saved_seconds / self.hits * 1000 if self.hits else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
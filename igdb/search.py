@@ -0,0 +1,451 @@
+import json
+import math
+import threading
+import time
+import numpy as np
+from psycopg import errors, sql  # type: ignore
+from psycopg_pool import ConnectionPool  # type: ignore
+from pgvector.psycopg import register_vector  # type: ignore
+from .tracing import current_span, span
+
+# Same columns as the queries in the notebooks return
+RESULT_COLUMNS = ("igdb_id", "name", "summary", "description", "url", "artwork_hash", "screenshot_hash")
+
+DEFAULT_TOP_K = 5
+# Candidates taken from each of the full-text and vector searches before they are fused by "hybrid_search()"
+DEFAULT_HYBRID_CANDIDATES = 40
+# Constant of reciprocal rank fusion: score = sum(1 / (RRF_K + rank)) over the searches returning the row
+DEFAULT_RRF_K = 60
+# Same configuration as the "search_document" column of the IGDB table (TEXT_SEARCH_CONFIG in lambda/loader.py)
+TEXT_SEARCH_CONFIG = "english"
+# With "halfvec" storage, the first pass fetches this many candidates per result for re-ranking
+DEFAULT_RERANK_FACTOR = 4
+# Questions searched by a single LATERAL query of "search_many()", larger batches are split
+DEFAULT_BATCH_QUERIES = 256
+DEFAULT_SECRET_TTL = 300
+
+# Filtered searches: filters matching up to this many rows (estimated by the planner) are searched exactly,
+# larger ones with the partial vector index of their partition if there is one, otherwise with the vector
+# index and an overfetch of k / selectivity candidates (up to DEFAULT_MAX_OVERFETCH) which are filtered after
+DEFAULT_EXACT_MAX_ROWS = 2000
+DEFAULT_MAX_OVERFETCH = 1000
+FILTER_STRATEGIES = ("auto", "exact", "partial", "overfetch")
+# Filters on array columns, matching the rows which contain all the given values
+ARRAY_FILTERS = {"genre": "genres", "platform": "platforms"}
+
+
+def _filter_values(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
+def filter_clause(filters):
+    # "release_year": a year or an inclusive (first, last) range, "genre" / "platform": a value or a list of values.
+    # [NOTE] Array conditions are written one value at a time like the predicates of the partial indexes
+    # ("partition_predicate()" in lambda/indexing.py), so the planner can match them.
+    conditions = []
+    for key, value in filters.items():
+        if key == "release_year":
+            if isinstance(value, (tuple, list)):
+                first, last = value
+                conditions.append(sql.SQL("release_year BETWEEN {} AND {}").format(sql.Literal(first), sql.Literal(last)))
+            else:
+                conditions.append(sql.SQL("release_year = {}").format(sql.Literal(value)))
+        elif key in ARRAY_FILTERS:
+            for item in _filter_values(value):
+                conditions.append(sql.SQL("{} @> {}").format(sql.Identifier(ARRAY_FILTERS[key]), sql.Literal([item])))
+        else:
+            raise ValueError(f"Unknown filter: {key}")
+    return sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("true")
+
+
+class FilterPlan:
+    def __init__(self, strategy, rows, selectivity, candidates, partition=None):
+        self.strategy = strategy  # "exact", "partial" or "overfetch"
+        self.rows = rows  # Estimated rows matching the filters
+        self.selectivity = selectivity
+        self.candidates = candidates  # Rows fetched from the vector index with "overfetch"
+        self.partition = partition  # (column, value) of the partial index used with "partial"
+
+    def __repr__(self):
+        return (f"FilterPlan(strategy={self.strategy!r}, rows={self.rows}, selectivity={self.selectivity:.4f}, "
+                f"candidates={self.candidates}, partition={self.partition!r})")
+
+
+class SecretCache:
+    # Cache the database credentials fetched from Secrets Manager, and refresh them after "ttl" seconds
+    def __init__(self, secret_arn, ttl=DEFAULT_SECRET_TTL, client=None):
+        if client is None:
+            import boto3  # type: ignore
+            client = boto3.client("secretsmanager")
+        self.secret_arn = secret_arn
+        self.ttl = ttl
+        self.client = client
+        self._secret = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._secret is None or time.monotonic() >= self._expires_at:
+                response = self.client.get_secret_value(SecretId=self.secret_arn)
+                self._secret = json.loads(response["SecretString"])
+                self._expires_at = time.monotonic() + self.ttl
+            return self._secret
+
+    def connect_kwargs(self):
+        secret = self.get()
+        return dict(host=secret["host"], port=secret["port"], user=secret["username"], password=secret["password"], connect_timeout=10)
+
+
+class SearchQueries:
+    # SQL of the searches over the IGDB table, shared by "SearchClient" and "AsyncSearchClient"
+    def __init__(self, table="igdb", storage="full", rerank_factor=DEFAULT_RERANK_FACTOR, dim=384, neighbors_table=None,
+                 result_cache=None):
+        self.table = table
+        self.storage = storage
+        self.rerank_factor = rerank_factor
+        self.result_cache = result_cache  # Optional "ResultCache" of "search_text()" and "hybrid_search()"
+        columns = ', '.join(RESULT_COLUMNS)
+        config = TEXT_SEARCH_CONFIG
+        if storage == "halfvec":
+            distance = f"description_embeddings::halfvec({dim}) <=> %(vector)b::halfvec({dim})"
+            self.query = f"""WITH candidates AS (
+                               SELECT {', '.join(RESULT_COLUMNS)}, description_embeddings
+                                 FROM {table}
+                                ORDER BY description_embeddings::halfvec({dim}) <=> %b::halfvec({dim})
+                                LIMIT %s)
+                             SELECT {', '.join(RESULT_COLUMNS)}
+                               FROM candidates
+                              ORDER BY description_embeddings <=> %b
+                              LIMIT %s;"""
+            nearest = f"""SELECT {columns}
+                           FROM (SELECT {columns}, description_embeddings
+                                   FROM {table}
+                                  ORDER BY description_embeddings::halfvec({dim}) <=> q.vector::halfvec({dim})
+                                  LIMIT %(candidates)s) candidates
+                          ORDER BY description_embeddings <=> q.vector
+                          LIMIT %(k)s"""
+        elif storage == "full":
+            distance = "description_embeddings <=> %(vector)b"
+            self.query = f"""SELECT {', '.join(RESULT_COLUMNS)}
+                               FROM {table}
+                              ORDER BY description_embeddings <=> %b
+                              LIMIT %s;"""
+            nearest = f"""SELECT {columns}
+                           FROM {table}
+                          ORDER BY description_embeddings <=> q.vector
+                          LIMIT %(k)s"""
+        else:
+            raise ValueError(f"Unknown storage: {storage}")
+        self.distance = distance
+        # Top-k of every question in one statement: the vector index is scanned once per unnested question.
+        # [NOTE] There is no "ORDER BY q.ord", a sort would hold back every row until the last question is
+        # searched. The nested loop returns the rows question by question in ordinality order, each one
+        # nearest first, so they can be streamed.
+        self.batch_query = f"""SELECT q.ord, nearest.*
+                                  FROM unnest(%(vectors)b::vector[]) WITH ORDINALITY q(vector, ord)
+                                 CROSS JOIN LATERAL ({nearest}) nearest;"""
+
+        # Related games precomputed by the importer (lambda/neighbors.py), read in rank order from its primary key
+        neighbors_table = neighbors_table or f"{table}_neighbors"
+        self.related_query = f"""SELECT {', '.join(f'game.{column}' for column in RESULT_COLUMNS)}
+                                   FROM {neighbors_table} neighbor
+                                   JOIN {table} game ON game.igdb_id = neighbor.neighbor_id
+                                  WHERE neighbor.igdb_id = %s
+                                  ORDER BY neighbor.rank
+                                  LIMIT %s;"""
+
+        # Full-text matches of all query terms, the ones with every term in their name first. A title match is
+        # strong when the query names the game rather than describes it: the query is the whole title, a prefix of
+        # it (with 2 terms or more), or most of its terms ("numnode()" of n terms joined by "&" is 2n - 1).
+        # [NOTE] A single descriptive word such as "racing" is in the name of many games, it's not a strong match
+        normalized = "trim(regexp_replace(lower({}), '[^[:alnum:]]+', ' ', 'g'))"
+        self.lexical_query = f"""SELECT {columns},
+                                        title_match AND (title = phrase
+                                                         OR numnode(query) > 1 AND starts_with(title, phrase || ' ')
+                                                         OR numnode(query) + 1 > length(name_vector)) AS strong_match
+                                   FROM (SELECT {columns}, query, name_vector, name_vector @@ query AS title_match,
+                                                ts_rank_cd(search_document, query) AS rank,
+                                                {normalized.format("coalesce(name, '')")} AS title
+                                           FROM {table}, plainto_tsquery('{config}', %(text)s) query,
+                                                to_tsvector('{config}', coalesce(name, '')) name_vector
+                                          WHERE search_document @@ query) matches,
+                                        {normalized.format("%(text)s")} phrase
+                                  ORDER BY title_match DESC, rank DESC
+                                  LIMIT %(k)s;"""
+        # Full-text candidates (matching any query term) and nearest neighbors, merged by reciprocal rank fusion
+        self.hybrid_query = f"""WITH lexical AS (
+                                   SELECT igdb_id, row_number() OVER (ORDER BY ts_rank_cd(search_document, query) DESC) AS rank
+                                     FROM {table}, CAST(replace(plainto_tsquery('{config}', %(text)s)::text, ' & ', ' | ') AS tsquery) query
+                                    WHERE search_document @@ query
+                                    ORDER BY rank
+                                    LIMIT %(candidates)s),
+                                 semantic AS (
+                                   SELECT igdb_id, row_number() OVER (ORDER BY distance) AS rank
+                                     FROM (SELECT igdb_id, {distance} AS distance
+                                             FROM {table}
+                                            ORDER BY distance
+                                            LIMIT %(candidates)s) nearest),
+                                 fused AS (
+                                   SELECT igdb_id, sum(1.0 / (%(rrf_k)s + rank)) AS score
+                                     FROM (SELECT * FROM lexical UNION ALL SELECT * FROM semantic) ranked
+                                    GROUP BY igdb_id)
+                               SELECT {columns}
+                                 FROM fused JOIN {table} USING (igdb_id)
+                                ORDER BY score DESC, igdb_id
+                                LIMIT %(k)s;"""
+        # Latest import generation written by the importer ("record_generation()" in lambda/sync.py)
+        self.generation_query = f"SELECT generation FROM {table}_generation ORDER BY generation DESC LIMIT 1;"
+
+    def _params(self, vector, k):
+        if self.storage == "halfvec":
+            return (vector, k * self.rerank_factor, vector, k)
+        return (vector, k)
+
+    def _cache_key(self, mode, k, **params):
+        return (mode, k, json.dumps(params, sort_keys=True, default=list))
+
+
+class SearchClient(SearchQueries):
+    # Top-k search over the IGDB table with a connection pool. Every pooled connection has pgvector's
+    # types registered, the query is prepared server-side and the query vector is sent in binary format.
+    # [NOTE] Orders by cosine distance ("<=>") to match the "vector_cosine_ops" index built by the importer.
+    # The embeddings are normalized, so the ranking is the same as L2 distance ("<->") used in the notebooks.
+    # With "halfvec" storage (index built with INDEX_STORAGE=halfvec), candidates are searched with the half
+    # precision index first, then re-ranked with the full precision embeddings of the table.
+    def __init__(self, secret_arn=None, conninfo="", embedder=None, min_size=1, max_size=4,
+                 secret_ttl=DEFAULT_SECRET_TTL, probes=None, ef_search=None, table="igdb",
+                 storage="full", rerank_factor=DEFAULT_RERANK_FACTOR, dim=384,
+                 exact_max_rows=DEFAULT_EXACT_MAX_ROWS, max_overfetch=DEFAULT_MAX_OVERFETCH, neighbors_table=None,
+                 result_cache=None):
+        SearchQueries.__init__(self, table, storage, rerank_factor, dim, neighbors_table, result_cache)
+        self.secrets = SecretCache(secret_arn, ttl=secret_ttl) if secret_arn else None
+        self.embedder = embedder  # Optional "EmbeddingClient" used by "search_text()"
+        self.probes = probes
+        self.ef_search = ef_search
+        self.exact_max_rows = exact_max_rows
+        self.max_overfetch = max_overfetch
+        self.metadata_ttl = secret_ttl
+        self._partitions = None
+        self._partitions_expire_at = 0.0
+        self._estimates = {}
+        self.pool = ConnectionPool(
+            conninfo,
+            # Credentials are resolved for every new connection, so a rotated secret is picked up after the TTL
+            kwargs=self.secrets.connect_kwargs if self.secrets else None,
+            min_size=min_size,
+            max_size=max_size,
+            configure=register_vector,
+            open=True,
+        )
+
+    def _set_search_params(self, conn, probes, ef_search):
+        # Settings are local to the transaction, so they are reset before the connection returns to the pool
+        if probes is not None:
+            conn.execute("SELECT set_config('ivfflat.probes', %s, true);", (str(int(probes)),))
+        if ef_search is not None:
+            conn.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(int(ef_search)),))
+
+    def _ef_search(self, ef_search, candidates):
+        ef_search = self.ef_search if ef_search is None else ef_search
+        if ef_search is None and candidates > 40:
+            ef_search = candidates  # HNSW returns at most "hnsw.ef_search" (default 40) candidates
+        return ef_search
+
+    def _fetch(self, query, params, candidates, probes=None, ef_search=None, prepare=True, index_scan=True):
+        ef_search = self._ef_search(ef_search, candidates)
+        with span("query"), self.pool.connection() as conn:
+            self._set_search_params(conn, self.probes if probes is None else probes, ef_search)
+            if not index_scan:
+                # Vector indexes only support index scans, the filter columns are still searched with bitmap scans
+                conn.execute("SELECT set_config('enable_indexscan', 'off', true);")
+            with conn.cursor() as cur:
+                cur.execute(query, params, prepare=prepare)
+                return cur.fetchall()
+
+    def search(self, vector, k=DEFAULT_TOP_K, probes=None, ef_search=None, filters=None, strategy="auto"):
+        vector = np.asarray(vector, dtype=np.float32)
+        if filters:
+            return self.search_filtered(vector, filters, k=k, strategy=strategy, probes=probes, ef_search=ef_search)
+        candidates = k * self.rerank_factor if self.storage == "halfvec" else k
+        return self._fetch(self.query, self._params(vector, k), candidates, probes, ef_search)
+
+    def search_many(self, vectors, k=DEFAULT_TOP_K, probes=None, ef_search=None, batch_size=DEFAULT_BATCH_QUERIES):
+        # Yield "(index, rows)" for every query vector, in order, as soon as its top-k rows are streamed back.
+        # Every "batch_size" vectors are searched by a single query, instead of one round trip per vector.
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        candidates = k * self.rerank_factor if self.storage == "halfvec" else k
+        ef_search = self._ef_search(ef_search, candidates)
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start:start + batch_size]
+            with self.pool.connection() as conn:
+                self._set_search_params(conn, self.probes if probes is None else probes, ef_search)
+                with conn.cursor() as cur:
+                    index, rows = 0, []
+                    for number, *row in cur.stream(self.batch_query, dict(vectors=batch, k=k, candidates=candidates)):
+                        # Questions without any row (empty table) are yielded with no rows as well
+                        while index < number - 1:
+                            yield start + index, rows
+                            index, rows = index + 1, []
+                        rows.append(tuple(row))
+                    while index < len(batch):
+                        yield start + index, rows
+                        index, rows = index + 1, []
+
+    def search_text_many(self, texts, k=DEFAULT_TOP_K, **kwargs):
+        # Embed all the texts with batched requests to the model endpoint, then search them with "search_many()"
+        vectors = self.embedder.embed(list(texts))
+        return self.search_many(vectors, k=k, **kwargs)
+
+    def partitions(self):
+        # Partitions with a partial vector index as {(column, value): rows}, read from the comments the
+        # importer puts on the indexes, and cached for "metadata_ttl" seconds
+        if self._partitions is None or time.monotonic() >= self._partitions_expire_at:
+            with self.pool.connection() as conn:
+                comments = conn.execute("""SELECT obj_description(indexrelid, 'pg_class') FROM pg_index
+                                            WHERE indrelid = %s::regclass AND indpred IS NOT NULL;""", (self.table,)).fetchall()
+            partitions = {}
+            for comment, in comments:
+                if comment:
+                    partition = json.loads(comment)
+                    partitions[(partition["column"], partition["value"])] = partition["rows"]
+            self._partitions = partitions
+            self._partitions_expire_at = time.monotonic() + self.metadata_ttl
+            self._estimates.clear()
+        return self._partitions
+
+    def estimate_rows(self, filters):
+        # Rows matching the filters and rows of the table, as estimated by the planner from the table statistics
+        key = json.dumps(filters, sort_keys=True, default=list)
+        if key not in self._estimates:
+            query = sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 FROM {} WHERE {}").format(sql.Identifier(self.table), filter_clause(filters))
+            with self.pool.connection() as conn:
+                plan, = conn.execute(query).fetchone()
+                total, = conn.execute("SELECT greatest(reltuples, 1) FROM pg_class WHERE oid = %s::regclass;", (self.table,)).fetchone()
+            if len(self._estimates) >= 1024:
+                self._estimates.clear()
+            self._estimates[key] = (plan[0]["Plan"]["Plan Rows"], int(total))
+        return self._estimates[key]
+
+    def plan_filter(self, filters, k=DEFAULT_TOP_K, strategy="auto"):
+        if strategy not in FILTER_STRATEGIES:
+            raise ValueError(f"Unknown strategy: {strategy}")
+        partitions = self.partitions()
+        rows, total = self.estimate_rows(filters)
+        selectivity = min(1.0, rows / total)
+        partition = next(((column, value) for key, column in ARRAY_FILTERS.items()
+                          for value in _filter_values(filters.get(key)) if (column, value) in partitions), None)
+        if strategy == "auto":
+            if rows <= self.exact_max_rows:
+                strategy = "exact"
+            elif partition is not None:
+                strategy = "partial"
+            else:
+                strategy = "overfetch"
+        if strategy == "partial" and partition is None:
+            raise ValueError(f"No partial index for the filters: {filters}")
+        candidates = min(self.max_overfetch, max(k, math.ceil(2 * k / max(selectivity, 1e-9))))
+        return FilterPlan(strategy, rows, selectivity, candidates, partition)
+
+    def search_filtered(self, vector, filters, k=DEFAULT_TOP_K, strategy="auto", probes=None, ef_search=None):
+        # Top-k search among the rows matching the filters, with the strategy chosen by "plan_filter()".
+        # Approximate strategies returning less than k rows are completed by an exact search.
+        vector = np.asarray(vector, dtype=np.float32)
+        plan = self.plan_filter(filters, k, strategy)
+        columns = sql.SQL(", ").join(map(sql.Identifier, RESULT_COLUMNS))
+        table, clause = sql.Identifier(self.table), filter_clause(filters)
+        rows = None
+        if plan.strategy == "partial":
+            query = sql.SQL("SELECT {} FROM {} WHERE {} ORDER BY {} LIMIT %(k)s;").format(
+                columns, table, clause, sql.SQL(self.distance))
+            rows = self._fetch(query, dict(vector=vector, k=k), k, probes, ef_search, prepare=None)
+        elif plan.strategy == "overfetch":
+            query = sql.SQL("""WITH candidates AS (
+                                   SELECT {}, {} AS matched, {} AS distance
+                                     FROM {}
+                                    ORDER BY distance
+                                    LIMIT %(candidates)s)
+                                 SELECT {} FROM candidates WHERE matched ORDER BY distance LIMIT %(k)s;""").format(
+                columns, clause, sql.SQL(self.distance), table, columns)
+            rows = self._fetch(query, dict(vector=vector, candidates=plan.candidates, k=k), plan.candidates, probes, ef_search, prepare=None)
+        if rows is None or len(rows) < k:
+            query = sql.SQL("SELECT {} FROM {} WHERE {} ORDER BY description_embeddings <=> %(vector)b LIMIT %(k)s;").format(
+                columns, table, clause)
+            rows = self._fetch(query, dict(vector=vector, k=k), k, prepare=None, index_scan=False)
+        return rows
+
+    def generation(self):
+        # Latest import generation, 0 when the importer didn't record any
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute(self.generation_query).fetchone()
+        except errors.UndefinedTable:
+            row = None
+        return row[0] if row else 0
+
+    def _cached(self, key, vector, start, search):
+        # Rows of the search from the result cache if a near query is cached, otherwise searched and cached
+        if self.result_cache is None:
+            return search()
+        if self.result_cache.generation_due():
+            self.result_cache.set_generation(self.generation())
+        rows = self.result_cache.get(key, vector, time.perf_counter() - start)
+        current_span().add(cache_hits=rows is not None)
+        if rows is None:
+            rows = search()
+            self.result_cache.put(key, vector, rows, time.perf_counter() - start)
+        return rows
+
+    @span("search_text")
+    def search_text(self, text, k=DEFAULT_TOP_K, **kwargs):
+        start = time.perf_counter()
+        with span("embed"):
+            vector = self.embedder.embed([text])[0]
+        return self._cached(self._cache_key("vector", k, **kwargs), vector, start, lambda: self.search(vector, k=k, **kwargs))
+
+    def related(self, igdb_id, k=DEFAULT_TOP_K):
+        # "More like this": the k games nearest to a game, without reading its embedding or an ANN search
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.related_query, (igdb_id, k), prepare=True)
+                return cur.fetchall()
+
+    def lexical_search(self, text, k=DEFAULT_TOP_K):
+        # Full-text search only, returns the rows and whether the top one is a strong title match
+        with span("lexical"), self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.lexical_query, dict(text=text, k=k), prepare=True)
+                rows = cur.fetchall()
+        return [row[:-1] for row in rows], bool(rows) and rows[0][-1]
+
+    @span("hybrid_search")
+    def hybrid_search(self, text, k=DEFAULT_TOP_K, vector=None, candidates=DEFAULT_HYBRID_CANDIDATES,
+                      rrf_k=DEFAULT_RRF_K, lexical_fast_path=True, probes=None, ef_search=None):
+        # Search with both the full-text index and the vector index in a single query, and fuse their rankings.
+        # With "lexical_fast_path", queries naming a title (a strong title match, e.g. "Zelda Tears of the Kingdom"
+        # or "Mario Kart") return the full-text results right away, without the embedding call.
+        # [NOTE] With a result cache, rephrased questions near a cached one get its fused results, full-text
+        # ranking included.
+        start = time.perf_counter()
+        if lexical_fast_path and vector is None:
+            rows, strong_match = self.lexical_search(text, k)
+            if strong_match:
+                return rows
+        if vector is None:
+            with span("embed"):
+                vector = self.embedder.embed([text])[0]
+        candidates = max(candidates, k)
+        params = dict(text=text, vector=np.asarray(vector, dtype=np.float32), candidates=candidates, rrf_k=rrf_k, k=k)
+        key = self._cache_key("hybrid", k, candidates=candidates, rrf_k=rrf_k, probes=probes, ef_search=ef_search)
+        return self._cached(key, vector, start, lambda: self._fetch(self.hybrid_query, params, candidates, probes, ef_search))
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,264 @@
+# Lightweight phase timing of the import (lambda/), the inference (model/code/) and the search (igdb/).
+# It only depends on the standard library. "lambda/tracing.py" is the canonical file, "igdb/tracing.py" and
+# "model/code/tracing.py" are copies of it: edit it and copy it over, "tests/test_tracing.py" checks they match.
+#
+#   with span('copy') as current:        # Context manager, spans opened inside it are its children
+#       current.add(rows=len(batch))     # Counters, summed
+#       current.set(mode='incremental')  # Properties, kept as is
+#   @span('import')                      # Decorator, for functions and coroutine functions
+#   for row in iterate('read', rows):    # Time spent producing the items of a lazy iterator only
+#
+# A span opened outside any other one starts a trace. When it ends, every phase of the trace is written as one
+# record with its duration, number of calls, counters and the memory high-water mark of the process when it
+# ended. Phases with the same path (e.g. "inference/forward" of every micro-batch) are merged into one record.
+# Sinks (TRACE_SINK):
+#   - "emf":  CloudWatch Embedded Metric Format on stdout, turned into metrics by Lambda (default in Lambda)
+#   - "json": JSON lines appended to TRACE_FILE, for offline runs
+#   - "off":  Nothing is recorded (default elsewhere)
+# Only a TRACE_SAMPLE_RATE fraction of the traces are recorded, spans of the other ones are a context lookup.
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Load Environment Variables
+TRACE_SINK = os.environ.get('TRACE_SINK', 'emf' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'off')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))  # Fraction of the traces recorded
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')  # Output of the "json" sink
+TRACE_NAMESPACE = os.environ.get('TRACE_NAMESPACE', 'IGDB')  # CloudWatch namespace of the "emf" sink
+
+SINKS = ('emf', 'json', 'off')
+
+_current = contextvars.ContextVar('tracing_span', default=None)
+
+
+def max_rss_kib():
+    # Peak resident set size of the process so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # Bytes on macOS, KiB on Linux
+
+
+class Span:
+    def __init__(self, name, parent=None, **properties):
+        self.name = name
+        self.parent = parent
+        self.path = f"{parent.path}/{name}" if parent is not None else name
+        self.properties = properties
+        self.counts = {}
+        self.seconds = 0.0
+        self.max_rss_kib = None
+        self.children = []  # Ended child spans
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def set(self, **properties):
+        self.properties.update(properties)
+
+    def __repr__(self):
+        return f"Span(path={self.path!r}, seconds={self.seconds:.3f}, counts={self.counts}, max_rss_kib={self.max_rss_kib})"
+
+
+class _NoopSpan:
+    # Span of a trace which isn't sampled, or outside of any trace
+    path = None
+
+    def add(self, **counts):
+        pass
+
+    def set(self, **properties):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Scope:
+    # Context manager and decorator returned by "Tracer.span()"
+    def __init__(self, tracer, name, properties):
+        self.tracer = tracer
+        self.name = name
+        self.properties = properties
+        self._span = None
+        self._token = None
+        self._start = 0.0
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is NOOP_SPAN or (parent is None and not self.tracer.sampled()):
+            self._span = NOOP_SPAN
+        else:
+            self._span = Span(self.name, parent, **self.properties)
+        self._token = _current.set(self._span)
+        self._start = time.perf_counter()
+        return self._span
+
+    def __exit__(self, exc_type, exc, traceback):
+        span = self._span
+        _current.reset(self._token)
+        if span is NOOP_SPAN:
+            return False
+        span.seconds += time.perf_counter() - self._start
+        span.max_rss_kib = max_rss_kib()
+        if exc_type is not None:
+            span.set(error=exc_type.__name__)
+        if span.parent is None:
+            self.tracer.emit(span)
+        else:
+            span.parent.children.append(span)
+        return False
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with _Scope(self.tracer, self.name, dict(self.properties)):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Scope(self.tracer, self.name, dict(self.properties)):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class Tracer:
+    def __init__(self, sink=TRACE_SINK, sample_rate=TRACE_SAMPLE_RATE, path=TRACE_FILE, namespace=TRACE_NAMESPACE, stream=None):
+        if sink not in SINKS:
+            raise ValueError(f"Unknown sink: {sink}")
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.path = path
+        self.namespace = namespace
+        self.stream = stream  # Output of the "emf" sink, stdout by default
+        self.traces = 0  # Traces emitted
+        self._lock = threading.Lock()
+
+    def sampled(self):
+        return self.sink != 'off' and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def span(self, name, **properties):
+        return _Scope(self, name, properties)
+
+    def iterate(self, name, iterable, unit='items'):
+        # Yield the items of the iterable, timing only the time spent in the iterator (e.g. the S3 reads and the
+        # parsing of a lazy row stream) as a child span of the span consuming it, with the number of items
+        parent = _current.get()
+        if parent is None or parent is NOOP_SPAN:
+            yield from iterable
+            return
+        span = Span(name, parent)
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    span.seconds += time.perf_counter() - start
+                span.counts[unit] = span.counts.get(unit, 0) + 1
+                yield item
+        finally:
+            span.max_rss_kib = max_rss_kib()
+            parent.children.append(span)
+
+    def records(self, root):
+        # One record per phase path of the trace, depth-first
+        records = {}
+
+        def visit(span):
+            record = records.get(span.path)
+            if record is None:
+                record = records[span.path] = dict(phase=span.path, seconds=0.0, calls=0, max_rss_kib=None, counts={}, properties={})
+            record['seconds'] += span.seconds
+            record['calls'] += 1
+            if span.max_rss_kib is not None:
+                record['max_rss_kib'] = max(record['max_rss_kib'] or 0, span.max_rss_kib)
+            for key, value in span.counts.items():
+                record['counts'][key] = record['counts'].get(key, 0) + value
+            record['properties'].update(span.properties)
+            for child in span.children:
+                visit(child)
+
+        visit(root)
+        return list(records.values())
+
+    def emit(self, root):
+        trace_id = uuid.uuid4().hex
+        timestamp = int(time.time() * 1000)
+        if self.sink == 'emf':
+            lines = [self._emf(root.name, trace_id, timestamp, record) for record in self.records(root)]
+        else:
+            lines = [json.dumps(dict(trace=root.name, trace_id=trace_id, timestamp=timestamp, phase=record['phase'],
+                                     seconds=record['seconds'], calls=record['calls'], max_rss_kib=record['max_rss_kib'],
+                                     **record['counts'], **record['properties']), default=str)
+                     for record in self.records(root)]
+        with self._lock:
+            self.traces += 1
+            if self.sink == 'emf':
+                stream = self.stream or sys.stdout
+                stream.write(''.join(line + '\n' for line in lines))
+                stream.flush()
+            else:
+                with open(self.path, 'a') as file:
+                    file.write(''.join(line + '\n' for line in lines))
+
+    def _emf(self, trace, trace_id, timestamp, record):
+        # Metrics per (Trace, Phase), the counters are metrics too and the properties are searchable log fields
+        metrics = [{'Name': 'Duration', 'Unit': 'Milliseconds'}, {'Name': 'Calls', 'Unit': 'Count'}]
+        values = {'Duration': record['seconds'] * 1000, 'Calls': record['calls']}
+        if record['max_rss_kib'] is not None:
+            metrics.append({'Name': 'MaxRSS', 'Unit': 'Kilobytes'})
+            values['MaxRSS'] = record['max_rss_kib']
+        for key, value in record['counts'].items():
+            metrics.append({'Name': key, 'Unit': 'Count'})
+            values[key] = value
+        return json.dumps({
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [['Trace', 'Phase']], 'Metrics': metrics}],
+            },
+            **record['properties'],
+            'Trace': trace,
+            'Phase': record['phase'],
+            'TraceId': trace_id,
+            **values,
+        }, default=str)
+
+
+# Tracer configured by the environment variables, shared by the modules of a process
+tracer = Tracer()
+span = tracer.span
+iterate = tracer.iterate
+
+
+def configure(**options):
+    # Change the sink, sample rate, path or namespace of the shared tracer, e.g. from a command line
+    for key, value in options.items():
+        if not hasattr(tracer, key):
+            raise TypeError(f"Unknown option: {key}")
+        if key == 'sink' and value not in SINKS:
+            raise ValueError(f"Unknown sink: {value}")
+        setattr(tracer, key, value)
+
+
+def current_span():
+    # Innermost open span, a no-op one outside of a recorded trace
+    return _current.get() or NOOP_SPAN
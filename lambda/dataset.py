@@ -0,0 +1,127 @@
+import json
+import os
+import numpy as np
+from loader import DATASET_COLUMNS
+
+# Binary dataset layout, next to each other with the same base name:
+#   <name>.manifest.json  Row count, dimensions, data type and file names
+#   <name>.parquet        Metadata columns (everything but the embeddings)
+#   <name>.f32 / .f16     Embeddings as a contiguous little-endian row-major block
+FORMAT_NAME = 'igdb-embeddings'
+FORMAT_VERSION = 1
+MANIFEST_SUFFIX = '.manifest.json'
+METADATA_COLUMNS = DATASET_COLUMNS[:-1]
+DTYPES = {'float32': ('<f4', '.f32'), 'float16': ('<f2', '.f16')}
+
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+
+class DatasetWriter:
+    # Write dataset rows into the binary layout one by one, holding only one row group of metadata in memory
+    def __init__(self, base_path, dim=384, dtype='float32', row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self.base_path = base_path
+        self.dim = dim
+        self.dtype = dtype
+        self.row_group_size = row_group_size
+        self.rows = 0
+        numpy_dtype, suffix = DTYPES[dtype]
+        self._numpy_dtype = numpy_dtype
+        self.metadata_path = base_path + '.parquet'
+        self.embeddings_path = base_path + suffix
+        self.manifest_path = base_path + MANIFEST_SUFFIX
+        # The files of a previous dataset with the same name are overwritten, its manifest would describe them
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        self._schema = pa.schema([('igdb_id', pa.int64())] + [(column, pa.string()) for column in METADATA_COLUMNS[1:]])
+        self._pa = pa
+        self._metadata_writer = pq.ParquetWriter(self.metadata_path, self._schema)
+        self._embeddings_file = open(self.embeddings_path, 'wb')
+        self._pending = []
+
+    def write(self, row):
+        *fields, embeddings = row
+        embeddings = np.asarray(embeddings, dtype=self._numpy_dtype)
+        if embeddings.shape != (self.dim,):
+            raise ValueError(f"Expected {self.dim} dimensions, got {embeddings.shape}")
+        self._embeddings_file.write(embeddings.tobytes())
+        self._pending.append(fields)
+        self.rows += 1
+        if len(self._pending) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            columns = list(zip(*self._pending))
+            self._metadata_writer.write_table(self._pa.table(
+                {column: list(values) for column, values in zip(METADATA_COLUMNS, columns)}, schema=self._schema))
+            self._pending = []
+
+    def close(self):
+        self._flush()
+        self._metadata_writer.close()
+        self._embeddings_file.close()
+        manifest = {
+            'format': FORMAT_NAME,
+            'version': FORMAT_VERSION,
+            'rows': self.rows,
+            'dim': self.dim,
+            'dtype': self.dtype,
+            'metadata': os.path.basename(self.metadata_path),
+            'embeddings': os.path.basename(self.embeddings_path),
+        }
+        with open(self.manifest_path, 'w') as file:
+            json.dump(manifest, file, indent=2)
+        return manifest
+
+    def abort(self):
+        # Close and remove the partial files without writing the manifest. A truncated dataset must not be
+        # imported: incremental imports delete the games missing from it.
+        self._metadata_writer.close()
+        self._embeddings_file.close()
+        for path in (self.metadata_path, self.embeddings_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    if manifest.get('format') != FORMAT_NAME or manifest.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported dataset format: {manifest.get('format')} v{manifest.get('version')}")
+    return manifest
+
+
+def open_embeddings(manifest_path):
+    # Memory-map the embeddings block, rows are paged in by the OS only when they're read
+    manifest = read_manifest(manifest_path)
+    path = os.path.join(os.path.dirname(manifest_path), manifest['embeddings'])
+    return np.memmap(path, dtype=DTYPES[manifest['dtype']][0], mode='r', shape=(manifest['rows'], manifest['dim']))
+
+
+def iter_rows(manifest_path, batch_size=DEFAULT_ROW_GROUP_SIZE):
+    # Yield dataset rows in the same shape as the JSON dataset, the embeddings being memory-mapped row views
+    import pyarrow.parquet as pq  # type: ignore
+    manifest = read_manifest(manifest_path)
+    embeddings = open_embeddings(manifest_path)
+    metadata = pq.ParquetFile(os.path.join(os.path.dirname(manifest_path), manifest['metadata']))
+    offset = 0
+    for batch in metadata.iter_batches(batch_size=batch_size, columns=list(METADATA_COLUMNS)):
+        columns = [batch.column(column).to_pylist() for column in METADATA_COLUMNS]
+        for i, fields in enumerate(zip(*columns)):
+            yield [*fields, embeddings[offset + i]]
+        offset += batch.num_rows
+    if offset != manifest['rows']:
+        raise ValueError(f"Metadata has {offset} rows, but the manifest has {manifest['rows']} rows")
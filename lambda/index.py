@@ -1,32 +1,66 @@
 # Blank Lambda function ref: https://github.com/awsdocs/aws-lambda-developer-guide/blob/main/sample-apps/blank-python/function/lambda_function.py
 import logging
 import os
+import time
 import boto3  # type: ignore
-import jsonpickle  # type: ignore
 import json
 import psycopg  # type: ignore
 from pgvector.psycopg import register_vector  # type: ignore
+from loader import DEFAULT_BATCH_SIZE
+from indexing import PARTITION_MIN_ROWS
+from neighbors import DEFAULT_BLOCK_SIZE, DEFAULT_NEIGHBORS
+from ingest import DATASET_KEY, MANIFEST_KEY, binary_keys, binary_rows, dataset_version, download_rows, has_object, stream_rows
+from shards import DEFAULT_SHARD_SIZE, DEFAULT_WORKERS, sharded_import, worker_pool
+from sync import incremental_import, post_import, replace_import, swap_import
+from tracing import iterate, span
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 secretsmanager = boto3.client('secretsmanager')
 s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
 
 # Load Environment Variables
 DB_SECRET_ARN = os.environ['DB_SECRET_ARN']
 BUCKET_NAME = os.environ['BUCKET_NAME']
+IMPORT_MODE = os.environ.get('IMPORT_MODE', 'incremental')  # "incremental" (Upsert changed rows), "swap" (Full rebuild in a shadow table), "sharded" (Resumable "swap" across invocations) or "replace" (Drop and reload)
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+IMPORT_SHARD_SIZE = int(os.environ.get('IMPORT_SHARD_SIZE', DEFAULT_SHARD_SIZE))  # Rows loaded and checkpointed at once by "sharded" imports
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', DEFAULT_WORKERS))  # Worker threads (and connections) per invocation
+IMPORT_FANOUT = int(os.environ.get('IMPORT_FANOUT', 1))  # Concurrent invocations sharing the shards of a "sharded" import
+IMPORT_TIME_MARGIN = int(os.environ.get('IMPORT_TIME_MARGIN', 15))  # Seconds before the timeout to stop claiming shards
+IMPORT_MAX_INVOCATIONS = int(os.environ.get('IMPORT_MAX_INVOCATIONS', 20))  # Upper bound of the re-invocation chain
+DATASET_FORMAT = os.environ.get('DATASET_FORMAT', 'auto')  # "auto" (Binary if its manifest exists), "binary" or "json"
+INGEST_MODE = os.environ.get('INGEST_MODE', 'stream')  # "stream" (Parse S3 object body incrementally) or "download" (Download to /tmp then parse at once)
+INDEX_METHOD = os.environ.get('INDEX_METHOD', 'auto')  # "auto" (Choose by row count), "ivfflat" or "hnsw"
+INDEX_PARAMS = json.loads(os.environ.get('INDEX_PARAMS', '{}'))  # Override the sized index parameters, e.g. '{"lists": 50}' or '{"m": 16, "ef_construction": 64}'
+INDEX_CONCURRENTLY = os.environ.get('INDEX_CONCURRENTLY', 'false').lower() == 'true'
+INDEX_MAINTENANCE_WORK_MEM = os.environ.get('INDEX_MAINTENANCE_WORK_MEM', '128MB')
+INDEX_PARALLEL_WORKERS = int(os.environ.get('INDEX_PARALLEL_WORKERS', 1))
+INDEX_STORAGE = os.environ.get('INDEX_STORAGE', 'full')  # "full" (Index float32 embeddings) or "halfvec" (Index a half precision copy)
+INDEX_PARTITION_MIN_ROWS = int(os.environ.get('INDEX_PARTITION_MIN_ROWS', PARTITION_MIN_ROWS))  # Genres/platforms with a partial vector index
+NEIGHBORS_K = int(os.environ.get('NEIGHBORS_K', DEFAULT_NEIGHBORS))  # Related games precomputed per game, "0" to skip
+NEIGHBORS_BLOCK_SIZE = int(os.environ.get('NEIGHBORS_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))  # Games scored at once, bounds the memory
 
+def invoke_self(context, import_id, invocation):
+    logger.info(f"## Invoking {context.function_name} to continue import {import_id}")
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'import_id': import_id, 'invocation': invocation}),
+        )
+
+@span('import', mode=IMPORT_MODE)
 def handler(event, context):
-    logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
-    logger.info('## EVENT\r' + jsonpickle.encode(event))
-    logger.info('## CONTEXT\r' + jsonpickle.encode(context))
+    logger.info(f"## Import mode: {IMPORT_MODE}, event: {json.dumps(event)}")
 
     # Get Database Credentials
     logger.info('## Getting Database Credentials')
-    db_secret = secretsmanager.get_secret_value(
-        SecretId=DB_SECRET_ARN,
-    )
+    with span('credentials'):
+        db_secret = secretsmanager.get_secret_value(
+            SecretId=DB_SECRET_ARN,
+        )
     db_secret_string = json.loads(db_secret['SecretString'])
     db_secret_string
     db_host = db_secret_string['host']
@@ -34,51 +68,71 @@ def handler(event, context):
     db_user = db_secret_string['username']
     db_pass = db_secret_string['password']
 
-    # Download Data Files
-    logger.info('## Downloading Data Files')
-    s3.download_file(BUCKET_NAME, 'nintendo_switch_games_mean_pooling.json', '/tmp/nintendo_switch_games_mean_pooling.json')
-
-    # Load JSON Data into Dict
-    logger.info('## Importing Data Files')
-    with open('/tmp/nintendo_switch_games_mean_pooling.json') as file:
-        games = json.loads(file.read())
+    # Load Data Files
+    binary = DATASET_FORMAT == 'binary' or (DATASET_FORMAT == 'auto' and has_object(s3, BUCKET_NAME, MANIFEST_KEY))
+    if binary:
+        logger.info('## Downloading Binary Data Files')
+        games = binary_rows(s3, BUCKET_NAME)
+    elif INGEST_MODE == 'download':
+        logger.info('## Downloading Data Files')
+        games = download_rows(s3, BUCKET_NAME)
+    else:
+        # Rows are parsed lazily while they are being imported, the peak memory is bounded by the batch size
+        logger.info('## Streaming Data Files')
+        games = stream_rows(s3, BUCKET_NAME)
+    # Time spent downloading and parsing the rows, as they are pulled by the import
+    games = iterate('read', games, unit='rows')
 
     # Import Dict Data into Database
     logger.info('## Importing Data into Database')
-    with psycopg.connect(host=db_host, user=db_user, password=db_pass, port=db_port, connect_timeout=10, autocommit=True) as conn:
-        with conn.cursor() as cur:
-            # Enable pgvector extension
-            cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-            register_vector(conn)
+    index_options = dict(
+        method=INDEX_METHOD,
+        params=INDEX_PARAMS,
+        concurrently=INDEX_CONCURRENTLY,
+        maintenance_work_mem=INDEX_MAINTENANCE_WORK_MEM,
+        parallel_workers=INDEX_PARALLEL_WORKERS,
+        storage=INDEX_STORAGE,
+        partition_min_rows=INDEX_PARTITION_MIN_ROWS,
+        )
+    with span('connect'):
+        conn = psycopg.connect(host=db_host, user=db_user, password=db_pass, port=db_port, connect_timeout=10, autocommit=True)
+    with conn:
+        # Enable pgvector extension
+        conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        register_vector(conn)
+
+        # Load data into IGDB table, then (re)build the Cosine distance index
+        imported = True
+        if IMPORT_MODE == 'replace':
+            stats = replace_import(conn, games, batch_size=IMPORT_BATCH_SIZE, index_options=index_options)
+        elif IMPORT_MODE == 'sharded':
+            # Invocations of the same dataset version share its checkpoints, fanned out ones get the version in the event
+            import_id = event.get('import_id') or dataset_version(s3, BUCKET_NAME, binary_keys(s3, BUCKET_NAME) if binary else [DATASET_KEY])
+            invocation = event.get('invocation', 0)
+            if invocation == 0:
+                for _ in range(IMPORT_FANOUT - 1):
+                    invoke_self(context, import_id, invocation + 1)
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - IMPORT_TIME_MARGIN
+            pool_kwargs = dict(host=db_host, user=db_user, password=db_pass, port=db_port, connect_timeout=10)
+            with worker_pool(kwargs=pool_kwargs, workers=IMPORT_WORKERS) as pool:
+                stats = sharded_import(conn, pool, games, import_id, shard_size=IMPORT_SHARD_SIZE, workers=IMPORT_WORKERS,
+                                       deadline=deadline, batch_size=IMPORT_BATCH_SIZE, index_options=index_options)
+            # Only the invocation which swapped the table in runs the steps after the import, the others (or re-runs
+            # of a finished import) would rebuild the neighbors and bump the generation again.
+            # Continue in a new invocation while shards are left, with "pending" unknown if this one stopped before the end
+            imported = stats.swapped
+            if not stats.finished and stats.pending != 0:
+                if invocation + 1 < IMPORT_MAX_INVOCATIONS:
+                    invoke_self(context, import_id, invocation + 1)
+                else:
+                    logger.error(f"## Import {import_id} is not finished after {IMPORT_MAX_INVOCATIONS} invocations")
+        elif IMPORT_MODE == 'swap':
+            stats = swap_import(conn, games, batch_size=IMPORT_BATCH_SIZE, index_options=index_options)
+        else:
+            stats = incremental_import(conn, games, batch_size=IMPORT_BATCH_SIZE, index_options=index_options)
 
-            # Create IGDB table
-            cur.execute("DROP TABLE IF EXISTS igdb")
-            cur.execute("""CREATE TABLE IF NOT EXISTS igdb(
-                        igdb_id bigserial primary key, 
-                        name text,
-                        summary text,
-                        description text,
-                        url text,
-                        artwork_hash text,
-                        screenshot_hash text,
-                        description_embeddings vector(384));""")
+        # Precompute the related games and invalidate the search results cached by clients
+        if imported:
+            post_import(conn, stats, IMPORT_MODE, neighbors_k=NEIGHBORS_K, neighbors_block_size=NEIGHBORS_BLOCK_SIZE)
 
-            # Insert data into IGDB table
-            for row in games:
-                igdb_id, name, summary, description, url, artwork_hash, screenshot_hash, description_embeddings = row
-                cur.execute("""INSERT INTO igdb
-                                (igdb_id, name, summary, description, url, artwork_hash, screenshot_hash, description_embeddings) 
-                            VALUES(%s, %s, %s, %s, %s, %s, %s, %s);""", 
-                            (igdb_id, name, summary, description, url, artwork_hash, screenshot_hash, description_embeddings,))
-            
-            # # Create L2 distance index
-            # cur.execute("""CREATE INDEX ON igdb 
-            #        USING ivfflat (description_embeddings vector_l2_ops) WITH (lists = 100);""")  # Index name: igdb_description_embeddings_idx
-            # cur.execute("VACUUM ANALYZE igdb;")
-            
-            # Create Cosine distance index
-            cur.execute("""CREATE INDEX ON igdb 
-                USING ivfflat (description_embeddings vector_cosine_ops) WITH (lists = 100);""")  # Index name: igdb_description_embeddings_idx
-            cur.execute("VACUUM ANALYZE igdb;")
-    
     logger.info('## Process Finished.')
\ No newline at end of file
@@ -0,0 +1,205 @@
+import json
+import logging
+import math
+import time
+from psycopg import sql  # type: ignore
+from tracing import span
+
+logger = logging.getLogger()
+
+INDEX_NAME = 'igdb_description_embeddings_idx'
+OPCLASS = 'vector_cosine_ops'
+# Indexes of the other columns, named "<table>_<column>_idx": (column, method)
+SECONDARY_INDEXES = (('search_document', 'gin'), ('release_year', 'btree'), ('genres', 'gin'), ('platforms', 'gin'))
+
+# Values of these array columns with at least PARTITION_MIN_ROWS rows get a partial vector index of their own,
+# so filtered searches on them don't lose results to post-filtering. Smaller ones are searched exactly.
+PARTITION_COLUMNS = ('genres', 'platforms')
+PARTITION_MIN_ROWS = 2000
+MAX_PARTITIONS = 8
+# Partitions holding more than this fraction of the table lose few results to post-filtering, they don't need one
+PARTITION_MAX_FRACTION = 0.5
+
+# Tables up to this size get an HNSW index (better recall/latency, slower build), larger ones get an IVFFlat
+# index which builds much faster. The import runs in a Lambda function with a 60s timeout, along with the load.
+# [NOTE] Timed on a single core (PostgreSQL 16, pgvector 0.6, 384-d, m = 16, ef_construction = 64, 128MB
+# maintenance_work_mem, no parallel workers): HNSW builds 10k rows in 3.8s, 20k in 8.9s and 40k in 19.5s,
+# IVFFlat builds 40k rows in 0.4s. Raise it with a larger timeout and database instance, or set INDEX_METHOD.
+HNSW_MAX_ROWS = 20_000
+# HNSW is available since pgvector 0.5.0
+HNSW_MIN_VERSION = (0, 5, 0)
+# Half precision vectors ("halfvec") are available since pgvector 0.7.0
+HALFVEC_MIN_VERSION = (0, 7, 0)
+EMBEDDING_DIM = 384
+
+
+class IndexPlan:
+    def __init__(self, method, params):
+        self.method = method  # "ivfflat" or "hnsw"
+        self.params = params  # Storage parameters used in the "WITH (...)" clause
+
+    def __repr__(self):
+        return f"IndexPlan(method={self.method!r}, params={self.params!r})"
+
+
+class IndexBuildStats:
+    def __init__(self, plan, rows, seconds, concurrently, storage='full'):
+        self.plan = plan
+        self.rows = rows
+        self.seconds = seconds
+        self.concurrently = concurrently
+        self.storage = storage
+
+    def __repr__(self):
+        return f"IndexBuildStats(plan={self.plan!r}, rows={self.rows}, seconds={self.seconds:.3f}, concurrently={self.concurrently}, storage={self.storage!r})"
+
+
+def ivfflat_lists(row_count):
+    # pgvector's recommendation: rows / 1000 for up to 1M rows, sqrt(rows) for over 1M rows
+    if row_count > 1_000_000:
+        return int(math.sqrt(row_count))
+    return max(1, row_count // 1000)
+
+
+def hnsw_params(row_count):
+    # pgvector's defaults (m = 16, ef_construction = 64) are fine for small tables,
+    # raise them a bit for larger tables to keep recall high
+    if row_count > 50_000:
+        return {'m': 24, 'ef_construction': 100}
+    return {'m': 16, 'ef_construction': 64}
+
+
+def plan_index(row_count, method='auto', hnsw_supported=True, params=None):
+    if method == 'auto':
+        method = 'hnsw' if hnsw_supported and row_count <= HNSW_MAX_ROWS else 'ivfflat'
+    if method == 'hnsw' and not hnsw_supported:
+        logger.warning('## HNSW is not supported by the installed pgvector version, fall back to IVFFlat')
+        method = 'ivfflat'
+
+    if method == 'hnsw':
+        plan = IndexPlan('hnsw', hnsw_params(row_count))
+    elif method == 'ivfflat':
+        plan = IndexPlan('ivfflat', {'lists': ivfflat_lists(row_count)})
+    else:
+        raise ValueError(f"Unknown index method: {method}")
+    # Explicit parameters (e.g. recommended by "scripts/benchmark_ann_index.py") override the sized ones of the method
+    plan.params.update({key: value for key, value in (params or {}).items() if key in plan.params})
+    return plan
+
+
+def index_target(storage='full', dim=EMBEDDING_DIM):
+    # The indexed expression and its operator class. With "halfvec" storage the index holds a half precision
+    # copy of the embeddings (half the size), the table keeps the full precision ones for re-ranking.
+    if storage == 'halfvec':
+        return f"(description_embeddings::halfvec({dim}))", 'halfvec_cosine_ops'
+    if storage == 'full':
+        return 'description_embeddings', OPCLASS
+    raise ValueError(f"Unknown index storage: {storage}")
+
+
+def pgvector_version(cur):
+    cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+    extversion, = cur.fetchone()
+    return tuple(int(part) for part in (extversion.split('.') + ['0', '0'])[:3])
+
+
+def partition_predicate(column, value):
+    # [NOTE] Filtered queries must use the same expression, so the planner can match them with the partial index
+    return sql.SQL("{} @> {}").format(sql.Identifier(column), sql.Literal([value]))
+
+
+@span('partition_indexes')
+def build_partition_indexes(cur, table='igdb', method='auto', concurrently=False, storage='full',
+                            min_rows=PARTITION_MIN_ROWS, max_partitions=MAX_PARTITIONS):
+    # Replace the partial vector indexes, one for each of the largest partitions (e.g. games of a genre).
+    # Each index is commented with its partition as JSON, so search clients can find out which ones exist.
+    keyword = sql.SQL('CONCURRENTLY ' if concurrently else '')
+    cur.execute("""SELECT indexrelid::regclass::text FROM pg_index
+                    WHERE indrelid = %s::regclass AND indpred IS NOT NULL;""", (table,))
+    for name, in cur.fetchall():
+        cur.execute(sql.SQL("DROP INDEX {}IF EXISTS {};").format(keyword, sql.Identifier(name)))
+
+    cur.execute(sql.SQL("SELECT count(*) FROM {};").format(sql.Identifier(table)))
+    max_rows = cur.fetchone()[0] * PARTITION_MAX_FRACTION
+    partitions = []
+    for column in PARTITION_COLUMNS:
+        cur.execute(sql.SQL("""SELECT value, count(*) FROM {}, unnest({}) value
+                               GROUP BY value HAVING count(*) BETWEEN %s AND %s ORDER BY count(*) DESC;""").format(
+                        sql.Identifier(table), sql.Identifier(column)), (min_rows, max_rows))
+        partitions.extend((column, value, rows) for value, rows in cur.fetchall())
+    partitions.sort(key=lambda partition: -partition[2])
+
+    hnsw_supported = pgvector_version(cur) >= HNSW_MIN_VERSION
+    expression, opclass = index_target(storage)
+    for i, (column, value, rows) in enumerate(partitions[:max_partitions]):
+        plan = plan_index(rows, method, hnsw_supported=hnsw_supported)
+        params = ', '.join(f"{key} = {int(value)}" for key, value in plan.params.items())
+        name = f"{table}_{column}_part{i}_idx"
+        cur.execute(sql.SQL("CREATE INDEX {}{} ON {} USING {} ({} {}) WITH ({}) WHERE {};").format(
+            keyword, sql.Identifier(name), sql.Identifier(table), sql.SQL(plan.method), sql.SQL(expression),
+            sql.SQL(opclass), sql.SQL(params), partition_predicate(column, value)))
+        cur.execute(sql.SQL("COMMENT ON INDEX {} IS {};").format(
+            sql.Identifier(name), sql.Literal(json.dumps({'column': column, 'value': value, 'rows': rows}))))
+        logger.info(f"## Built partial index {name}: {plan} for {column} = {value!r} ({rows} rows)")
+    return partitions[:max_partitions]
+
+
+def build_index(conn, table='igdb', row_count=None, method='auto', concurrently=False,
+                maintenance_work_mem='128MB', parallel_workers=1, index_name=INDEX_NAME, analyze=True, storage='full',
+                partition_min_rows=PARTITION_MIN_ROWS, params=None):
+    # Build (or rebuild) the vector index of the table sized by the number of loaded rows, the partial vector
+    # indexes of the large partitions, and the secondary indexes if they're missing.
+    # When "concurrently" is True, a new index is built next to the existing one with
+    # "CREATE INDEX CONCURRENTLY" then swapped in by rename, so queries are never blocked.
+    # [NOTE] "CONCURRENTLY" can't run inside a transaction block, the connection must be in autocommit mode
+    with span('index', table=table) as current, conn.cursor() as cur:
+        if row_count is None:
+            cur.execute(f"SELECT count(*) FROM {table};")
+            row_count, = cur.fetchone()
+
+        version = pgvector_version(cur)
+        plan = plan_index(row_count, method, hnsw_supported=version >= HNSW_MIN_VERSION, params=params)
+        if storage == 'halfvec' and version < HALFVEC_MIN_VERSION:
+            logger.warning('## halfvec is not supported by the installed pgvector version, fall back to full precision')
+            storage = 'full'
+        expression, opclass = index_target(storage)
+        logger.info(f"## Building index: {plan} for {row_count} rows")
+
+        # Give the build more memory and parallel workers for this session only
+        cur.execute("SELECT set_config('maintenance_work_mem', %s, false);", (maintenance_work_mem,))
+        cur.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false);", (str(parallel_workers),))
+
+        params = ', '.join(f"{key} = {int(value)}" for key, value in plan.params.items())
+        current.set(method=plan.method, storage=storage)
+        current.add(rows=row_count)
+        start = time.perf_counter()
+        with span('vector_index'):
+            if concurrently:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}_new;")  # Leftover of a failed build
+                cur.execute(f"""CREATE INDEX CONCURRENTLY {index_name}_new ON {table}
+                    USING {plan.method} ({expression} {opclass}) WITH ({params});""")
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name};")
+                cur.execute(f"ALTER INDEX {index_name}_new RENAME TO {index_name};")
+            else:
+                cur.execute(f"DROP INDEX IF EXISTS {index_name};")
+                cur.execute(f"""CREATE INDEX {index_name} ON {table}
+                    USING {plan.method} ({expression} {opclass}) WITH ({params});""")
+        seconds = time.perf_counter() - start
+
+        # Secondary indexes don't depend on the row count, they're built once after the initial load and maintained afterwards
+        with span('secondary_indexes'):
+            for column, column_method in SECONDARY_INDEXES:
+                cur.execute(f"""CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {table}_{column}_idx ON {table}
+                    USING {column_method} ({column});""")
+        build_partition_indexes(cur, table, method, concurrently, storage, partition_min_rows)
+
+        cur.execute("RESET maintenance_work_mem;")
+        cur.execute("RESET max_parallel_maintenance_workers;")
+
+        if analyze:
+            with span('vacuum_analyze'):
+                cur.execute(f"VACUUM ANALYZE {table};")
+
+    stats = IndexBuildStats(plan, row_count, seconds, concurrently, storage)
+    logger.info(f"## Index built in {seconds:.2f}s: {stats}")
+    return stats
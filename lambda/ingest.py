@@ -0,0 +1,75 @@
+import hashlib
+import json
+import logging
+import os
+import ijson  # type: ignore
+from dataset import MANIFEST_SUFFIX, iter_rows, read_manifest
+from tracing import span
+
+logger = logging.getLogger()
+
+DATASET_NAME = 'nintendo_switch_games_mean_pooling'
+DATASET_KEY = DATASET_NAME + '.json'
+MANIFEST_KEY = DATASET_NAME + MANIFEST_SUFFIX
+READ_BUFFER_SIZE = 64 * 1024
+
+
+def download_rows(s3, bucket, key=DATASET_KEY, tmp_dir='/tmp'):
+    # Download the whole file into /tmp, then parse it at once.
+    # [NOTE] Holds both the raw text and all parsed rows in memory, use "stream_rows()" for large datasets
+    path = os.path.join(tmp_dir, os.path.basename(key))
+    with span('download'):
+        s3.download_file(bucket, key, path)
+    with span('parse') as current, open(path) as file:
+        rows = json.loads(file.read())
+        current.add(rows=len(rows))
+    return rows
+
+
+def stream_rows(s3, bucket, key=DATASET_KEY, buf_size=READ_BUFFER_SIZE):
+    # Read the object body as a stream and parse the top-level JSON array row by row.
+    # Only one read buffer and the row currently being parsed live in memory, so the consumer
+    # (e.g. "loader.copy_rows()") decides how many rows are held at once with its batch size.
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        yield from ijson.items(body, 'item', use_float=True, buf_size=buf_size)
+    finally:
+        body.close()
+
+
+def has_object(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except s3.exceptions.ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+def binary_keys(s3, bucket, manifest_key=MANIFEST_KEY):
+    # Keys of the manifest and the files it lists
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+    prefix = os.path.dirname(manifest_key)
+    return [manifest_key] + [f"{prefix}/{name}" if prefix else name for name in (manifest['metadata'], manifest['embeddings'])]
+
+
+def dataset_version(s3, bucket, keys):
+    # Fingerprint of the dataset objects from their ETags, changes whenever one of them is uploaded with a new content
+    digest = hashlib.sha256()
+    for key in keys:
+        digest.update(s3.head_object(Bucket=bucket, Key=key)['ETag'].encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+def binary_rows(s3, bucket, manifest_key=MANIFEST_KEY, tmp_dir='/tmp'):
+    # Download the binary dataset (manifest, Parquet metadata and embeddings block) into /tmp,
+    # then read it with the embeddings block memory-mapped instead of loaded into memory
+    prefix = os.path.dirname(manifest_key)
+    manifest_path = os.path.join(tmp_dir, os.path.basename(manifest_key))
+    with span('download'):
+        s3.download_file(bucket, manifest_key, manifest_path)
+        manifest = read_manifest(manifest_path)
+        for name in (manifest['metadata'], manifest['embeddings']):
+            s3.download_file(bucket, f"{prefix}/{name}" if prefix else name, os.path.join(tmp_dir, name))
+    yield from iter_rows(manifest_path)
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import re
+import time
+from itertools import islice
+import numpy as np
+from tracing import span
+
+logger = logging.getLogger()
+
+# Column order of the dataset rows
+DATASET_COLUMNS = ("igdb_id", "name", "summary", "description", "url", "artwork_hash", "screenshot_hash", "description_embeddings")
+# Column order of the IGDB table, the dataset columns plus a hash of their content and the metadata parsed from the description
+COLUMNS = DATASET_COLUMNS + ("content_hash", "release_year", "genres", "platforms")
+COLUMN_TYPES = ("int8", "text", "text", "text", "text", "text", "text", "vector", "bytea", "int2", "text[]", "text[]")
+
+DEFAULT_BATCH_SIZE = 1000
+# Text search configuration of the "search_document" column, queries must be parsed with the same one
+TEXT_SEARCH_CONFIG = "english"
+
+
+def create_table(cur, table="igdb"):
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {table}(
+                igdb_id bigserial primary key, 
+                name text,
+                summary text,
+                description text,
+                url text,
+                artwork_hash text,
+                screenshot_hash text,
+                description_embeddings vector(384),
+                content_hash bytea,
+                release_year smallint,
+                genres text[],
+                platforms text[],
+                search_document tsvector GENERATED ALWAYS AS (
+                    setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(name, '')), 'A') ||
+                    setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(summary, '')), 'B') ||
+                    setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(description, '')), 'C')) STORED);""")
+
+
+def content_hash(row):
+    # Hash of all dataset fields, used to find out changed rows on incremental imports
+    *fields, embeddings = row
+    digest = hashlib.blake2b(digest_size=16)
+    for field in fields:
+        digest.update(str(field).encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(np.asarray(embeddings, dtype="<f4").tobytes())
+    return digest.digest()
+
+
+# The descriptions end with labeled fields, for example:
+#   "... Released on May 12, 2023. Publishers: Nintendo. Platforms: Nintendo Switch. Game Modes: Single player.
+#    Genres: Role-playing (RPG), Adventure. Themes: Action, Fantasy. Player Perspectives: Third person."
+RELEASE_YEAR_PATTERN = re.compile(r"Released on [A-Z][a-z]{2} \d{1,2}, (\d{4})")
+
+
+def _labeled_values(description, label):
+    match = re.search(rf"\b{label}: (.*?)(?:\.(?= [A-Z][A-Za-z ]*: )|\.?\s*$)", description)
+    if match is None:
+        return []
+    return [value.strip() for value in match.group(1).split(", ") if value.strip() and value.strip() != "unknown"]
+
+
+def parse_metadata(description):
+    # Release year, genres and platforms of a game from its description, None / empty lists if missing
+    description = description or ""
+    match = RELEASE_YEAR_PATTERN.search(description)
+    return (int(match.group(1)) if match else None,
+            _labeled_values(description, "Genres"),
+            _labeled_values(description, "Platforms"))
+
+
+def table_row(row):
+    # Values of a dataset row in the column order of the IGDB table
+    *fields, embeddings = row
+    return (*fields, np.asarray(embeddings, dtype=np.float32), content_hash(row), *parse_metadata(row[3]))
+
+
+class LoadStats:
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return f"LoadStats(rows={self.rows}, batches={self.batches}, seconds={self.seconds:.3f}, rows_per_sec={self.rows_per_sec:.1f})"
+
+
+def _batched(rows, batch_size):
+    iterator = iter(rows)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def copy_rows(conn, rows, table="igdb", batch_size=DEFAULT_BATCH_SIZE):
+    # Stream rows into the table with "COPY ... FROM STDIN" in binary format.
+    # [NOTE] Embeddings are sent as numpy arrays, so the binary dumper registered by
+    # pgvector's "register_vector()" encodes them with pgvector's binary "vector" format
+    # (int16 dim, int16 unused, dim x big-endian float4) instead of the text representation.
+    # Every batch runs in its own transaction, so a failed batch only rolls back itself.
+    stats = LoadStats()
+    start = time.perf_counter()
+    statement = f"COPY {table} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+    with span('copy') as current, conn.cursor() as cur:
+        for batch in _batched(rows, batch_size):
+            with conn.transaction():
+                with cur.copy(statement) as copy:
+                    copy.set_types(COLUMN_TYPES)
+                    for row in batch:
+                        copy.write_row(table_row(row))
+            stats.rows += len(batch)
+            stats.batches += 1
+            current.add(rows=len(batch), batches=1)
+            logger.info(f"## Copied batch {stats.batches} ({stats.rows} rows so far)")
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Copied {stats.rows} rows in {stats.seconds:.2f}s ({stats.rows_per_sec:.1f} rows/sec)")
+    return stats
+
+
+def insert_rows(conn, rows, table="igdb"):
+    # The original row-at-a-time path, kept as a fallback and as a baseline for benchmarks
+    stats = LoadStats()
+    start = time.perf_counter()
+    with conn.cursor() as cur:
+        for row in rows:
+            cur.execute(f"""INSERT INTO {table}
+                            ({', '.join(COLUMNS)})
+                        VALUES({', '.join(['%s'] * len(COLUMNS))});""",
+                        table_row(row))
+            stats.rows += 1
+    stats.batches = 1
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Inserted {stats.rows} rows in {stats.seconds:.2f}s ({stats.rows_per_sec:.1f} rows/sec)")
+    return stats
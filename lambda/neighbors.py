@@ -0,0 +1,201 @@
+import json
+import logging
+import time
+import numpy as np
+from psycopg import sql  # type: ignore
+from tracing import iterate, span
+
+logger = logging.getLogger()
+
+TABLE = 'igdb'
+NEIGHBORS_TABLE = 'igdb_neighbors'
+SHADOW_NEIGHBORS_TABLE = 'igdb_neighbors_shadow'
+
+# Neighbors stored per game
+DEFAULT_NEIGHBORS = 10
+# Games scored at once against a tile of the embedding matrix, the scores of a block take
+# block_size x (tile_size + k) float32 values (8 MiB with the defaults)
+DEFAULT_BLOCK_SIZE = 512
+DEFAULT_TILE_SIZE = 4096
+# Above this fraction of changed or deleted rows, an incremental update rebuilds every neighbor list
+FULL_REBUILD_FRACTION = 0.5
+
+
+class NeighborStats:
+    def __init__(self, mode, k):
+        self.mode = mode  # "full" or "incremental"
+        self.k = k
+        self.rows = 0  # Games of the table
+        self.updated = 0  # Games whose neighbor lists were computed
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f"NeighborStats(mode={self.mode!r}, k={self.k}, rows={self.rows}, updated={self.updated}, seconds={self.seconds:.3f})"
+
+
+def create_neighbors_table(cur, table=NEIGHBORS_TABLE, k=DEFAULT_NEIGHBORS):
+    # The primary key serves the lookup of a game's neighbors in rank order with a single index range scan.
+    # [NOTE] No foreign key to the IGDB table, since imports replace it by swapping tables.
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {table}(
+                igdb_id bigint,
+                rank smallint,
+                neighbor_id bigint not null,
+                score real not null,
+                primary key (igdb_id, rank));""")
+    cur.execute(sql.SQL("COMMENT ON TABLE {} IS {}").format(sql.Identifier(table), sql.Literal(json.dumps({'k': k}))))
+
+
+def neighbors_are_current(cur, k, table=NEIGHBORS_TABLE):
+    # The table exists and was built with the same number of neighbors
+    cur.execute("SELECT obj_description(to_regclass(%s), 'pg_class');", (table,))
+    comment = cur.fetchone()[0]
+    return comment is not None and json.loads(comment).get('k') == k
+
+
+@span('load_embeddings')
+def load_embeddings(conn, table=TABLE, chunk_size=2000):
+    # Ids and unit-normalized embeddings of every game, ordered by id.
+    # [NOTE] "register_vector()" must have been called on the connection
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {table};")
+        count = cur.fetchone()[0]
+    ids = np.empty(count, dtype=np.int64)
+    matrix = None
+    with conn.transaction():
+        with conn.cursor(name='igdb_neighbors_embeddings') as cur:
+            cur.itersize = chunk_size
+            cur.execute(f"SELECT igdb_id, description_embeddings FROM {table} ORDER BY igdb_id;")
+            rows = 0
+            for igdb_id, vector in cur:
+                if rows >= count:  # Rows inserted after counting
+                    break
+                if matrix is None:
+                    matrix = np.empty((count, len(vector)), dtype=np.float32)
+                ids[rows] = igdb_id
+                matrix[rows] = vector
+                rows += 1
+    if matrix is None:
+        return ids[:0], np.empty((0, 0), dtype=np.float32)
+    matrix = matrix[:rows]
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), np.float32(1e-12))
+    return ids[:rows], matrix
+
+
+def top_k_neighbors(matrix, positions, k=DEFAULT_NEIGHBORS, block_size=DEFAULT_BLOCK_SIZE, tile_size=DEFAULT_TILE_SIZE):
+    # Yield "(positions, neighbor positions, scores)" for every block of the given row positions: the k rows
+    # with the highest cosine similarity to each of them, best first, leaving the row itself out. The matrix
+    # is multiplied one tile at a time, and the running top-k of the block is merged with each tile's scores.
+    k = min(k, len(matrix) - 1)
+    if k <= 0:
+        return
+    for start in range(0, len(positions), block_size):
+        rows = np.asarray(positions[start:start + block_size])
+        queries = matrix[rows]
+        best_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        best = np.full((len(rows), k), -1, dtype=np.int64)
+        for tile in range(0, len(matrix), tile_size):
+            scores = queries @ matrix[tile:tile + tile_size].T
+            own = (rows >= tile) & (rows < tile + scores.shape[1])
+            scores[np.nonzero(own)[0], rows[own] - tile] = -np.inf
+            scores = np.concatenate([best_scores, scores], axis=1)
+            candidates = np.concatenate([best, np.broadcast_to(np.arange(tile, tile + scores.shape[1] - k), (len(rows), scores.shape[1] - k))], axis=1)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best = np.take_along_axis(candidates, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        yield rows, np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def copy_neighbors(cur, table, ids, blocks):
+    # Stream the neighbor lists into the table with "COPY ... FROM STDIN" in binary format
+    rows = 0
+    with cur.copy(f"COPY {table} (igdb_id, rank, neighbor_id, score) FROM STDIN WITH (FORMAT BINARY)") as copy:
+        copy.set_types(('int8', 'int2', 'int8', 'float4'))
+        for positions, neighbors, scores in blocks:
+            for igdb_id, neighbor_positions, neighbor_scores in zip(ids[positions].tolist(), ids[neighbors].tolist(), scores.tolist()):
+                for rank, (neighbor_id, score) in enumerate(zip(neighbor_positions, neighbor_scores), start=1):
+                    copy.write_row((igdb_id, rank, neighbor_id, score))
+            rows += len(positions)
+    return rows
+
+
+def build_neighbors(conn, k=DEFAULT_NEIGHBORS, block_size=DEFAULT_BLOCK_SIZE, table=TABLE):
+    # Compute the neighbor lists of every game into a shadow table, then swap it in with renames in a single
+    # transaction, so lookups keep reading the previous lists until the new ones are complete
+    stats = NeighborStats('full', k)
+    start = time.perf_counter()
+    ids, matrix = load_embeddings(conn, table)
+    stats.rows = len(ids)
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {SHADOW_NEIGHBORS_TABLE}")
+            create_neighbors_table(cur, SHADOW_NEIGHBORS_TABLE, k)
+            with span('write'):
+                blocks = iterate('top_k', top_k_neighbors(matrix, np.arange(len(ids)), k, block_size), unit='blocks')
+                stats.updated = copy_neighbors(cur, SHADOW_NEIGHBORS_TABLE, ids, blocks)
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {NEIGHBORS_TABLE}")
+            cur.execute(f"ALTER TABLE {SHADOW_NEIGHBORS_TABLE} RENAME TO {NEIGHBORS_TABLE}")
+            cur.execute(f"ALTER INDEX {SHADOW_NEIGHBORS_TABLE}_pkey RENAME TO {NEIGHBORS_TABLE}_pkey")
+            cur.execute(f"ANALYZE {NEIGHBORS_TABLE};")
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Neighbors built: {stats}")
+    return stats
+
+
+def affected_positions(conn, ids, matrix, changed, deleted, k, block_size=DEFAULT_BLOCK_SIZE):
+    # Positions of the games whose neighbor lists may change: the changed games themselves, the ones listing
+    # a changed or deleted game as a neighbor, and the ones a changed game would now enter the top-k of
+    positions = {int(igdb_id): position for position, igdb_id in enumerate(ids.tolist())}
+    changed_positions = np.array([positions[igdb_id] for igdb_id in changed if igdb_id in positions], dtype=np.int64)
+    affected = set(changed_positions.tolist())
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT DISTINCT igdb_id FROM {NEIGHBORS_TABLE} WHERE neighbor_id = ANY(%s);", (list(changed) + list(deleted),))
+        affected.update(positions[igdb_id] for igdb_id, in cur if igdb_id in positions)
+        # Score of the last neighbor of every game, games with less than k neighbors take any new one
+        cur.execute(f"SELECT igdb_id, min(score), count(*) FROM {NEIGHBORS_TABLE} GROUP BY igdb_id;")
+        threshold = np.full(len(ids), -np.inf, dtype=np.float32)
+        for igdb_id, score, count in cur:
+            if igdb_id in positions and count >= k:
+                threshold[positions[igdb_id]] = score
+    if len(changed_positions):
+        changed_matrix = matrix[changed_positions]
+        for start in range(0, len(ids), block_size):
+            scores = matrix[start:start + block_size] @ changed_matrix.T
+            own = (changed_positions >= start) & (changed_positions < start + len(scores))
+            scores[changed_positions[own] - start, np.nonzero(own)[0]] = -np.inf
+            entering = scores.max(axis=1) > threshold[start:start + len(scores)]
+            affected.update((start + np.nonzero(entering)[0]).tolist())
+    return np.array(sorted(affected), dtype=np.int64)
+
+
+def update_neighbors(conn, changed=None, deleted=(), k=DEFAULT_NEIGHBORS, block_size=DEFAULT_BLOCK_SIZE, table=TABLE):
+    # Recompute only the neighbor lists affected by the changed (new or updated) and deleted games of an
+    # incremental import, replacing them in a single transaction. "changed=None" means every game changed.
+    # Falls back to "build_neighbors()" when the table is missing, has another k, or most rows changed.
+    with conn.cursor() as cur:
+        current = neighbors_are_current(cur, k)
+    if changed is None or not current:
+        return build_neighbors(conn, k=k, block_size=block_size, table=table)
+    stats = NeighborStats('incremental', k)
+    start = time.perf_counter()
+    changed, deleted = list(changed), list(deleted)
+    if not changed and not deleted:
+        logger.info('## Neighbors are up to date')
+        return stats
+    ids, matrix = load_embeddings(conn, table)
+    stats.rows = len(ids)
+    if len(changed) + len(deleted) > max(len(ids), 1) * FULL_REBUILD_FRACTION:
+        return build_neighbors(conn, k=k, block_size=block_size, table=table)
+
+    with span('affected'):
+        affected = affected_positions(conn, ids, matrix, changed, deleted, k, block_size)
+    with span('write'), conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {NEIGHBORS_TABLE} WHERE igdb_id = ANY(%s);", (ids[affected].tolist() + deleted,))
+            blocks = iterate('top_k', top_k_neighbors(matrix, affected, k, block_size), unit='blocks')
+            stats.updated = copy_neighbors(cur, NEIGHBORS_TABLE, ids, blocks)
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Neighbors updated: {stats}")
+    return stats
@@ -0,0 +1,267 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from psycopg import errors  # type: ignore
+from psycopg_pool import ConnectionPool  # type: ignore
+from pgvector.psycopg import register_vector  # type: ignore
+from loader import DEFAULT_BATCH_SIZE, _batched, copy_rows, create_table
+from indexing import build_index
+from sync import SHADOW_TABLE, swap_in
+from tracing import span
+
+logger = logging.getLogger()
+
+# Checkpoint tables: one row per import (identified by the dataset version), one row per shard of it
+IMPORTS_TABLE = 'igdb_imports'
+SHARDS_TABLE = 'igdb_import_shards'
+
+# Rows of a shard, a shard is loaded and checkpointed in a single transaction
+DEFAULT_SHARD_SIZE = 1000
+DEFAULT_WORKERS = 4
+# Shards failing this many times are left out, so a bad shard can't keep the re-invocations going forever
+MAX_ATTEMPTS = 3
+# Key of the advisory lock serializing the import planning and the final swap across invocations
+LOCK_KEY = 0x16db
+# Sessions of frozen or killed invocations release their shard locks after this timeout
+IDLE_IN_TRANSACTION_TIMEOUT = '30s'
+
+
+class ShardStats:
+    def __init__(self, import_id):
+        self.import_id = import_id
+        self.loaded = 0  # Shards loaded by this invocation
+        self.skipped = 0  # Shards already done, or being loaded by another invocation
+        self.failed = 0
+        self.rows = 0
+        self.pending = None  # Shards left after this invocation, unknown until a reader reached the end of the dataset
+        self.stopped_early = False  # Stopped claiming shards because of the deadline
+        self.finished = False  # The shadow table has been indexed and swapped in
+        self.swapped = False  # This invocation did the swap, the steps after the import are left to it
+        self.upserted_ids = None  # Same as "SyncStats", every row is reloaded
+        self.deleted_ids = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return (f"ShardStats(import_id={self.import_id!r}, loaded={self.loaded}, skipped={self.skipped}, failed={self.failed}, "
+                f"rows={self.rows}, pending={self.pending}, stopped_early={self.stopped_early}, finished={self.finished}, "
+                f"swapped={self.swapped}, seconds={self.seconds:.3f})")
+
+
+def create_checkpoint_tables(cur):
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {IMPORTS_TABLE}(
+                import_id text primary key,
+                shard_size int not null,
+                shards int,
+                status text not null default 'loading',
+                created_at timestamptz not null default now(),
+                finished_at timestamptz);""")
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {SHARDS_TABLE}(
+                import_id text references {IMPORTS_TABLE} on delete cascade,
+                shard int,
+                status text not null default 'pending',
+                rows int not null default 0,
+                attempts int not null default 0,
+                worker text,
+                updated_at timestamptz not null default now(),
+                primary key (import_id, shard));""")
+
+
+def _configure_worker(conn):
+    register_vector(conn)
+    conn.execute(f"SET idle_in_transaction_session_timeout = '{IDLE_IN_TRANSACTION_TIMEOUT}';")
+
+
+def worker_pool(conninfo='', kwargs=None, workers=DEFAULT_WORKERS):
+    # One connection per worker thread, in autocommit mode like the main connection of the Lambda function
+    return ConnectionPool(conninfo, kwargs=dict(kwargs or {}, autocommit=True), min_size=workers, max_size=workers,
+                          configure=_configure_worker, open=True)
+
+
+def begin_import(conn, import_id, shard_size=DEFAULT_SHARD_SIZE):
+    # Resume the import of this dataset version, or start it over with an empty shadow table.
+    # Returns the status ("loading" or "finished") and the shard size the import was planned with.
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+            create_checkpoint_tables(cur)
+            cur.execute(f"SELECT status, shard_size FROM {IMPORTS_TABLE} WHERE import_id = %s;", (import_id,))
+            row = cur.fetchone()
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (SHADOW_TABLE,))
+            shadow_exists = cur.fetchone()[0]
+            if row is not None and (row[0] == 'finished' or shadow_exists):
+                logger.info(f"## Resuming import {import_id} ({row[0]})")
+                return row
+            logger.info(f"## Starting import {import_id}")
+            cur.execute(f"DELETE FROM {IMPORTS_TABLE};")  # Checkpoints of older dataset versions
+            cur.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+            create_table(cur, SHADOW_TABLE)
+            cur.execute(f"INSERT INTO {IMPORTS_TABLE} (import_id, shard_size) VALUES (%s, %s);", (import_id, shard_size))
+    return 'loading', shard_size
+
+
+def _claim_shard(conn, import_id, shard, worker):
+    # Count the attempt outside of the load transaction, so it's kept even if the load fails
+    with conn.cursor() as cur:
+        cur.execute(f"INSERT INTO {SHARDS_TABLE} (import_id, shard) VALUES (%s, %s) ON CONFLICT DO NOTHING;", (import_id, shard))
+        cur.execute(f"""UPDATE {SHARDS_TABLE} SET attempts = attempts + 1, worker = %s, updated_at = now()
+                         WHERE (import_id, shard) IN (
+                               SELECT import_id, shard FROM {SHARDS_TABLE}
+                                WHERE import_id = %s AND shard = %s AND status = 'pending' AND attempts < %s
+                                  FOR UPDATE SKIP LOCKED)
+                     RETURNING attempts;""", (worker, import_id, shard, MAX_ATTEMPTS))
+        return cur.fetchone() is not None
+
+
+def load_shard(pool, import_id, shard, rows, worker, batch_size=DEFAULT_BATCH_SIZE):
+    # Copy the rows of a shard into the shadow table and mark it done in the same transaction.
+    # A worker killed halfway rolls back everything it copied, and the shard stays pending.
+    # The row lock on the shard is held until commit, so concurrent invocations skip it meanwhile.
+    # Returns the number of rows loaded, or None when the shard has been skipped.
+    with pool.connection() as conn:
+        if not _claim_shard(conn, import_id, shard, worker):
+            return None
+        try:
+            with conn.transaction():
+                with conn.cursor() as cur:
+                    cur.execute(f"""SELECT 1 FROM {SHARDS_TABLE}
+                                     WHERE import_id = %s AND shard = %s AND status = 'pending'
+                                       FOR UPDATE NOWAIT;""", (import_id, shard))
+                    if cur.fetchone() is None:
+                        return None
+                    loaded = copy_rows(conn, rows, table=SHADOW_TABLE, batch_size=batch_size).rows
+                    cur.execute(f"""UPDATE {SHARDS_TABLE} SET status = 'done', rows = %s, updated_at = now()
+                                     WHERE import_id = %s AND shard = %s;""", (loaded, import_id, shard))
+        except errors.LockNotAvailable:
+            return None  # Claimed by another invocation at the same time, which got the lock first
+    logger.info(f"## Loaded shard {shard} ({loaded} rows) by {worker}")
+    return loaded
+
+
+def import_progress(cur, import_id):
+    # Returns the status, the total shard count (None until known), and the done and failed shard counts,
+    # or None if the import has been superseded by a newer dataset version
+    cur.execute(f"""SELECT i.status, i.shards,
+                           count(*) FILTER (WHERE s.status = 'done'),
+                           count(*) FILTER (WHERE s.status = 'pending' AND s.attempts >= %s)
+                      FROM {IMPORTS_TABLE} i LEFT JOIN {SHARDS_TABLE} s USING (import_id)
+                     WHERE i.import_id = %s
+                     GROUP BY i.status, i.shards;""", (MAX_ATTEMPTS, import_id))
+    return cur.fetchone()
+
+
+def run_shards(conn, pool, import_id, rows, shard_size=DEFAULT_SHARD_SIZE, workers=DEFAULT_WORKERS,
+               deadline=None, batch_size=DEFAULT_BATCH_SIZE, stats=None):
+    # Read the dataset once, cut it into shards of "shard_size" rows in dataset order, and hand the
+    # shards which aren't done yet to the worker threads. Stops handing out shards after "deadline"
+    # (a "time.monotonic()" value), the shards in flight are still finished.
+    stats = stats or ShardStats(import_id)
+    worker_prefix = uuid.uuid4().hex[:8]
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT shard FROM {SHARDS_TABLE} WHERE import_id = %s AND (status = 'done' OR attempts >= %s);",
+                    (import_id, MAX_ATTEMPTS))
+        skip = {shard for shard, in cur}
+
+    # [NOTE] Bound the shards held in memory: the ones being loaded plus one being read ahead
+    slots = threading.BoundedSemaphore(workers + 1)
+
+    def load(shard, chunk):
+        try:
+            return load_shard(pool, import_id, shard, chunk, f"{worker_prefix}-{threading.current_thread().name}", batch_size)
+        except Exception:
+            logger.exception(f"## Failed to load shard {shard}")
+            return False
+        finally:
+            slots.release()
+
+    shard = -1
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard') as executor:
+        for shard, chunk in enumerate(_batched(rows, shard_size)):
+            if shard in skip:
+                stats.skipped += 1
+                continue
+            slots.acquire()
+            if deadline is not None and time.monotonic() >= deadline:
+                slots.release()
+                stats.stopped_early = True
+                break
+            # [NOTE] Worker threads don't inherit the context, each shard runs in a copy of this one so its
+            # spans are children of the import span
+            futures.append(executor.submit(contextvars.copy_context().run, load, shard, chunk))
+        else:
+            # Reached the end of the dataset, the total number of shards is known now
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {IMPORTS_TABLE} SET shards = %s WHERE import_id = %s;", (shard + 1, import_id))
+
+    for future in futures:
+        loaded = future.result()
+        if loaded is None:
+            stats.skipped += 1
+        elif loaded is False:
+            stats.failed += 1
+        else:
+            stats.loaded += 1
+            stats.rows += loaded
+    return stats
+
+
+def finish_import(conn, import_id, index_options=None):
+    # Index the shadow table and swap it in once all shards are done. Only one invocation gets the lock,
+    # the others leave it to that one. Returns "swapped" if this call did the swap, "finished" if the import
+    # was already finished, or None if it isn't finished yet.
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            return None
+        try:
+            progress = import_progress(cur, import_id)
+            if progress is None:
+                return None
+            status, shards, done, _ = progress
+            if status == 'finished':
+                return 'finished'
+            if shards is None or done < shards:
+                return None
+            cur.execute(f"SELECT coalesce(sum(rows), 0) FROM {SHARDS_TABLE} WHERE import_id = %s;", (import_id,))
+            row_count = cur.fetchone()[0]
+            index_options = dict(index_options or {}, concurrently=False)  # Nobody queries the shadow table yet
+            build_index(conn, table=SHADOW_TABLE, row_count=row_count, index_name=f"{SHADOW_TABLE}_description_embeddings_idx", **index_options)
+            with conn.transaction():
+                swap_in(conn)
+                cur.execute(f"UPDATE {IMPORTS_TABLE} SET status = 'finished', finished_at = now() WHERE import_id = %s;", (import_id,))
+            logger.info(f"## Import {import_id} finished with {row_count} rows")
+            return 'swapped'
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (LOCK_KEY,))
+
+
+@span('sharded_import')
+def sharded_import(conn, pool, rows, import_id, shard_size=DEFAULT_SHARD_SIZE, workers=DEFAULT_WORKERS,
+                   deadline=None, batch_size=DEFAULT_BATCH_SIZE, index_options=None):
+    # Checkpointed full rebuild in the shadow table, which can be resumed by re-running it with the same
+    # "import_id" (the dataset version), and run by several invocations at once. "conn" is an autocommit
+    # connection used for the checkpoints, "pool" holds the connections of the worker threads.
+    stats = ShardStats(import_id)
+    start = time.perf_counter()
+    status, shard_size = begin_import(conn, import_id, shard_size)
+    if status != 'finished':
+        run_shards(conn, pool, import_id, rows, shard_size=shard_size, workers=workers, deadline=deadline,
+                   batch_size=batch_size, stats=stats)
+        status = finish_import(conn, import_id, index_options=index_options)
+    stats.finished = status in ('finished', 'swapped')
+    stats.swapped = status == 'swapped'
+    with conn.cursor() as cur:
+        progress = import_progress(cur, import_id)
+    if progress is None:
+        logger.warning(f"## Import {import_id} has been superseded by a newer dataset version")
+    else:
+        _, shards, done, failed = progress
+        stats.pending = None if shards is None else shards - done - failed
+        if failed:
+            logger.error(f"## {failed} shards failed {MAX_ATTEMPTS} times, the import can't finish")
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Import progress: {stats}")
+    return stats
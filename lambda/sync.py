@@ -0,0 +1,173 @@
+import logging
+import time
+from loader import COLUMNS, DEFAULT_BATCH_SIZE, content_hash, copy_rows, create_table
+from indexing import build_index
+from neighbors import DEFAULT_BLOCK_SIZE, DEFAULT_NEIGHBORS, update_neighbors
+from tracing import span
+
+logger = logging.getLogger()
+
+TABLE = 'igdb'
+SHADOW_TABLE = 'igdb_shadow'
+STAGING_TABLE = 'igdb_staging'
+GENERATION_TABLE = 'igdb_generation'
+
+
+class SyncStats:
+    def __init__(self, mode):
+        self.mode = mode
+        self.rows = 0  # Rows in the incoming dataset
+        self.upserted = 0
+        self.deleted = 0
+        self.upserted_ids = None  # Ids of the new or changed rows, None when every row was (re)loaded
+        self.deleted_ids = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f"SyncStats(mode={self.mode!r}, rows={self.rows}, upserted={self.upserted}, deleted={self.deleted}, seconds={self.seconds:.3f})"
+
+
+def table_is_current(cur, table=TABLE):
+    # The table exists and already has the columns added after the first release: "content_hash" used by
+    # incremental imports, "search_document" used by full-text searches and the metadata used by filters
+    required = ('content_hash', 'search_document', 'release_year', 'genres', 'platforms')
+    cur.execute("""SELECT count(*) FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = %s AND column_name = ANY(%s);""",
+                (table, list(required)))
+    return cur.fetchone()[0] == len(required)
+
+
+def record_generation(conn, mode):
+    # Append a new import generation, search clients drop the results they cached from the previous ones
+    # ("ResultCache" in igdb/result_cache.py)
+    with conn.cursor() as cur:
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {GENERATION_TABLE}(
+                    generation bigint generated always as identity primary key,
+                    mode text not null,
+                    imported_at timestamptz not null default now());""")
+        cur.execute(f"INSERT INTO {GENERATION_TABLE} (mode) VALUES (%s) RETURNING generation;", (mode,))
+        generation = cur.fetchone()[0]
+    logger.info(f"## Import generation: {generation}")
+    return generation
+
+
+def post_import(conn, stats, mode, neighbors_k=DEFAULT_NEIGHBORS, neighbors_block_size=DEFAULT_BLOCK_SIZE):
+    # Steps after an import, shared by the Lambda function and the notebook, so they can't drift apart:
+    # precompute the related games of every game (only the lists affected by an incremental import are
+    # recomputed, "0" neighbors to skip), then invalidate the search results cached by clients, unless an
+    # incremental import changed nothing
+    if neighbors_k > 0:
+        with span('neighbors') as current:
+            neighbor_stats = update_neighbors(conn, changed=stats.upserted_ids, deleted=stats.deleted_ids,
+                                              k=neighbors_k, block_size=neighbors_block_size)
+            current.add(rows=neighbor_stats.updated)
+    if stats.upserted_ids is None or stats.upserted_ids or stats.deleted_ids:
+        record_generation(conn, mode)
+
+
+@span('replace_import')
+def replace_import(conn, rows, batch_size=DEFAULT_BATCH_SIZE, index_options=None):
+    # Drop and reload the table in place, searches return nothing until the import finishes
+    stats = SyncStats('replace')
+    start = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        create_table(cur, TABLE)
+    stats.rows = stats.upserted = copy_rows(conn, rows, table=TABLE, batch_size=batch_size).rows
+    build_index(conn, table=TABLE, row_count=stats.rows, **(index_options or {}))
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Import finished: {stats}")
+    return stats
+
+
+@span('swap_in')
+def swap_in(conn):
+    # Replace the table with the loaded and indexed shadow table with renames in a single transaction.
+    # Indexes are named after their table ("igdb_shadow_*"), they're renamed after the table too ("igdb_*").
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            cur.execute(f"ALTER TABLE {SHADOW_TABLE} RENAME TO {TABLE}")
+            cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass;", (TABLE,))
+            for name, in cur.fetchall():
+                if name.startswith(f"{SHADOW_TABLE}_"):
+                    cur.execute(f"ALTER INDEX {name} RENAME TO {TABLE}_{name[len(SHADOW_TABLE) + 1:]}")
+            cur.execute(f"ALTER SEQUENCE {SHADOW_TABLE}_igdb_id_seq RENAME TO {TABLE}_igdb_id_seq")
+
+
+@span('swap_import')
+def swap_import(conn, rows, batch_size=DEFAULT_BATCH_SIZE, index_options=None):
+    # Load the full dataset into a shadow table and build its index there, then swap it in
+    # with renames in a single transaction. Queries keep hitting the old table until the swap.
+    stats = SyncStats('swap')
+    start = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")  # Leftover of a failed import
+        create_table(cur, SHADOW_TABLE)
+    stats.rows = stats.upserted = copy_rows(conn, rows, table=SHADOW_TABLE, batch_size=batch_size).rows
+    index_options = dict(index_options or {}, concurrently=False)  # Nobody queries the shadow table yet
+    build_index(conn, table=SHADOW_TABLE, row_count=stats.rows, index_name=f"{SHADOW_TABLE}_description_embeddings_idx", **index_options)
+
+    swap_in(conn)
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Import finished: {stats}")
+    return stats
+
+
+@span('incremental_import')
+def incremental_import(conn, rows, batch_size=DEFAULT_BATCH_SIZE, index_options=None):
+    # Compare incoming rows with the table by "igdb_id" and content hash, stage only the new or
+    # changed rows, then upsert them and delete the removed ones in a single transaction.
+    # Falls back to a full "swap_import()" when the table doesn't exist yet or has an old schema.
+    with conn.cursor() as cur:
+        if not table_is_current(cur, TABLE):
+            logger.info(f"## Table {TABLE} is missing or outdated, rebuild it")
+            return swap_import(conn, rows, batch_size=batch_size, index_options=index_options)
+        with span('read_hashes'):
+            cur.execute(f"SELECT igdb_id, content_hash FROM {TABLE};")
+            existing = {igdb_id: bytes(row_hash) if row_hash is not None else None for igdb_id, row_hash in cur}
+
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+        cur.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} (LIKE {TABLE} INCLUDING DEFAULTS);")
+
+    stats = SyncStats('incremental')
+    stats.upserted_ids = []
+    start = time.perf_counter()
+    seen = set()
+
+    def changed_rows():
+        for row in rows:
+            stats.rows += 1
+            igdb_id = row[0]
+            seen.add(igdb_id)
+            if existing.get(igdb_id, b'') != content_hash(row):
+                stats.upserted_ids.append(igdb_id)
+                yield row
+
+    stats.upserted = copy_rows(conn, changed_rows(), table=STAGING_TABLE, batch_size=batch_size).rows
+    removed = [igdb_id for igdb_id in existing if igdb_id not in seen]
+
+    updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in COLUMNS if column != 'igdb_id')
+    with span('upsert') as current, conn.transaction():
+        current.add(rows=stats.upserted, deleted=len(removed))
+        with conn.cursor() as cur:
+            cur.execute(f"""INSERT INTO {TABLE} ({', '.join(COLUMNS)})
+                            SELECT {', '.join(COLUMNS)} FROM {STAGING_TABLE}
+                            ON CONFLICT (igdb_id) DO UPDATE SET {updates};""")
+            if removed:
+                cur.execute(f"DELETE FROM {TABLE} WHERE igdb_id = ANY(%s);", (removed,))
+            stats.deleted = len(removed)
+            stats.deleted_ids = removed
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+        if stats.upserted or stats.deleted:
+            with span('analyze'):
+                cur.execute(f"ANALYZE {TABLE};")
+
+    # [NOTE] IVFFlat lists are sized at build time, rebuild the index once the table size changed a lot
+    if abs(len(seen) - len(existing)) > max(len(existing), 1) // 2:
+        build_index(conn, table=TABLE, row_count=len(seen), **dict(index_options or {}, concurrently=True))
+
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"## Import finished: {stats}")
+    return stats
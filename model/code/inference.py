@@ -1,6 +1,27 @@
+import logging
+import os
 from transformers import AutoTokenizer, AutoModel
 import torch
 import torch.nn.functional as F
+from embedding_cache import MemoryEmbeddingCache
+from tracing import current_span, span
+
+logger = logging.getLogger(__name__)
+
+# Upper bound of sentences sent through the model at once
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))
+# "auto" (ONNX graph if exported, otherwise PyTorch), "onnx", "quantized" (Dynamic int8 PyTorch) or "torch"
+INFERENCE_ENGINE = os.environ.get("INFERENCE_ENGINE", "auto")
+# Intra-op threads of the engine, defaults to the number of CPUs of the endpoint
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", os.cpu_count() or 1))
+ONNX_MODEL_FILE = os.path.join("onnx", "model.onnx")
+# PyTorch weights, left out of the ONNX model artifacts by "scripts/build_model_artifact.py"
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")
+# Sentences whose vectors are kept in memory by the endpoint, so repeated ones skip the model ("0" to disable)
+EMBEDDING_CACHE_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_ENTRIES", 10000))
+
+# [NOTE] Keyed by the normalized sentence without lower-casing it, so it doesn't depend on the tokenizer being uncased
+embedding_cache = MemoryEmbeddingCache(EMBEDDING_CACHE_ENTRIES, lowercase=False) if EMBEDDING_CACHE_ENTRIES > 0 else None
 
 # Helper: Mean Pooling - Take attention mask into account for correct averaging
 def mean_pooling(model_output, attention_mask):
@@ -9,29 +30,118 @@ def mean_pooling(model_output, attention_mask):
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
 
+class OnnxModel:
+    # Run an exported ONNX graph with ONNX Runtime, called like the PyTorch model so pooling stays the same
+    def __init__(self, path, threads=INFERENCE_THREADS):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def __call__(self, **encoded_input):
+        inputs = {name: encoded_input[name].numpy() for name in self.input_names if name in encoded_input}
+        last_hidden_state = self.session.run(None, inputs)[0]
+        return (torch.from_numpy(last_hidden_state),)
+
+
+def load_engine(model_dir, engine=INFERENCE_ENGINE, threads=INFERENCE_THREADS):
+    # Fall back to the PyTorch model when the ONNX graph or ONNX Runtime is missing, if its weights are there
+    onnx_path = os.path.join(model_dir, ONNX_MODEL_FILE)
+    has_weights = any(os.path.exists(os.path.join(model_dir, name)) for name in WEIGHT_FILES)
+    if engine in ("auto", "onnx"):
+        if os.path.exists(onnx_path):
+            try:
+                return OnnxModel(onnx_path, threads=threads)
+            except ImportError as error:
+                if not has_weights:
+                    raise ImportError(f"onnxruntime is not installed and {model_dir} has no PyTorch weights "
+                                      f"({', '.join(WEIGHT_FILES)}) to fall back to") from error
+                logger.warning("onnxruntime is not installed, fall back to PyTorch")
+        elif engine == "onnx":
+            logger.warning(f"{onnx_path} is missing, fall back to PyTorch")
+    if not has_weights:
+        raise FileNotFoundError(f"No PyTorch weights ({', '.join(WEIGHT_FILES)}) in {model_dir}")
+
+    torch.set_num_threads(threads)
+    model = AutoModel.from_pretrained(model_dir)
+    model.eval()
+    if engine == "quantized":
+        # Dynamic int8 quantization of the Linear layers, weights are quantized once at load time
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+@span('model_fn')
 def model_fn(model_dir):
     # Load model from HuggingFace Hub
     tokenizer = AutoTokenizer.from_pretrained(model_dir)
-    model = AutoModel.from_pretrained(model_dir)
+    model = load_engine(model_dir)
     return model, tokenizer
 
+def embed(sentences, model, tokenizer, batch_size=MAX_BATCH_SIZE):
+    # Tokenize once without padding, so the sentences can be bucketed by their token length
+    with span("tokenize") as current:
+        encoded_input = tokenizer(sentences, truncation=True)
+        lengths = [len(input_ids) for input_ids in encoded_input["input_ids"]]
+        current.add(sentences=len(sentences), tokens=sum(lengths))
+    order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+
+    sentence_embeddings = None
+    with torch.no_grad():
+        # Run micro-batches of similar lengths, each one is only padded to its own longest sentence
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            with span("pad"):
+                features = [{key: encoded_input[key][i] for key in encoded_input.keys()} for i in indices]
+                batch = tokenizer.pad(features, padding=True, return_tensors='pt')
+
+            # Compute token embeddings
+            with span("forward") as current:
+                model_output = model(**batch)
+                current.add(padded_tokens=batch['input_ids'].numel())
+
+            # Perform pooling
+            with span("pool"):
+                embeddings = mean_pooling(model_output, batch['attention_mask'])
+
+                # Normalize embeddings
+                embeddings = F.normalize(embeddings, p=2, dim=1)
+
+            # Put the results back in the original order of the inputs
+            if sentence_embeddings is None:
+                sentence_embeddings = embeddings.new_empty((len(sentences), embeddings.shape[1]))
+            sentence_embeddings[torch.tensor(indices)] = embeddings
+
+    return sentence_embeddings
+
+@span('inference')
 def predict_fn(data, model_and_tokenizer):
     # destruct model and tokenizer
     model, tokenizer = model_and_tokenizer
-    
-    # Tokenize sentences
-    sentences = data.pop("inputs", data)
-    encoded_input = tokenizer(sentences, padding=True, truncation=True, return_tensors='pt')
 
-    # Compute token embeddings
-    with torch.no_grad():
-        model_output = model(**encoded_input)
+    # A single sentence returns a single vector, a list of sentences returns one vector per sentence
+    sentences = data.pop("inputs", data)
+    single = isinstance(sentences, str)
+    if single:
+        sentences = [sentences]
+    if not sentences:
+        return {"vectors": []}
+    batch_size = min(int(data.pop("batch_size", MAX_BATCH_SIZE)), MAX_BATCH_SIZE)
 
-    # Perform pooling
-    sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+    # Only the sentences missing from the cache go through the model
+    vectors = embedding_cache.get_many(sentences) if embedding_cache is not None else [None] * len(sentences)
+    misses = [i for i, vector in enumerate(vectors) if vector is None]
+    current_span().add(cache_hits=len(sentences) - len(misses))
+    if misses:
+        sentence_embeddings = embed([sentences[i] for i in misses], model, tokenizer, batch_size=batch_size)
 
-    # Normalize embeddings
-    sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
-    
-    # return dictonary, which will be json serializable
-    return {"vectors": sentence_embeddings[0].tolist()}
+        # return dictonary, which will be json serializable
+        computed = sentence_embeddings.tolist()
+        for i, vector in zip(misses, computed):
+            vectors[i] = vector
+        if embedding_cache is not None:
+            embedding_cache.put_many([sentences[i] for i in misses], computed)
+    return {"vectors": vectors[0] if single else vectors}
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Compare the inference engines of the custom inference script on CPU: cosine similarity of their vectors
+# against the float32 PyTorch model (should stay above ~0.99 to keep search results the same) and latency.
+#
+# Export the ONNX graph first (see "export_onnx.py"), then execute at the root directory of this project:
+#   python ./scripts/benchmark_engines.py --model-dir ./assets/all-MiniLM-L6-v2 --dataset ./assets/nintendo_switch_games.csv
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "model", "code"))
+from inference import ONNX_MODEL_FILE, embed, load_engine  # noqa: E402
+from benchmark_inference import load_sentences  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+ENGINES = ("torch", "quantized", "onnx")
+
+
+def measure(model, tokenizer, sentences, batch_size, repeat):
+    latencies = []
+    for _ in range(repeat):
+        for i in range(0, len(sentences), batch_size):
+            start = time.perf_counter()
+            embed(sentences[i:i + batch_size], model, tokenizer, batch_size=batch_size)
+            latencies.append(time.perf_counter() - start)
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare parity and latency of the inference engines on CPU")
+    parser.add_argument("--model-dir", default="./assets/all-MiniLM-L6-v2")
+    parser.add_argument("--dataset", help="CSV file with a 'description' column, synthetic sentences are used if omitted")
+    parser.add_argument("--sentences", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32])
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+    sentences = load_sentences(args.dataset, args.sentences)
+    reference = None
+
+    print(f"{'engine':<12}{'min cos':>10}{'mean cos':>10}" + "".join(f"{'p50/p99 ms @' + str(b):>22}" for b in args.batch_sizes)
+          + f"  (threads={args.threads})")
+    for engine in ENGINES:
+        if engine == "onnx" and not os.path.exists(os.path.join(args.model_dir, ONNX_MODEL_FILE)):
+            print(f"{engine:<12}  skipped, {ONNX_MODEL_FILE} is missing")
+            continue
+        model = load_engine(args.model_dir, engine=engine, threads=args.threads)
+        vectors = embed(sentences, model, tokenizer).numpy()
+        if reference is None:
+            reference = vectors
+        similarities = np.sum(vectors * reference, axis=1)  # Both are normalized
+        embed(sentences[:8], model, tokenizer)  # Warm up
+        latencies = [measure(model, tokenizer, sentences, batch_size, args.repeat) for batch_size in args.batch_sizes]
+        print(f"{engine:<12}{similarities.min():>10.4f}{similarities.mean():>10.4f}"
+              + "".join(f"{f'{p50:.1f}/{p99:.1f}':>22}" for p50, p99 in latencies))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Benchmark the CPU throughput (sentences/sec) of the custom inference script for different batch sizes.
+#
+# Clone the model first, for example:
+#   git clone https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2 ./assets/all-MiniLM-L6-v2
+# Then execute at the root directory of this project:
+#   python ./scripts/benchmark_inference.py --model-dir ./assets/all-MiniLM-L6-v2 --dataset ./assets/nintendo_switch_games.csv
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "model", "code"))
+import inference  # noqa: E402
+from inference import model_fn, predict_fn  # noqa: E402
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def load_sentences(path, count, seed=42):
+    rng = random.Random(seed)
+    if path:
+        with open(path, newline="") as file:
+            sentences = [row["description"] for row in csv.DictReader(file) if row.get("description")]
+    else:
+        words = "a platform game with a pink character who can fly and fight in a large open world".split()
+        sentences = [" ".join(rng.choices(words, k=rng.randint(5, 200))) for _ in range(count)]
+    rng.shuffle(sentences)
+    return sentences[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sentences/sec of predict_fn on CPU")
+    parser.add_argument("--model-dir", default="./assets/all-MiniLM-L6-v2")
+    parser.add_argument("--dataset", help="CSV file with a 'description' column, synthetic sentences are used if omitted")
+    parser.add_argument("--sentences", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    inference.MAX_BATCH_SIZE = max(BATCH_SIZES)  # Let every request run as a single micro-batch
+    inference.embedding_cache = None  # Every batch size embeds the same sentences, measure the model only
+    model_and_tokenizer = model_fn(args.model_dir)
+    sentences = load_sentences(args.dataset, args.sentences)
+
+    # Warm up
+    predict_fn({"inputs": sentences[:8]}, model_and_tokenizer)
+
+    print(f"{'batch size':>10}{'seconds':>10}{'sentences/sec':>16}  (threads={args.threads}, sentences={len(sentences)})")
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        # One request per batch, as a client packing "batch_size" descriptions per request would send them
+        for i in range(0, len(sentences), batch_size):
+            predict_fn({"inputs": sentences[i:i + batch_size], "batch_size": batch_size}, model_and_tokenizer)
+        seconds = time.perf_counter() - start
+        print(f"{batch_size:>10}{seconds:>10.2f}{len(sentences) / seconds:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
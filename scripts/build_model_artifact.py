@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Build the model archive ("model.tar.gz") deployed to the SageMaker endpoint with only the files "model_fn()" loads:
+#   - torch:     config, tokenizer and the safetensors weights (falls back to "pytorch_model.bin" if missing)
+#   - onnx:      config, tokenizer and an ONNX graph exported from the weights (see "export_onnx.py")
+#   - onnx-int8: same as "onnx", with the graph int8-quantized
+# The inference code is packed under "code/", and a manifest with the SHA-256 checksum of every file is written
+# into the archive and next to it. With "--compare", the full repository is packed as well (as "get_assets.sh" used
+# to do), and the size and load time (extract + "model_fn()" + first prediction) of both archives are reported.
+#
+# Execute at the root directory of this project, for example:
+#   python ./scripts/build_model_artifact.py --engine torch --compare
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "model", "code")
+sys.path.insert(0, CODE_DIR)
+
+REPO = "sentence-transformers/all-MiniLM-L6-v2"
+CONFIG_FILES = ("config.json",)
+TOKENIZER_FILES = ("tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "vocab.txt")
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")  # In order of preference, only the first one found is kept
+ENGINES = ("torch", "onnx", "onnx-int8")
+MANIFEST_NAME = "manifest.json"
+# Installed by the SageMaker Hugging Face Inference Toolkit at startup, only packed with the ONNX engines
+ONNX_REQUIREMENTS = "onnxruntime==1.16.3\n"
+
+
+def sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(repo, revision, tmp_dir, full=False):
+    # Download only the files needed to build the artifact, or the whole repository (without .git) with "full"
+    from huggingface_hub import snapshot_download  # type: ignore
+    patterns = None if full else list(CONFIG_FILES + TOKENIZER_FILES + WEIGHT_FILES)
+    return snapshot_download(repo, revision=revision, allow_patterns=patterns,
+                             local_dir=os.path.join(tmp_dir, "full" if full else "slim"))
+
+
+def stage(source_dir, staging_dir, engine):
+    # Copy the files "model_fn()" loads into the staging directory
+    os.makedirs(staging_dir)
+    names = [name for name in CONFIG_FILES + TOKENIZER_FILES if os.path.exists(os.path.join(source_dir, name))]
+    weights = next((name for name in WEIGHT_FILES if os.path.exists(os.path.join(source_dir, name))), None)
+    if weights is None:
+        raise FileNotFoundError(f"No model weights ({', '.join(WEIGHT_FILES)}) in {source_dir}")
+    if engine == "torch":
+        names.append(weights)
+    for name in names:
+        shutil.copy2(os.path.join(source_dir, name), os.path.join(staging_dir, name))
+
+    if engine != "torch":
+        # [NOTE] The PyTorch weights are left out, so the endpoint needs onnxruntime to load the model and
+        # "load_engine" raises instead of falling back to PyTorch without it
+        from export_onnx import export
+        export(source_dir, quantize=(engine == "onnx-int8"), output_dir=staging_dir)
+
+    shutil.copytree(CODE_DIR, os.path.join(staging_dir, "code"), ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+    if engine != "torch":
+        with open(os.path.join(staging_dir, "code", "requirements.txt"), "w") as file:
+            file.write(ONNX_REQUIREMENTS)
+
+
+def write_manifest(staging_dir, repo, revision, engine):
+    files = {}
+    for root, _, filenames in os.walk(staging_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, staging_dir)
+            files[name] = {"size": os.path.getsize(path), "sha256": sha256(path)}
+    manifest = {"repo": repo, "revision": revision, "engine": engine, "files": dict(sorted(files.items()))}
+    with open(os.path.join(staging_dir, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def pack(staging_dir, output):
+    # Files are added at the top level of the archive, where SageMaker extracts them into /opt/ml/model
+    with tarfile.open(output, "w:gz") as archive:
+        for name in sorted(os.listdir(staging_dir)):
+            archive.add(os.path.join(staging_dir, name), arcname=name)
+    return output
+
+
+def measure_load(archive_path, tmp_dir):
+    # Time what a cold start does with the archive: extract it, load the model and make the first prediction
+    from inference import model_fn, predict_fn
+    model_dir = tempfile.mkdtemp(dir=tmp_dir)
+    start = time.perf_counter()
+    with tarfile.open(archive_path) as archive:
+        archive.extractall(model_dir)
+    extracted = time.perf_counter()
+    model_and_tokenizer = model_fn(model_dir)
+    loaded = time.perf_counter()
+    predict_fn({"inputs": "A platform game with a pink character"}, model_and_tokenizer)
+    predicted = time.perf_counter()
+    shutil.rmtree(model_dir)
+    return extracted - start, loaded - extracted, predicted - loaded
+
+
+def print_report(name, archive_path, tmp_dir):
+    extract, load, predict = measure_load(archive_path, tmp_dir)
+    size = os.path.getsize(archive_path) / 1024 / 1024
+    print(f"{name:<10}{size:>12.2f}{extract:>12.2f}{load:>12.2f}{predict:>12.2f}{extract + load + predict:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a slim model archive for the SageMaker endpoint")
+    parser.add_argument("--repo", default=REPO)
+    parser.add_argument("--revision", default="main")
+    parser.add_argument("--source-dir", help="Local model directory to pack instead of downloading the repository")
+    parser.add_argument("--engine", choices=ENGINES, default="torch")
+    parser.add_argument("--output", default="./assets/model.tar.gz")
+    parser.add_argument("--compare", action="store_true", help="Also pack the full repository, then compare both archives")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = args.source_dir or download(args.repo, args.revision, tmp_dir)
+        staging_dir = os.path.join(tmp_dir, "staging")
+        stage(source_dir, staging_dir, args.engine)
+        manifest = write_manifest(staging_dir, args.source_dir or args.repo, args.revision, args.engine)
+        pack(staging_dir, args.output)
+        manifest["archive"] = {"name": os.path.basename(args.output), "size": os.path.getsize(args.output), "sha256": sha256(args.output)}
+        with open(os.path.splitext(os.path.splitext(args.output)[0])[0] + ".manifest.json", "w") as file:
+            json.dump(manifest, file, indent=2)
+        print(f"Packed {len(manifest['files'])} files into {args.output}")
+        for name, entry in manifest["files"].items():
+            print(f"{entry['size'] / 1024 / 1024:>10.2f} MiB  {name}")
+
+        if args.compare:
+            # The full repository with the inference code, as packed by "tar zcvf ./model.tar.gz *" before
+            full_dir = args.source_dir or download(args.repo, args.revision, tmp_dir, full=True)
+            baseline_dir = os.path.join(tmp_dir, "baseline")
+            shutil.copytree(full_dir, baseline_dir, ignore=shutil.ignore_patterns(".git", ".cache"))
+            shutil.copytree(CODE_DIR, os.path.join(baseline_dir, "code"), ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+            baseline = pack(baseline_dir, os.path.join(tmp_dir, "baseline.tar.gz"))
+            print(f"\n{'archive':<10}{'size MiB':>12}{'extract s':>12}{'load s':>12}{'predict s':>12}{'total s':>12}")
+            print_report("full", baseline, tmp_dir)
+            print_report("slim", args.output, tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
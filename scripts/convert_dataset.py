@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Convert the JSON dataset (a list of rows, each one ending with its embeddings) into the binary dataset
+# read by the import Lambda function: Parquet metadata plus a contiguous little-endian embeddings block.
+#
+# Execute at the root directory of this project, for example:
+#   python ./scripts/convert_dataset.py ./assets/nintendo_switch_games_mean_pooling.json
+import argparse
+import os
+import sys
+import time
+
+import ijson  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "lambda"))
+from dataset import MANIFEST_SUFFIX, DatasetWriter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the JSON dataset into the binary dataset format")
+    parser.add_argument("source", help="JSON dataset file")
+    parser.add_argument("--output", help="Base path of the output files, defaults to the source path without extension")
+    parser.add_argument("--dtype", choices=("float32", "float16"), default="float32")
+    parser.add_argument("--dim", type=int, default=384)
+    args = parser.parse_args()
+
+    base_path = args.output or os.path.splitext(args.source)[0]
+    start = time.perf_counter()
+    with open(args.source, "rb") as source, DatasetWriter(base_path, dim=args.dim, dtype=args.dtype) as writer:
+        for row in ijson.items(source, "item", use_float=True):
+            writer.write(row)
+    seconds = time.perf_counter() - start
+
+    sizes = {path: os.path.getsize(path) for path in (args.source, writer.metadata_path, writer.embeddings_path, base_path + MANIFEST_SUFFIX)}
+    print(f"Converted {writer.rows} rows in {seconds:.2f}s")
+    for path, size in sizes.items():
+        print(f"{size / 1024 / 1024:>10.2f} MiB  {path}")
+
+
+if __name__ == "__main__":
+    main()
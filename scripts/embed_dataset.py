@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Generate the embeddings dataset offline, without the model endpoint: the descriptions of the CSV dataset are
+# embedded by a pool of worker processes running "model_fn()"/"predict_fn()" of the inference script, and the rows
+# are written as they complete, in the JSON dataset format (or the binary one) imported by the Lambda function.
+#
+# Every worker loads its own copy of the model with a pinned number of torch threads, and the descriptions are sent
+# in requests of "--batch-size" rows in the CSV order, the same requests the notebook sends to the endpoint, so the
+# vectors are the same as the endpoint's. "--compare" checks it against a single process with the endpoint's
+# threads, and "--sweep" reports the throughput for different numbers of cores.
+#
+# Clone the model first, for example:
+#   git clone https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2 ./assets/all-MiniLM-L6-v2
+# Then execute at the root directory of this project:
+#   python ./scripts/embed_dataset.py ./assets/nintendo_switch_games.csv --model-dir ./assets/all-MiniLM-L6-v2
+#   python ./scripts/embed_dataset.py ./assets/nintendo_switch_games.csv --sweep
+import argparse
+import collections
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+MODEL_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "model", "code")
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lambda")
+sys.path.insert(0, LAMBDA_DIR)
+from loader import DATASET_COLUMNS  # noqa: E402
+
+# Same request size as the notebook's "EmbeddingClient" and "MAX_BATCH_SIZE" of the inference script
+DEFAULT_BATCH_SIZE = 32
+SWEEP_ROWS = 512
+DESCRIPTION = DATASET_COLUMNS.index("description")
+
+# Model and tokenizer of a worker process, loaded once by "_init_worker()"
+_model_and_tokenizer = None
+
+
+def _init_worker(model_dir, threads):
+    # Pin the threads before torch is imported, "INFERENCE_THREADS" is read when the inference script is imported
+    global _model_and_tokenizer
+    for name in ("INFERENCE_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ["EMBEDDING_CACHE_ENTRIES"] = "0"  # Every description is embedded by the model, as for a cold endpoint
+    sys.path.insert(0, MODEL_CODE_DIR)
+    import torch
+    from inference import model_fn
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _model_and_tokenizer = model_fn(model_dir)
+
+
+def _embed(descriptions):
+    # One request, as the endpoint would get it
+    from inference import predict_fn
+    return predict_fn({"inputs": descriptions}, _model_and_tokenizer)["vectors"]
+
+
+def read_rows(path, limit=None):
+    # Stream the dataset rows of the CSV file without their embeddings, empty fields become null as pandas reads them
+    with open(path, newline="") as file:
+        for row in itertools.islice(csv.DictReader(file), limit):
+            fields = [row.get(column) or None for column in DATASET_COLUMNS[:-1]]
+            fields[0] = int(fields[0])
+            yield fields
+
+
+def batched(rows, batch_size):
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+class JsonDatasetWriter:
+    # Write the JSON dataset (a list of rows, each one ending with its embeddings) row by row, into a temporary
+    # file renamed when it is complete so an interrupted run never leaves a truncated dataset behind
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._temp_path = path + ".tmp"
+        self._file = open(self._temp_path, "w")
+        self._file.write("[")
+
+    def write(self, row):
+        self._file.write(("\n" if self.rows == 0 else ",\n") + json.dumps(row))
+        self.rows += 1
+
+    def close(self):
+        self._file.write("\n]\n")
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+class EmbeddingPool:
+    # "workers" processes of "threads" torch threads each, embedding batches in the order they are submitted.
+    # At most "max_pending" batches are in flight, so the CSV is read only as fast as the rows are embedded.
+    def __init__(self, model_dir, workers, threads, max_pending=None):
+        self.workers = workers
+        self.threads = threads
+        self.max_pending = max_pending or workers * 2
+        # "spawn", torch isn't fork-safe and every worker has to import it after pinning its threads
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker, initargs=(model_dir, threads))
+
+    def warm_up(self):
+        # Start every worker and load its model, so the model load isn't part of the measured throughput
+        list(self.executor.map(_embed, [["warm up"]] * self.workers))
+
+    def embed(self, batches):
+        # Yield "(batch, vectors)" in the submission order
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, self.executor.submit(_embed, [fields[DESCRIPTION] or "" for fields in batch])))
+            if len(pending) >= self.max_pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f"EmbeddingPool(workers={self.workers}, threads={self.threads})"
+
+
+def generate(args, output):
+    if args.format == "binary":
+        from dataset import DatasetWriter
+        writer = DatasetWriter(output, dim=args.dim, dtype=args.dtype)
+    else:
+        writer = JsonDatasetWriter(output)
+    with EmbeddingPool(args.model_dir, args.workers, args.threads) as pool, writer:
+        pool.warm_up()
+        start = time.perf_counter()
+        for batch, vectors in pool.embed(batched(read_rows(args.source, args.limit), args.batch_size)):
+            for fields, vector in zip(batch, vectors):
+                writer.write([*fields, vector])
+            if args.progress and writer.rows % (args.batch_size * 10) < args.batch_size:
+                print(f"{writer.rows} rows, {writer.rows / (time.perf_counter() - start):.1f} rows/sec", file=sys.stderr)
+        seconds = time.perf_counter() - start
+    cores = args.workers * args.threads
+    print(f"Embedded {writer.rows} rows into {output} in {seconds:.2f}s with {args.workers} workers x {args.threads} threads: "
+          f"{writer.rows / seconds:.1f} rows/sec, {writer.rows / seconds / cores:.1f} rows/sec per core")
+
+
+def compare(args):
+    # Embed the first rows with the pool and with one process configured as the endpoint (all the CPUs, default
+    # threads), in the same requests, and count the vectors which differ
+    rows = list(read_rows(args.source, args.compare))
+    batches = list(batched(rows, args.batch_size))
+    with EmbeddingPool(args.model_dir, args.workers, args.threads) as pool:
+        vectors = [vector for _, batch_vectors in pool.embed(batches) for vector in batch_vectors]
+    with EmbeddingPool(args.model_dir, 1, os.cpu_count() or 1) as endpoint:
+        expected = [vector for _, batch_vectors in endpoint.embed(batches) for vector in batch_vectors]
+    different = sum(vector != reference for vector, reference in zip(vectors, expected))
+    max_difference = max((abs(a - b) for vector, reference in zip(vectors, expected) for a, b in zip(vector, reference)), default=0.0)
+    print(f"Compared {len(rows)} rows: {len(rows) - different} identical, {different} different, max abs difference {max_difference:.3g}")
+    return different == 0
+
+
+def sweep(args):
+    # Throughput of the same rows for every split of 1, 2, 4, ... cores into worker processes and torch threads
+    cpus = os.cpu_count() or 1
+    core_counts = sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    batches = list(batched(read_rows(args.source, args.limit or SWEEP_ROWS), args.batch_size))
+    rows = sum(len(batch) for batch in batches)
+    print(f"{'cores':>6}{'workers':>9}{'threads':>9}{'seconds':>10}{'rows/sec':>10}{'per core':>10}{'speedup':>9}  (rows={rows})")
+    baseline = None
+    for cores in core_counts:
+        for workers in sorted({cores, 1}, reverse=True):
+            threads = cores // workers
+            with EmbeddingPool(args.model_dir, workers, threads) as pool:
+                pool.warm_up()
+                start = time.perf_counter()
+                for _ in pool.embed(batches):
+                    pass
+                seconds = time.perf_counter() - start
+            throughput = rows / seconds
+            baseline = baseline or throughput
+            print(f"{cores:>6}{workers:>9}{threads:>9}{seconds:>10.2f}{throughput:>10.1f}{throughput / cores:>10.1f}{throughput / baseline:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed the CSV dataset with a pool of local worker processes")
+    parser.add_argument("source", help="CSV dataset file")
+    parser.add_argument("--output", help="Output path, defaults to <source>_mean_pooling.json (a base path for --format binary)")
+    parser.add_argument("--format", choices=("json", "binary"), default="json")
+    parser.add_argument("--dtype", choices=("float32", "float16"), default="float32", help="Embeddings type of --format binary")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--model-dir", default="./assets/all-MiniLM-L6-v2")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads of every worker")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Descriptions per request")
+    parser.add_argument("--limit", type=int, help="Only embed the first rows")
+    parser.add_argument("--progress", action="store_true")
+    parser.add_argument("--compare", type=int, metavar="ROWS", help="Check the vectors of the first rows against the endpoint's configuration")
+    parser.add_argument("--sweep", action="store_true", help="Report the throughput per number of cores instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(0 if compare(args) else 1)
+    if args.sweep:
+        sweep(args)
+        return
+    base_path = os.path.splitext(args.source)[0] + "_mean_pooling"
+    generate(args, args.output or (base_path + ".json" if args.format == "json" else base_path))
+
+
+if __name__ == "__main__":
+    main()
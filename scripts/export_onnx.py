@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Export the model into an ONNX graph loaded by "model_fn()" (INFERENCE_ENGINE=auto/onnx), optionally int8-quantized.
+#
+# Execute at the root directory of this project, for example:
+#   python ./scripts/export_onnx.py --model-dir ./assets/all-MiniLM-L6-v2 --quantize
+import argparse
+import inspect
+import os
+import sys
+
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "model", "code"))
+from inference import ONNX_MODEL_FILE  # noqa: E402
+
+
+class Encoder(torch.nn.Module):
+    # Take the inputs positionally and return only the last hidden state, which "mean_pooling()" reads
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs)))[0]
+
+
+def export(model_dir, quantize=False, opset=14, output_dir=None):
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModel.from_pretrained(model_dir)
+    model.eval()
+
+    path = os.path.join(output_dir or model_dir, ONNX_MODEL_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fp32_path = path.replace(".onnx", "_fp32.onnx") if quantize else path
+
+    sample = tokenizer(["An example sentence", "Another, a bit longer, example sentence"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    # [NOTE] torch >= 2.5 has a "dynamo" exporter (the default since 2.9) which doesn't take "dynamic_axes",
+    # keep the TorchScript one. Older versions don't have the keyword and only have the TorchScript exporter.
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(model, input_names),
+            tuple(sample[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            **options,
+        )
+
+    if quantize:
+        # Dynamic int8 quantization of the weights, activations are quantized on the fly
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the model into an ONNX graph")
+    parser.add_argument("--model-dir", default="./assets/all-MiniLM-L6-v2")
+    parser.add_argument("--quantize", action="store_true", help="Quantize the weights into int8")
+    parser.add_argument("--opset", type=int, default=14)
+    args = parser.parse_args()
+
+    path = export(args.model_dir, quantize=args.quantize, opset=args.opset)
+    print(f"Exported {path} ({os.path.getsize(path) / 1024 / 1024:.2f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,22 +11,29 @@ cd ./assets
 
 echo "[INFO] Part 1: Archive Model"
 
-echo "[INFO] Cloning repo from https://huggingface.co/$REPO"
-git clone https://huggingface.co/$REPO
+if python3 -c "import huggingface_hub, transformers, torch" 2>/dev/null; then
+  echo "[INFO] Building a slim model archive with the files the inference script loads"
+  python3 ../scripts/build_model_artifact.py --repo $REPO --output ./model.tar.gz
+else
+  echo "[WARN] huggingface_hub, transformers or torch is not installed, pack the whole repository instead"
 
-echo "[INFO] Changing current directory to $MODEL_ID"
-cd ./$MODEL_ID
+  echo "[INFO] Cloning repo from https://huggingface.co/$REPO"
+  git clone https://huggingface.co/$REPO
 
-echo "[INFO] Moving inference script"
-cp -r ../../model/code ./
+  echo "[INFO] Changing current directory to $MODEL_ID"
+  cd ./$MODEL_ID
 
-echo "[INFO] Packing model"
-tar zcvf ./model.tar.gz *
+  echo "[INFO] Moving inference script"
+  cp -r ../../model/code ./
 
-echo "[INFO] Moving model archive to parent directory and removing repository directory"
-mv ./model.tar.gz ../model.tar.gz
-cd ..
-rm -rf ./$MODEL_ID
+  echo "[INFO] Packing model"
+  tar zcvf ./model.tar.gz *
+
+  echo "[INFO] Moving model archive to parent directory and removing repository directory"
+  mv ./model.tar.gz ../model.tar.gz
+  cd ..
+  rm -rf ./$MODEL_ID
+fi
 
 echo "[INFO] Part 1 Finished. Browse ./asset/model.tar.gz to get the model archive"
 
@@ -39,6 +46,13 @@ echo "[INFO] Moving IGDB data files to parent directory, then remove the reposit
 mv ./igdb-data-examples/*.csv ./igdb-data-examples/*.json ./
 rm -rf ./igdb-data-examples
 
+echo "[INFO] Converting the embeddings dataset into the binary dataset format"
+if python3 -c "import ijson, numpy, pyarrow" 2>/dev/null; then
+  python3 ../scripts/convert_dataset.py ./nintendo_switch_games_mean_pooling.json
+else
+  echo "[WARN] ijson, numpy or pyarrow is not installed, skip. The Lambda function will import the JSON dataset instead"
+fi
+
 echo "[INFO] Part 2 Finished."
 
 echo "[INFO] All Processes Finished."
\ No newline at end of file
@@ -6,6 +6,8 @@ from aws_cdk import (
     aws_lambda as lambda_,
     aws_ec2 as ec2,
     aws_logs as logs,
+    aws_iam as iam,
+    ArnFormat,
     Duration,
     triggers,
     CfnOutput,
@@ -56,6 +58,13 @@ class LambdaStack(NestedStack):
 
         bucket.grant_read(function.role)
         db_secret.grant_read(function.role)
+
+        # Let the function invoke itself to continue or fan out a "sharded" import.
+        # [NOTE] Matched by name, since referencing the function's ARN in its own role makes a circular dependency
+        function.add_to_role_policy(iam.PolicyStatement(
+            actions=["lambda:InvokeFunction"],
+            resources=[self.format_arn(service="lambda", resource="function", resource_name="*DataImportLambdaFunction*", arn_format=ArnFormat.COLON_RESOURCE_NAME)],
+            ))
         
         triggers.Trigger(
             self, "DataImportLambdaFunctionTrigger",
@@ -61,6 +61,14 @@ class VPCStack(NestedStack):
             security_groups=[self.sg_vpce],
         )
 
+        # Interface VPC Endpoint for Lambda Function to invoke itself, continuing a "sharded" import
+        self.vpc.add_interface_endpoint(
+            "LambdaInterfaceVPCEndpoint",
+            service=ec2.InterfaceVpcEndpointAwsService.LAMBDA,
+            subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_ISOLATED),
+            security_groups=[self.sg_vpce],
+        )
+
         # Gateway VPC Endpoint for Lambda Function to access S3
         self.vpc.add_gateway_endpoint(
             "S3GatewayVPCEndpoint",
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("pyarrow")
+
+from dataset import MANIFEST_SUFFIX, DatasetWriter, iter_rows, read_manifest  # noqa: E402
+
+
+def test_round_trip(tmp_path):
+    base_path = str(tmp_path / "games")
+    rows = dataset_rows(25)
+    with DatasetWriter(base_path, row_group_size=10) as writer:
+        for row in rows:
+            writer.write(row)
+    assert read_manifest(base_path + MANIFEST_SUFFIX)["rows"] == 25
+    read = list(iter_rows(base_path + MANIFEST_SUFFIX, batch_size=7))
+    assert [row[:-1] for row in read] == [row[:-1] for row in rows]
+    np.testing.assert_array_equal(np.stack([row[-1] for row in read]), np.asarray([row[-1] for row in rows], dtype="<f4"))
+
+
+def test_failed_conversion_writes_no_manifest(tmp_path):
+    # A truncated dataset must not look complete, incremental imports would delete the missing games
+    base_path = str(tmp_path / "games")
+    with DatasetWriter(base_path) as writer:
+        for row in dataset_rows(5):
+            writer.write(row)
+    with pytest.raises(ValueError):
+        with DatasetWriter(base_path, row_group_size=10) as writer:
+            for row in dataset_rows(25):
+                writer.write(row)
+            writer.write([26, "Game 26", "", "", "", "", "", [0.0] * 3])
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,102 @@
+import filecmp
+import os
+import pytest
+from conftest import MODEL_CODE_DIR, ROOT
+
+from igdb.embedding_cache import EmbeddingCache, MemoryEmbeddingCache
+
+
+def test_endpoint_copy_matches():
+    # "model/code/embedding_cache.py" is a copy of "igdb/embedding_cache.py" packed with the inference script
+    assert filecmp.cmp(os.path.join(ROOT, "igdb", "embedding_cache.py"), os.path.join(MODEL_CODE_DIR, "embedding_cache.py"), shallow=False)
+
+
+def vector(i):
+    return [float(i), 0.5, -1.0]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=5)
+    yield cache
+    cache.close()
+
+
+def test_round_trip_and_normalization(cache):
+    cache.put("A  platform\tgame", vector(1))
+    assert cache.get("A platform game") == vector(1)
+    assert cache.get("a platform game") is None  # The persistent cache is case sensitive
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evicts_least_recently_used(cache):
+    cache.put_many([f"game {i}" for i in range(5)], [vector(i) for i in range(5)])
+    cache.get("game 0")  # Used again, "game 1" is now the least recently used
+    cache.put_many(["game 5", "game 6"], [vector(5), vector(6)])
+    assert len(cache) == 5
+    assert cache.evictions == 2
+    assert cache.get_many(["game 0", "game 1", "game 2", "game 6"]) == [vector(0), None, None, vector(6)]
+
+
+def test_count_tracks_replaced_and_duplicate_keys(cache):
+    cache.put_many(["game 1", "game 2", "game 2"], [vector(1), vector(2), vector(2)])
+    cache.put_many(["game 1", "game 3"], [vector(10), vector(3)])
+    assert len(cache) == 3
+    assert cache._conn.execute("SELECT count(*) FROM embeddings;").fetchone()[0] == 3
+    assert cache.get("game 1") == vector(10)
+
+
+def test_put_does_not_scan_the_table(cache):
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    cache.put_many([f"game {i}" for i in range(8)], [vector(i) for i in range(8)])
+    assert not any(statement.startswith("SELECT count(*) FROM embeddings;") for statement in statements)
+    assert len(cache) == 5
+
+
+def test_count_is_read_again_when_reopened(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path)
+    cache.put_many(["game 1", "game 2"], [vector(1), vector(2)])
+    cache.close()
+    cache = EmbeddingCache(path, max_entries=1)
+    assert len(cache) == 2
+    cache.put("game 3", vector(3))
+    assert len(cache) == 1
+    cache.close()
+
+
+def test_memory_cache_lowercasing_is_optional():
+    cache = MemoryEmbeddingCache(max_entries=2)
+    cache.put("Super Mario", vector(1))
+    assert cache.get("super  mario") == vector(1)
+    exact = MemoryEmbeddingCache(max_entries=2, lowercase=False)
+    exact.put("Super Mario", vector(1))
+    assert exact.get("super mario") is None
+    assert exact.get("Super  Mario") == vector(1)
+
+
+def test_predict_fn_serves_repeated_sentences_from_the_cache(tiny_model_dir, monkeypatch):
+    monkeypatch.syspath_prepend(MODEL_CODE_DIR)
+    import inference
+    model_and_tokenizer = inference.model_fn(tiny_model_dir)
+    monkeypatch.setattr(inference, "embedding_cache", MemoryEmbeddingCache(16, lowercase=False))
+    calls = []
+    embed = inference.embed
+
+    def counting_embed(sentences, *args, **kwargs):
+        calls.append(list(sentences))
+        return embed(sentences, *args, **kwargs)
+
+    monkeypatch.setattr(inference, "embed", counting_embed)
+
+    first = inference.predict_fn({"inputs": ["a pink character", "a racing game"]}, model_and_tokenizer)["vectors"]
+    second = inference.predict_fn({"inputs": ["a racing game", "a puzzle game", "a pink character"]}, model_and_tokenizer)["vectors"]
+    assert calls == [["a pink character", "a racing game"], ["a puzzle game"]]
+    assert second[0] == first[1] and second[2] == first[0]
+    single = inference.predict_fn({"inputs": "a puzzle game"}, model_and_tokenizer)["vectors"]
+    assert single == second[1] and len(calls) == 2
+
+    monkeypatch.setattr(inference, "embedding_cache", None)
+    assert inference.predict_fn({"inputs": ["a racing game"]}, model_and_tokenizer)["vectors"] == [first[1]]
+    assert len(calls) == 3
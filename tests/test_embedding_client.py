@@ -0,0 +1,157 @@
+import json
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+from igdb.embedding_client import (EmbeddingClient, FakeTransport, HttpTransport, ThrottledError,
+                                   read_embeddings_file)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # "/throttle" answers 429, "/error" 500, any other path one vector per input: [length, 1.0]
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, self.headers["Content-Type"], payload))
+        status = {"/throttle": 429, "/error": 500}.get(self.path, 200)
+        body = json.dumps({"vectors": [[len(text), 1.0] for text in payload["inputs"]]}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path="/invocations"):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+class ThrottlingTransport:
+    # Wraps a transport and throttles its first "throttled" calls, or every call if None
+    def __init__(self, transport, throttled=None, failing_after=None):
+        self.transport = transport
+        self.throttled = throttled
+        self.failing_after = failing_after  # Fail with a non-throttling error after this many successful calls
+        self.calls = 0
+        self.succeeded = 0
+        self.batch_sizes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, payload):
+        with self._lock:
+            self.calls += 1
+            if self.throttled is None or self.calls <= self.throttled:
+                raise ThrottledError("Rate exceeded")
+            if self.failing_after is not None and self.succeeded >= self.failing_after:
+                raise RuntimeError("endpoint failed")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self.transport(payload)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.succeeded += 1
+                self.batch_sizes.append(len(payload["inputs"]))
+
+
+def test_http_transport_posts_json(server):
+    response = HttpTransport(url(server))({"inputs": ["a", "abc"]})
+    assert response == {"vectors": [[1, 1.0], [3, 1.0]]}
+    assert server.requests == [("/invocations", "application/json", {"inputs": ["a", "abc"]})]
+
+
+def test_http_transport_raises_throttled_error_on_429(server):
+    with pytest.raises(ThrottledError):
+        HttpTransport(url(server, "/throttle"))({"inputs": ["a"]})
+
+
+def test_http_transport_raises_other_errors(server):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        HttpTransport(url(server, "/error"))({"inputs": ["a"]})
+    assert error.value.code == 500
+
+
+def test_client_over_http_transport(server):
+    client = EmbeddingClient(HttpTransport(url(server)), batch_size=4, max_concurrency=2)
+    texts = ["x" * n for n in range(1, 11)]
+    assert client.embed(texts) == [[n, 1.0] for n in range(1, 11)]
+    assert client.requests == 3
+
+
+def test_fake_transport_is_deterministic():
+    transport = FakeTransport(dim=8, latency=0, per_text_latency=0)
+    vectors = transport({"inputs": ["mario", "kirby", "mario"]})["vectors"]
+    assert vectors[0] == vectors[2] != vectors[1]
+    assert sum(value * value for value in vectors[0]) == pytest.approx(1.0)
+
+
+def test_throttled_requests_are_retried():
+    fake = FakeTransport(dim=8, latency=0, per_text_latency=0)
+    transport = ThrottlingTransport(fake, throttled=3)
+    client = EmbeddingClient(transport, batch_size=8, max_concurrency=1, base_delay=0.001, max_delay=0.01)
+    texts = [f"game {i}" for i in range(20)]
+    assert client.embed(texts) == [fake.vector(text) for text in texts]
+    assert client.retries == 3
+    assert client.requests == 3 + 3  # 3 throttled attempts, then 3 batches
+
+
+def test_retries_are_bounded():
+    transport = ThrottlingTransport(FakeTransport(dim=8, latency=0, per_text_latency=0))
+    client = EmbeddingClient(transport, max_retries=2, base_delay=0.001, max_delay=0.01)
+    with pytest.raises(ThrottledError):
+        client.embed(["mario"])
+    assert client.requests == 3
+
+
+def test_batches_and_concurrency_are_bounded():
+    transport = ThrottlingTransport(FakeTransport(dim=8, latency=0.02, per_text_latency=0), throttled=0)
+    client = EmbeddingClient(transport, batch_size=5, max_concurrency=3)
+    client.embed([f"game {i}" for i in range(47)])
+    assert sorted(transport.batch_sizes) == [2] + [5] * 9
+    assert 1 < transport.max_in_flight <= 3
+
+
+def test_embed_to_file_resumes_after_a_failure(tmp_path):
+    path = str(tmp_path / "embeddings.jsonl")
+    fake = FakeTransport(dim=8, latency=0, per_text_latency=0)
+    texts = [f"game {i}" for i in range(30)]
+    keys = list(range(100, 130))
+
+    # The endpoint fails after 2 batches, the completed ones are already on disk
+    client = EmbeddingClient(ThrottlingTransport(fake, throttled=0, failing_after=2), batch_size=5, max_concurrency=1)
+    with pytest.raises(RuntimeError):
+        client.embed_to_file(texts, path, keys=keys)
+    done = read_embeddings_file(path)
+    assert len(done) == 10
+
+    # The resumed run only embeds the missing texts
+    missing = [i for i, key in enumerate(keys) if key not in done]
+    client = EmbeddingClient(fake, batch_size=5, max_concurrency=1)
+    assert client.embed_to_file([texts[i] for i in missing], path, keys=[keys[i] for i in missing]) == 20
+    assert client.requests == 4
+    assert read_embeddings_file(path) == {key: fake.vector(text) for key, text in zip(keys, texts)}
+
+
+def test_read_embeddings_file_truncates_a_partial_line(tmp_path):
+    path = tmp_path / "embeddings.jsonl"
+    path.write_text('{"key": 1, "vector": [1.0]}\n{"key": 2, "vector": [2.0]}\n{"key": 3, "vec')
+    assert read_embeddings_file(str(path)) == {1: [1.0], 2: [2.0]}
+    assert path.read_text() == '{"key": 1, "vector": [1.0]}\n{"key": 2, "vector": [2.0]}\n'
+    assert read_embeddings_file(str(tmp_path / "missing.jsonl")) == {}
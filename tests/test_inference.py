@@ -0,0 +1,137 @@
+import builtins
+import logging
+import os
+import shutil
+import sys
+import numpy as np
+import pytest
+from conftest import MODEL_CODE_DIR, ROOT
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, MODEL_CODE_DIR)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+from inference import ONNX_MODEL_FILE, WEIGHT_FILES, OnnxModel, embed, load_engine  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+# Minimum cosine similarity to the float32 PyTorch vectors, same bar as "scripts/benchmark_engines.py"
+MIN_COSINE = 0.99
+
+SENTENCES = [
+    "a platform game",
+    "a pink character who can fly",
+    "a racing game in a large open world",
+    "the red hat character can fight and fly in the open world",
+    "puzzle",
+    "an open world game with a character who can fight in a large world with racing and puzzle",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tiny_model_dir):
+    return AutoTokenizer.from_pretrained(tiny_model_dir)
+
+
+@pytest.fixture(scope="module")
+def reference(tiny_model_dir, tokenizer):
+    return embed(SENTENCES, load_engine(tiny_model_dir, engine="torch", threads=1), tokenizer).numpy()
+
+
+@pytest.fixture(scope="module")
+def onnx_model_dir(tiny_model_dir, tmp_path_factory):
+    pytest.importorskip("onnx")
+    from export_onnx import export
+    path = tmp_path_factory.mktemp("tiny-bert-onnx") / "model"
+    shutil.copytree(tiny_model_dir, path)
+    export(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def onnx_only_model_dir(onnx_model_dir, tmp_path):
+    # Like the ONNX model artifacts, without the PyTorch weights
+    path = tmp_path / "model"
+    shutil.copytree(onnx_model_dir, path, ignore=shutil.ignore_patterns(*WEIGHT_FILES))
+    return str(path)
+
+
+def block_import(monkeypatch, blocked):
+    real_import = builtins.__import__
+
+    def fake_import(name, *args, **kwargs):
+        if name == blocked or name.startswith(blocked + "."):
+            raise ImportError(f"No module named '{blocked}'")
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", fake_import)
+
+
+def cosine(vectors, reference):
+    return np.sum(vectors * reference, axis=1)  # Both are normalized
+
+
+def test_quantized_engine_parity(tiny_model_dir, tokenizer, reference):
+    model = load_engine(tiny_model_dir, engine="quantized", threads=1)
+    vectors = embed(SENTENCES, model, tokenizer).numpy()
+    assert cosine(vectors, reference).min() >= MIN_COSINE
+
+
+def test_export_without_the_dynamo_keyword(tiny_model_dir, tmp_path, monkeypatch):
+    # torch < 2.5 has no "dynamo" keyword in "torch.onnx.export()"
+    pytest.importorskip("onnx")
+    from export_onnx import export
+    real_export = torch.onnx.export
+
+    def legacy_export(model, args, f, input_names=None, output_names=None, dynamic_axes=None, opset_version=None):
+        return real_export(model, args, f, input_names=input_names, output_names=output_names,
+                           dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+
+    monkeypatch.setattr(torch.onnx, "export", legacy_export)
+    assert os.path.exists(export(tiny_model_dir, output_dir=str(tmp_path)))
+
+
+def test_onnx_engine_parity(onnx_model_dir, tokenizer, reference):
+    pytest.importorskip("onnxruntime")
+    model = load_engine(onnx_model_dir, engine="onnx", threads=1)
+    assert isinstance(model, OnnxModel)
+    vectors = embed(SENTENCES, model, tokenizer).numpy()
+    assert cosine(vectors, reference).min() >= MIN_COSINE
+
+
+def test_auto_engine_picks_the_onnx_graph(onnx_model_dir, tiny_model_dir):
+    pytest.importorskip("onnxruntime")
+    assert isinstance(load_engine(onnx_model_dir, engine="auto", threads=1), OnnxModel)
+    assert not isinstance(load_engine(tiny_model_dir, engine="auto", threads=1), OnnxModel)
+
+
+@pytest.mark.parametrize("engine", ["auto", "onnx"])
+def test_falls_back_to_torch_without_onnxruntime(onnx_model_dir, tokenizer, reference, monkeypatch, caplog, engine):
+    block_import(monkeypatch, "onnxruntime")
+    with caplog.at_level(logging.WARNING):
+        model = load_engine(onnx_model_dir, engine=engine, threads=1)
+    assert isinstance(model, torch.nn.Module)
+    assert "onnxruntime is not installed" in caplog.text
+    np.testing.assert_allclose(embed(SENTENCES, model, tokenizer).numpy(), reference, atol=1e-6)
+
+
+def test_falls_back_to_torch_without_onnx_graph(tiny_model_dir, tokenizer, reference, caplog):
+    with caplog.at_level(logging.WARNING):
+        model = load_engine(tiny_model_dir, engine="onnx", threads=1)
+    assert isinstance(model, torch.nn.Module)
+    assert f"{ONNX_MODEL_FILE} is missing" in caplog.text
+    np.testing.assert_allclose(embed(SENTENCES, model, tokenizer).numpy(), reference, atol=1e-6)
+
+
+def test_onnx_only_model_needs_onnxruntime(onnx_only_model_dir, monkeypatch):
+    pytest.importorskip("onnxruntime")
+    assert isinstance(load_engine(onnx_only_model_dir, engine="auto", threads=1), OnnxModel)
+    block_import(monkeypatch, "onnxruntime")
+    with pytest.raises(ImportError, match="no PyTorch weights"):
+        load_engine(onnx_only_model_dir, engine="auto", threads=1)
+
+
+def test_missing_weights_raise_without_onnx_graph(onnx_only_model_dir):
+    os.remove(os.path.join(onnx_only_model_dir, ONNX_MODEL_FILE))
+    with pytest.raises(FileNotFoundError, match="No PyTorch weights"):
+        load_engine(onnx_only_model_dir, engine="onnx", threads=1)
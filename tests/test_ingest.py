@@ -0,0 +1,99 @@
+import json
+import pytest
+from conftest import dataset_rows
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+pytest.importorskip("ijson")
+
+from ingest import DATASET_KEY, download_rows, stream_rows  # noqa: E402
+
+BUCKET = "igdb-test-assets"
+ROWS = 2000  # About 15 MiB of JSON, hundreds of read buffers
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"), ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def dataset(s3):
+    rows = dataset_rows(ROWS)
+    body = json.dumps(rows).encode("utf-8")
+    s3.put_object(Bucket=BUCKET, Key=DATASET_KEY, Body=body)
+    return rows, len(body)
+
+
+class CountingBody:
+    # Stands in for the streaming body of "get_object()", counting the bytes read and whether it's closed
+    def __init__(self, body):
+        self.body = body
+        self.read_bytes = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self.read_bytes += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+        self.body.close()
+
+
+@pytest.fixture
+def counting_s3(s3, monkeypatch):
+    bodies = []
+    get_object = s3.get_object
+
+    def counting_get_object(**kwargs):
+        response = get_object(**kwargs)
+        response["Body"] = CountingBody(response["Body"])
+        bodies.append(response["Body"])
+        return response
+
+    monkeypatch.setattr(s3, "get_object", counting_get_object)
+    return s3, bodies
+
+
+def test_stream_rows_parses_every_row(dataset, s3):
+    rows, _ = dataset
+    streamed = list(stream_rows(s3, BUCKET, buf_size=4096))
+    assert len(streamed) == ROWS
+    assert [row[:-1] for row in streamed] == [row[:-1] for row in rows]
+    assert all(isinstance(value, float) for value in streamed[0][-1])  # "use_float", not Decimal
+    assert streamed[-1][-1] == rows[-1][-1]
+
+
+def test_stream_rows_reads_incrementally(dataset, counting_s3):
+    _, size = dataset
+    s3, bodies = counting_s3
+    buf_size = 64 * 1024
+    rows = stream_rows(s3, BUCKET, buf_size=buf_size)
+    first = next(rows)
+    assert first[0] == 1
+    assert bodies[0].read_bytes <= 2 * buf_size < size
+    rows.close()
+    assert bodies[0].closed
+
+
+def test_stream_rows_closes_body_when_consumer_fails(dataset, counting_s3):
+    s3, bodies = counting_s3
+    with pytest.raises(RuntimeError):
+        for row in stream_rows(s3, BUCKET):
+            if row[0] == 100:
+                raise RuntimeError("consumer failed")
+    # The generator is closed when it's garbage collected, its "finally" closes the body
+    import gc
+    gc.collect()
+    assert bodies[0].closed
+
+
+def test_download_rows_matches_stream_rows(dataset, s3, tmp_path):
+    assert download_rows(s3, BUCKET, tmp_dir=str(tmp_path)) == list(stream_rows(s3, BUCKET))
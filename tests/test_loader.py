@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pgvector")
+
+from psycopg import errors, pq  # noqa: E402
+from loader import COLUMNS, content_hash, copy_rows, create_table  # noqa: E402
+
+
+@pytest.fixture
+def table(conn):
+    with conn.cursor() as cur:
+        create_table(cur)
+    return "igdb"
+
+
+def count(conn, table="igdb"):
+    return conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0]
+
+
+def test_copy_rows_batches(conn, table):
+    rows = dataset_rows(2500)
+    stats = copy_rows(conn, rows, batch_size=1000)
+    assert (stats.rows, stats.batches) == (2500, 3)
+    assert count(conn) == 2500
+
+    row = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM igdb WHERE igdb_id = 42;").fetchone()
+    assert list(row[:7]) == rows[41][:7]
+    np.testing.assert_array_equal(row[7], np.asarray(rows[41][7], dtype=np.float32))
+    assert bytes(row[8]) == content_hash(rows[41])
+    assert (row[9], row[10]) == (2002, ["Platform", "Puzzle"])
+
+
+def test_copy_rows_consumes_rows_lazily(conn, table):
+    # Rows are pulled one batch at a time, a generator is never materialized
+    pulled = []
+
+    def rows():
+        for row in dataset_rows(300):
+            pulled.append(row[0])
+            yield row
+
+    batches = []
+    original = conn.transaction
+
+    def transaction(*args, **kwargs):
+        batches.append(len(pulled))
+        return original(*args, **kwargs)
+
+    conn.transaction = transaction
+    copy_rows(conn, rows(), batch_size=100)
+    assert batches == [100, 200, 300]
+
+
+def test_failed_batch_only_rolls_back_itself(conn, table):
+    # The second batch holds a duplicate primary key: the first batch stays committed
+    rows = dataset_rows(250)
+    rows[150][0] = rows[120][0]
+    with pytest.raises(errors.UniqueViolation):
+        copy_rows(conn, rows, batch_size=100)
+    assert count(conn) == 100
+    assert conn.info.transaction_status == pq.TransactionStatus.IDLE
+    # The connection is still usable, e.g. to retry the remaining rows
+    copy_rows(conn, dataset_rows(150, start=101), batch_size=100)
+    assert count(conn) == 250
+
+
+def test_failing_row_source_rolls_back_the_current_batch(conn, table):
+    def rows():
+        yield from dataset_rows(150)
+        raise IOError("connection reset while reading the dataset")
+
+    with pytest.raises(IOError):
+        copy_rows(conn, rows(), batch_size=100)
+    assert count(conn) == 100
+    assert conn.info.transaction_status == pq.TransactionStatus.IDLE
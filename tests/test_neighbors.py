@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pgvector")
+
+from neighbors import NEIGHBORS_TABLE, build_neighbors, top_k_neighbors, update_neighbors  # noqa: E402
+from sync import incremental_import, post_import  # noqa: E402
+
+ROWS = 300
+K = 5
+INDEX_OPTIONS = {"method": "ivfflat"}
+
+
+def neighbor_lists(conn):
+    lists = {}
+    for igdb_id, neighbor_id, score in conn.execute(f"SELECT igdb_id, neighbor_id, score FROM {NEIGHBORS_TABLE} ORDER BY igdb_id, rank;"):
+        lists.setdefault(igdb_id, []).append((neighbor_id, round(score, 4)))
+    return lists
+
+
+def moved_rows(rows, positions, seed=1):
+    # The rows at these positions get new random embeddings
+    rng = np.random.default_rng(seed)
+    for position in positions:
+        vector = rng.normal(size=len(rows[position][7])).astype(np.float32)
+        rows[position][7] = (vector / np.linalg.norm(vector)).tolist()
+    return rows
+
+
+def test_top_k_matches_a_full_sort():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(50, 8)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ matrix.T
+    np.fill_diagonal(scores, -np.inf)
+    expected = np.argsort(-scores, axis=1, kind="stable")[:, :K]
+    # Small blocks and tiles, so the running top-k is merged across tiles
+    blocks = list(top_k_neighbors(matrix, np.arange(50), K, block_size=16, tile_size=7))
+    assert np.concatenate([positions for positions, _, _ in blocks]).tolist() == list(range(50))
+    np.testing.assert_array_equal(np.concatenate([neighbors for _, neighbors, _ in blocks]), expected)
+
+
+def test_incremental_update_matches_a_full_build(conn):
+    rows = dataset_rows(ROWS)
+    incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    build_neighbors(conn, k=K, block_size=64)
+    assert len(neighbor_lists(conn)) == ROWS
+
+    rows = moved_rows(rows, [2, 40, 41, 150])
+    del rows[77]
+    rows += moved_rows(dataset_rows(3, start=ROWS + 1), range(3), seed=2)
+    stats = incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    neighbor_stats = update_neighbors(conn, changed=stats.upserted_ids, deleted=stats.deleted_ids, k=K, block_size=64)
+    assert neighbor_stats.mode == "incremental"
+    assert 7 <= neighbor_stats.updated < ROWS
+    incremental = neighbor_lists(conn)
+
+    build_neighbors(conn, k=K, block_size=64)
+    assert incremental == neighbor_lists(conn)
+    assert 78 not in incremental and all(78 not in [neighbor for neighbor, _ in lists] for lists in incremental.values())
+
+
+def test_unchanged_import_keeps_the_neighbors(conn):
+    rows = dataset_rows(ROWS)
+    incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    build_neighbors(conn, k=K)
+    stats = update_neighbors(conn, changed=[], deleted=[], k=K)
+    assert (stats.mode, stats.updated) == ("incremental", 0)
+
+
+def test_falls_back_to_a_full_build(conn):
+    rows = dataset_rows(ROWS)
+    incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    assert update_neighbors(conn, changed=[1], k=K).mode == "full"  # No neighbors table yet
+    assert update_neighbors(conn, changed=[1], k=K + 1).mode == "full"  # Built with another k
+    assert update_neighbors(conn, changed=None, k=K + 1).mode == "full"  # Every row reloaded
+    assert update_neighbors(conn, changed=list(range(1, ROWS // 2 + 2)), k=K + 1).mode == "full"  # Most rows changed
+    assert all(len(lists) == K + 1 for lists in neighbor_lists(conn).values())
+
+
+def test_post_import_updates_the_neighbors(conn):
+    rows = dataset_rows(ROWS)
+    post_import(conn, incremental_import(conn, rows, index_options=INDEX_OPTIONS), "incremental", neighbors_k=K)
+    assert len(neighbor_lists(conn)) == ROWS
+    post_import(conn, incremental_import(conn, rows[1:], index_options=INDEX_OPTIONS), "incremental", neighbors_k=K)
+    lists = neighbor_lists(conn)
+    assert 1 not in lists and all(1 not in [neighbor for neighbor, _ in neighbors] for neighbors in lists.values())
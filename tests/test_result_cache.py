@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from conftest import dataset_rows
+
+from igdb.result_cache import ResultCache
+
+KEY = ("vector", 5, "{}")
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_near_queries_hit_and_far_ones_miss():
+    cache = ResultCache(max_distance=0.05, max_entries=4)
+    cache.put(KEY, [1.0, 0.0, 0.0], [("mario",)], seconds=0.2)
+    assert cache.get(KEY, [1.0, 0.05, 0.0], elapsed=0.05) == [("mario",)]
+    assert cache.get(KEY, [0.0, 1.0, 0.0]) is None
+    assert cache.get(("hybrid", 5, "{}"), [1.0, 0.0, 0.0]) is None  # Other mode or parameters
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.saved_seconds == pytest.approx(0.15)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_distance=0.01, max_entries=2)
+    cache.put(KEY, [1.0, 0.0, 0.0], ["a"], seconds=0.1)
+    cache.put(KEY, [0.0, 1.0, 0.0], ["b"], seconds=0.1)
+    cache.get(KEY, [1.0, 0.0, 0.0])
+    cache.put(KEY, [0.0, 0.0, 1.0], ["c"], seconds=0.1)
+    assert cache.evictions == 1 and len(cache) == 2
+    assert cache.get(KEY, [0.0, 1.0, 0.0]) is None
+    assert cache.get(KEY, [1.0, 0.0, 0.0]) == ["a"]
+
+
+def test_new_generation_drops_every_entry():
+    cache = ResultCache(generation_ttl=60)
+    assert cache.generation_due()
+    cache.set_generation(1)
+    assert not cache.generation_due()
+    cache.put(KEY, [1.0, 0.0], ["a"], seconds=0.1)
+    cache.set_generation(1)
+    assert cache.get(KEY, [1.0, 0.0]) == ["a"]
+    cache.set_generation(2)
+    assert cache.get(KEY, [1.0, 0.0]) is None
+    assert (len(cache), cache.invalidations, cache.generation) == (0, 1, 2)
+
+
+class FixedEmbedder:
+    # Embeds every text into the same vector, so every search after the first one hits the cache
+    def __init__(self, vector):
+        self.vector = vector
+        self.calls = 0
+
+    def embed(self, texts):
+        self.calls += 1
+        return [self.vector for _ in texts]
+
+
+def test_search_client_is_invalidated_by_an_import(conn, conninfo):
+    pytest.importorskip("psycopg_pool")
+    from loader import copy_rows, create_table
+    from sync import record_generation
+    from igdb.search import SearchClient
+
+    rows = dataset_rows(20)
+    with conn.cursor() as cur:
+        create_table(cur)
+    copy_rows(conn, rows)
+    cache = ResultCache(generation_ttl=0)  # Read the generation before every search
+    with SearchClient(conninfo=conninfo, embedder=FixedEmbedder(rows[0][7]), result_cache=cache) as client:
+        first = client.search_text("a platform game")
+        assert first[0][0] == 1
+        assert (cache.hits, cache.misses, cache.generation) == (0, 1, 0)  # No import generation recorded yet
+        assert client.search_text("a platform game!") == first
+        assert cache.hits == 1
+
+        # An import replaces the top result, the cached one must not be served anymore
+        conn.execute("DELETE FROM igdb WHERE igdb_id = 1;")
+        record_generation(conn, "incremental")
+        second = client.search_text("a platform game")
+        assert (cache.hits, cache.misses, cache.invalidations, cache.generation) == (1, 2, 1, 1)
+        assert second[0][0] != 1
+        assert client.search_text("a platform game") == second
+        assert cache.hits == 2
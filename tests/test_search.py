@@ -0,0 +1,57 @@
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("psycopg")
+pytest.importorskip("psycopg_pool")
+pytest.importorskip("pgvector")
+
+from loader import copy_rows, create_table  # noqa: E402
+from igdb.embedding_client import FakeTransport  # noqa: E402
+from igdb.search import SearchClient  # noqa: E402
+
+NAMES = ["The Legend of Zelda: Tears of the Kingdom", "Mario Kart 8 Deluxe", "Puzzle Bobble", "Puzzle Quest",
+         "Racing Kart Heroes", "Tetris", "Kirby Star Allies", "Super Mario Odyssey"]
+
+
+class CountingEmbedder:
+    def __init__(self):
+        self.transport = FakeTransport(dim=384, latency=0, per_text_latency=0)
+        self.texts = []
+
+    def embed(self, texts):
+        self.texts.extend(texts)
+        return self.transport({"inputs": texts})["vectors"]
+
+
+@pytest.fixture
+def client(conn, conninfo):
+    with conn.cursor() as cur:
+        create_table(cur)
+    rows = dataset_rows(len(NAMES))
+    for row, name in zip(rows, NAMES):
+        row[1] = name
+    rows[2][3] = "A racing puzzle game. Genres: Puzzle."
+    copy_rows(conn, rows)
+    with SearchClient(conninfo=conninfo, embedder=CountingEmbedder()) as client:
+        yield client
+
+
+@pytest.mark.parametrize("text, name", [("Zelda Tears of the Kingdom", NAMES[0]), ("mario kart", NAMES[1]),
+                                        ("Tetris", NAMES[5]), ("puzzle bobble", NAMES[2])])
+def test_title_queries_take_the_lexical_fast_path(client, text, name):
+    rows = client.hybrid_search(text, k=3)
+    assert client.embedder.texts == []
+    assert rows[0][1] == name
+
+
+@pytest.mark.parametrize("text", ["racing", "puzzle", "kart", "a puzzle game"])
+def test_descriptive_queries_are_fused_with_the_semantic_search(client, text):
+    _, strong_match = client.lexical_search(text)
+    assert not strong_match
+    client.hybrid_search(text, k=3)
+    assert client.embedder.texts == [text]
+
+
+def test_lexical_fast_path_can_be_disabled(client):
+    client.hybrid_search("Tetris", k=3, lexical_fast_path=False)
+    assert client.embedder.texts == ["Tetris"]
@@ -0,0 +1,178 @@
+import json
+import threading
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("psycopg")
+pytest.importorskip("psycopg_pool")
+pytest.importorskip("pgvector")
+
+import shards  # noqa: E402
+import tracing  # noqa: E402
+from loader import copy_rows  # noqa: E402
+from shards import (LOCK_KEY, SHARDS_TABLE, begin_import, finish_import, load_shard, run_shards,  # noqa: E402
+                    sharded_import, worker_pool)
+from sync import SHADOW_TABLE, TABLE  # noqa: E402
+
+# [NOTE] The advisory lock of the imports is global to the database, these tests must not run in parallel
+ROWS = 450  # 5 shards of 100 rows, the last one partial
+SHARD_SIZE = 100
+IMPORT_ID = "dataset-v1"
+INDEX_OPTIONS = {"method": "ivfflat"}
+
+
+@pytest.fixture
+def pool(conninfo):
+    with worker_pool(conninfo, workers=2) as pool:
+        yield pool
+
+
+def ids(conn, table=TABLE):
+    return [igdb_id for igdb_id, in conn.execute(f"SELECT igdb_id FROM {table} ORDER BY igdb_id;")]
+
+
+def shard_states(conn):
+    return conn.execute(f"SELECT shard, status, rows, attempts FROM {SHARDS_TABLE} ORDER BY shard;").fetchall()
+
+
+def run_import(conn, pool, rows=None, **kwargs):
+    return sharded_import(conn, pool, rows or dataset_rows(ROWS), IMPORT_ID, shard_size=SHARD_SIZE, workers=2,
+                          batch_size=20, index_options=INDEX_OPTIONS, **kwargs)
+
+
+def test_import_loads_every_shard_once(conn, pool):
+    stats = run_import(conn, pool)
+    assert (stats.loaded, stats.skipped, stats.failed, stats.rows, stats.pending) == (5, 0, 0, ROWS, 0)
+    assert stats.finished and stats.swapped
+    assert ids(conn) == list(range(1, ROWS + 1))
+    assert [state[1:] for state in shard_states(conn)] == [("done", 100, 1)] * 4 + [("done", 50, 1)]
+    assert conn.execute(f"SELECT to_regclass('{SHADOW_TABLE}');").fetchone()[0] is None
+
+
+def test_shard_spans_are_children_of_the_import(conn, pool, monkeypatch, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing.tracer, "sink", "json")
+    monkeypatch.setattr(tracing.tracer, "sample_rate", 1.0)
+    monkeypatch.setattr(tracing.tracer, "path", str(path))
+    run_import(conn, pool)
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert {record["trace"] for record in records} == {"sharded_import"}
+    copies = [record for record in records if record["phase"] == "sharded_import/copy"]
+    assert len(copies) == 1
+    assert (copies[0]["calls"], copies[0]["rows"]) == (5, ROWS)
+
+
+def test_resumes_after_a_worker_is_killed(conn, connect, pool, monkeypatch):
+    # The backend of the worker loading shard 2 is terminated halfway through it, after 2 of its batches
+    admin = connect()
+    killed = []
+
+    def copy_rows_killed(worker_conn, rows, **kwargs):
+        if rows[0][0] != 201 or killed:
+            return copy_rows(worker_conn, rows, **kwargs)
+
+        def killing():
+            for i, row in enumerate(rows):
+                if i == 50:
+                    killed.append(worker_conn.info.backend_pid)
+                    admin.execute("SELECT pg_terminate_backend(%s);", (worker_conn.info.backend_pid,))
+                yield row
+
+        return copy_rows(worker_conn, killing(), **kwargs)
+
+    monkeypatch.setattr(shards, "copy_rows", copy_rows_killed)
+    stats = run_import(conn, pool)
+    assert killed
+    assert (stats.loaded, stats.failed, stats.pending) == (4, 1, 1)
+    assert not stats.finished and not stats.swapped
+    # Everything the killed worker copied has been rolled back, the shard is still pending
+    shadow_ids = ids(conn, SHADOW_TABLE)
+    assert len(shadow_ids) == ROWS - 100 and not set(range(201, 301)) & set(shadow_ids)
+    assert shard_states(conn)[2] == (2, "pending", 0, 1)
+
+    # The next invocation only loads the killed shard, and the table holds every row exactly once
+    stats = run_import(conn, pool)
+    assert (stats.loaded, stats.skipped, stats.failed, stats.rows, stats.pending) == (1, 4, 0, 100, 0)
+    assert stats.finished and stats.swapped
+    assert ids(conn) == list(range(1, ROWS + 1))
+    assert [state[1:] for state in shard_states(conn)] == [("done", 100, 1)] * 2 + [("done", 100, 2)] + \
+        [("done", 100, 1), ("done", 50, 1)]
+
+
+def test_shard_locked_by_another_invocation_is_skipped(conn, connect, pool):
+    begin_import(conn, IMPORT_ID, SHARD_SIZE)
+    conn.execute(f"INSERT INTO {SHARDS_TABLE} (import_id, shard) VALUES (%s, 1);", (IMPORT_ID,))
+    other = connect()
+    with other.transaction():
+        # Another invocation is loading shard 1
+        other.execute(f"SELECT 1 FROM {SHARDS_TABLE} WHERE import_id = %s AND shard = 1 FOR UPDATE;", (IMPORT_ID,))
+        assert load_shard(pool, IMPORT_ID, 1, dataset_rows(100, start=101), "worker") is None
+        assert load_shard(pool, IMPORT_ID, 0, dataset_rows(100), "worker") == 100
+    assert [state[1:] for state in shard_states(conn)] == [("done", 100, 1), ("pending", 0, 0)]
+    assert ids(conn, SHADOW_TABLE) == list(range(1, 101))
+
+
+def test_concurrent_invocations_share_the_shards(conninfo, connect, monkeypatch):
+    # Slow down the loads, so both invocations are claiming shards at the same time
+    started = threading.Barrier(2)
+
+    def copy_rows_slow(worker_conn, rows, **kwargs):
+        try:
+            started.wait(timeout=1)
+        except threading.BrokenBarrierError:
+            pass
+        return copy_rows(worker_conn, rows, **kwargs)
+
+    monkeypatch.setattr(shards, "copy_rows", copy_rows_slow)
+    results = [None, None]
+
+    def invoke(i):
+        with worker_pool(conninfo, workers=2) as pool:
+            results[i] = run_import(connect(), pool)
+
+    threads = [threading.Thread(target=invoke, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(stats.loaded for stats in results) == 5
+    assert sum(stats.rows for stats in results) == ROWS
+    assert sum(stats.failed for stats in results) == 0
+    assert [stats.swapped for stats in results].count(True) <= 1
+    conn = connect()
+    if not any(stats.swapped for stats in results):
+        # Both finished their shards while the other one held the lock, the next run does the swap
+        assert finish_import(conn, IMPORT_ID, index_options=INDEX_OPTIONS) == "swapped"
+    assert ids(conn) == list(range(1, ROWS + 1))
+    # [NOTE] A shard claimed by both invocations at once counts an attempt for each, only one of them loads it
+    assert [state[1:3] for state in shard_states(conn)] == [("done", 100)] * 4 + [("done", 50)]
+
+
+def test_finish_import_is_guarded_by_the_advisory_lock(conn, connect, pool):
+    begin_import(conn, IMPORT_ID, SHARD_SIZE)
+    stats = run_shards(conn, pool, IMPORT_ID, dataset_rows(ROWS), shard_size=SHARD_SIZE, workers=2, deadline=0)
+    assert stats.stopped_early and stats.loaded == 0
+    assert finish_import(conn, IMPORT_ID) is None  # Stopped before the end of the dataset, shards are left
+    run_shards(conn, pool, IMPORT_ID, dataset_rows(ROWS), shard_size=SHARD_SIZE, workers=2)
+
+    other = connect()
+    other.execute("SELECT pg_advisory_lock(%s);", (LOCK_KEY,))
+    try:
+        # Another invocation is swapping the table in, this one leaves it to that one
+        assert finish_import(conn, IMPORT_ID, index_options=INDEX_OPTIONS) is None
+        assert conn.execute(f"SELECT to_regclass('{TABLE}');").fetchone()[0] is None
+    finally:
+        other.execute("SELECT pg_advisory_unlock(%s);", (LOCK_KEY,))
+    assert finish_import(conn, IMPORT_ID, index_options=INDEX_OPTIONS) == "swapped"
+    assert finish_import(conn, IMPORT_ID, index_options=INDEX_OPTIONS) == "finished"
+    assert ids(conn) == list(range(1, ROWS + 1))
+
+
+def test_rerun_of_a_finished_import_does_not_swap_again(conn, pool):
+    assert run_import(conn, pool).swapped
+    stats = run_import(conn, pool)
+    assert stats.finished and not stats.swapped
+    assert (stats.loaded, stats.pending) == (0, 0)
+    assert finish_import(conn, IMPORT_ID) == "finished"
+    assert ids(conn) == list(range(1, ROWS + 1))
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from conftest import dataset_rows
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pgvector")
+
+import sync  # noqa: E402
+from loader import content_hash  # noqa: E402
+from sync import GENERATION_TABLE, incremental_import, post_import, record_generation, swap_import  # noqa: E402
+
+ROWS = 40
+INDEX_OPTIONS = {"method": "ivfflat"}
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    # Row counts of the vector index builds
+    builds = []
+    build_index = sync.build_index
+
+    def counting_build_index(conn, row_count=None, **kwargs):
+        builds.append(row_count)
+        return build_index(conn, row_count=row_count, **kwargs)
+
+    monkeypatch.setattr(sync, "build_index", counting_build_index)
+    return builds
+
+
+def table_rows(conn):
+    return {igdb_id: (description, bytes(row_hash)) for igdb_id, description, row_hash in
+            conn.execute("SELECT igdb_id, description, content_hash FROM igdb;")}
+
+
+def generations(conn):
+    return conn.execute(f"SELECT count(*) FROM {GENERATION_TABLE};").fetchone()[0]
+
+
+def test_first_import_rebuilds_the_table(conn, builds):
+    stats = incremental_import(conn, dataset_rows(ROWS), index_options=INDEX_OPTIONS)
+    assert (stats.mode, stats.rows, stats.upserted, stats.upserted_ids) == ("swap", ROWS, ROWS, None)
+    assert len(table_rows(conn)) == ROWS
+    assert builds == [ROWS]
+
+
+def test_unchanged_dataset_is_a_no_op(conn, builds):
+    rows = dataset_rows(ROWS)
+    incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    before = table_rows(conn)
+    stats = incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    assert (stats.mode, stats.rows, stats.upserted, stats.deleted) == ("incremental", ROWS, 0, 0)
+    assert (stats.upserted_ids, stats.deleted_ids) == ([], [])
+    assert table_rows(conn) == before
+    assert builds == [ROWS]
+
+
+def test_changed_and_removed_rows(conn, builds):
+    rows = dataset_rows(ROWS)
+    incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    rows[4][3] = "A new description. Released on Jan 01, 2024. Genres: Racing."
+    rows[9][7] = list(np.roll(rows[9][7], 1))
+    removed = rows.pop(14)
+    rows += dataset_rows(2, start=ROWS + 1)
+    stats = incremental_import(conn, rows, index_options=INDEX_OPTIONS)
+    assert sorted(stats.upserted_ids) == [5, 10, ROWS + 1, ROWS + 2]
+    assert stats.deleted_ids == [removed[0]]
+
+    imported = table_rows(conn)
+    assert sorted(imported) == sorted(row[0] for row in rows)
+    assert imported[5] == (rows[4][3], content_hash(rows[4]))
+    assert imported[10][1] == content_hash(rows[9])
+    year, genres = conn.execute("SELECT release_year, genres FROM igdb WHERE igdb_id = 5;").fetchone()
+    assert (year, genres) == (2024, ["Racing"])
+    assert builds == [ROWS]  # The table size barely changed, the index is kept
+
+
+def test_index_is_rebuilt_when_the_table_size_changes_a_lot(conn, builds):
+    incremental_import(conn, dataset_rows(ROWS), index_options=INDEX_OPTIONS)
+    incremental_import(conn, dataset_rows(ROWS * 3), index_options=INDEX_OPTIONS)
+    assert builds == [ROWS, ROWS * 3]
+    incremental_import(conn, dataset_rows(ROWS), index_options=INDEX_OPTIONS)
+    assert builds == [ROWS, ROWS * 3, ROWS]
+
+
+def test_outdated_table_is_rebuilt(conn, builds):
+    conn.execute("CREATE TABLE igdb (igdb_id bigserial primary key, name text, description_embeddings vector(384));")
+    stats = incremental_import(conn, dataset_rows(ROWS), index_options=INDEX_OPTIONS)
+    assert stats.mode == "swap"
+    assert len(table_rows(conn)) == ROWS
+
+
+def test_swap_import_replaces_the_table(conn):
+    swap_import(conn, dataset_rows(ROWS), index_options=INDEX_OPTIONS)
+    swap_import(conn, dataset_rows(5, start=100), index_options=INDEX_OPTIONS)
+    assert sorted(table_rows(conn)) == list(range(100, 105))
+    indexes = {name for name, in conn.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'igdb';")}
+    assert "igdb_description_embeddings_idx" in indexes
+
+
+def test_generation_is_bumped_only_when_rows_changed(conn):
+    rows = dataset_rows(ROWS)
+    post_import(conn, incremental_import(conn, rows, index_options=INDEX_OPTIONS), "incremental", neighbors_k=0)
+    assert generations(conn) == 1
+    post_import(conn, incremental_import(conn, rows, index_options=INDEX_OPTIONS), "incremental", neighbors_k=0)
+    assert generations(conn) == 1
+    post_import(conn, incremental_import(conn, rows[1:], index_options=INDEX_OPTIONS), "incremental", neighbors_k=0)
+    assert generations(conn) == 2
+    assert record_generation(conn, "swap") == 3
@@ -0,0 +1,50 @@
+import filecmp
+import io
+import json
+import os
+import pytest
+from conftest import MODEL_CODE_DIR, ROOT
+
+from tracing import NOOP_SPAN, Tracer, current_span
+
+
+@pytest.mark.parametrize("copy", [os.path.join(ROOT, "igdb", "tracing.py"), os.path.join(MODEL_CODE_DIR, "tracing.py")])
+def test_copies_match_lambda_tracing(copy):
+    assert filecmp.cmp(os.path.join(ROOT, "lambda", "tracing.py"), copy, shallow=False)
+
+
+def test_nested_spans_are_merged_by_path(tmp_path):
+    tracer = Tracer(sink="json", path=str(tmp_path / "traces.jsonl"))
+    with tracer.span("import", mode="swap"):
+        for rows in (10, 20):
+            with tracer.span("copy") as current:
+                current.add(rows=rows)
+                assert current_span() is current
+        for _ in tracer.iterate("read", range(3), unit="rows"):
+            pass
+    records = {record["phase"]: record for record in map(json.loads, (tmp_path / "traces.jsonl").read_text().splitlines())}
+    assert list(records) == ["import", "import/copy", "import/read"]
+    assert records["import"]["mode"] == "swap"
+    assert (records["import/copy"]["calls"], records["import/copy"]["rows"]) == (2, 30)
+    assert records["import/read"]["rows"] == 3
+    assert tracer.traces == 1
+
+
+def test_emf_sink_writes_a_metric_per_counter():
+    stream = io.StringIO()
+    tracer = Tracer(sink="emf", stream=stream)
+    with tracer.span("inference") as current:
+        current.add(sentences=4)
+    record = json.loads(stream.getvalue())
+    metrics = {metric["Name"] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert {"Duration", "Calls", "sentences"} <= metrics
+    assert (record["Trace"], record["Phase"], record["sentences"]) == ("inference", "inference", 4)
+
+
+def test_unsampled_traces_record_nothing(tmp_path):
+    tracer = Tracer(sink="json", sample_rate=0.0, path=str(tmp_path / "traces.jsonl"))
+    with tracer.span("search") as current:
+        assert current is NOOP_SPAN
+        with tracer.span("query") as child:
+            assert child is NOOP_SPAN
+    assert tracer.traces == 0 and not (tmp_path / "traces.jsonl").exists()